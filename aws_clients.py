@@ -0,0 +1,93 @@
+import logging
+import threading
+from typing import Dict, Tuple
+import boto3
+from botocore.config import Config
+
+logger = logging.getLogger(__name__)
+
+# One boto3 session and one client per service for the whole consumer.
+# Every client brings its own urllib3 pool (10 connections by default), so with one client per
+# component and per thread the workers kept overflowing pools ("Connection pool is full, discarding
+# connection") and paying for new TLS handshakes. The factory builds each client once, with the pool
+# sized for the worker count, explicit timeouts, the retry mode and TCP keepalive from the config.
+# boto3 clients are thread safe, resources are not, so resources get one per thread on top of the shared client.
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def shared_session() -> boto3.session.Session:
+    """
+    The process-wide boto3 session. Creating a session reloads the service models from disk,
+    which costs a few hundred ms, so every factory builds its clients from this one.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = boto3.session.Session()
+        return _session
+
+
+class ClientFactory:
+    """
+    Builds and caches boto3 clients for one session.
+
+    endpoint_url points every service at a local stand-in (moto server, LocalStack...).
+    """
+    def __init__(self, region_name: str = 'us-east-1', max_pool_connections: int = 10,
+                 connect_timeout_s: float = 5, read_timeout_s: float = 30, retry_mode: str = 'standard',
+                 retry_max_attempts: int = 3, tcp_keepalive: bool = True, endpoint_url: str = None):
+        self.region_name = region_name
+        self.endpoint_url = endpoint_url
+        self.botocore_config = Config(
+            max_pool_connections=max_pool_connections,
+            connect_timeout=connect_timeout_s,
+            read_timeout=read_timeout_s,
+            retries={'mode': retry_mode, 'max_attempts': retry_max_attempts},
+            tcp_keepalive=tcp_keepalive
+        )
+        self.session = shared_session()
+        self._clients: Dict[Tuple[str, str], object] = {}
+        self._resources: Dict[Tuple[str, str], object] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config) -> "ClientFactory":
+        return cls(
+            region_name=config.region_name,
+            # every worker can hold a request GET and a storage call at once, plus the flusher threads
+            max_pool_connections=config.max_pool_connections or max(10, 2 * config.workers + 2),
+            connect_timeout_s=config.connect_timeout_s,
+            read_timeout_s=config.read_timeout_s,
+            retry_mode=config.retry_mode,
+            retry_max_attempts=config.retry_max_attempts,
+            tcp_keepalive=config.tcp_keepalive,
+            endpoint_url=config.endpoint_url
+        )
+
+    def client(self, service: str, region_name: str = None):
+        """The shared client for a service, safe to use from any thread."""
+        key = (service, region_name or self.region_name)
+        client = self._clients.get(key)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(key)
+                if client is None:
+                    client = self._clients[key] = self.session.client(
+                        service, region_name=key[1], endpoint_url=self.endpoint_url, config=self.botocore_config)
+        return client
+
+    def dynamodb_table(self, table_name: str, region_name: str = None):
+        """
+        A new Table resource for the calling thread. Resource objects aren't thread safe, but every
+        Table made here sits on the same shared DynamoDB resource client and its connection pool.
+        """
+        key = ('dynamodb', region_name or self.region_name)
+        with self._lock:
+            resource = self._resources.get(key)
+            if resource is None:
+                resource = self._resources[key] = self.session.resource(
+                    'dynamodb', region_name=key[1], endpoint_url=self.endpoint_url, config=self.botocore_config)
+            return resource.Table(table_name)
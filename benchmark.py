@@ -0,0 +1,393 @@
+import argparse
+import json
+import os
+import random
+import string
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Any
+
+import boto3
+from config import ConsumerConfig
+from get_widget import RequestAcknowledger, RequestDecodeError
+from request_sources import create_request_source
+from widget_processor import Wiget_Processor, InvalidRequestError
+from metrics import METRICS
+from aws_clients import ClientFactory
+import json_codec
+
+# End-to-end throughput/latency benchmark for the consumer pipeline.
+# Generates N synthetic widget requests shaped like the test fixture, pushes them through
+# retrieval -> processing/storage -> acknowledgement against moto (no AWS account needed),
+# and prints a JSON report so runs can be compared across worker counts, batching and backends.
+#
+#   python benchmark.py --requests 2000 --workers 8 --prefetch-size 1000 --storage-type dynamodb --dynamodb-batch-size 25
+#
+# --codec-only skips the pipeline and times the JSON codecs alone on the same payloads:
+#
+#   python benchmark.py --codec-only --requests 1000 --note-size 300
+
+REQUEST_BUCKET = 'bench-widget-requests'
+WIDGET_BUCKET = 'bench-widgets'
+WIDGET_TABLE = 'bench-widgets'
+REGION = 'us-east-1'
+OWNERS = ["Sue Smith", "John Jones", "Mary Major", "Henry Hops"]
+
+
+def _random_upper(length: int) -> str:
+    return ''.join(random.choices(string.ascii_uppercase, k=length))
+
+
+def _random_uuid() -> str:
+    # drawn from `random` (not uuid4) so a seed reproduces the same requests
+    return str(uuid.UUID(int=random.getrandbits(128), version=4))
+
+
+def generate_requests(count: int, note_size: int = 300, seed: int = None) -> List[Dict[str, Any]]:
+    """
+    Builds `count` create requests shaped like the fixture payload, including a large `note` attribute.
+    """
+    rng_state = random.getstate()
+    if seed is not None:
+        random.seed(seed)
+    try:
+        requests = []
+        for _ in range(count):
+            requests.append({
+                "type": "create",
+                "requestId": _random_uuid(),
+                "widgetId": _random_uuid(),
+                "owner": random.choice(OWNERS),
+                "label": _random_upper(9),
+                "description": _random_upper(43),
+                "otherAttributes": [
+                    {"name": "color", "value": random.choice(["blue", "red", "green"])},
+                    {"name": "height", "value": str(random.randint(1, 999))},
+                    {"name": "height-unit", "value": "cm"},
+                    {"name": "width", "value": str(random.randint(1, 999))},
+                    {"name": "width-unit", "value": "cm"},
+                    {"name": "rating", "value": f"{random.uniform(0, 5):.7f}"},
+                    {"name": "quantity", "value": str(random.randint(1, 999))},
+                    {"name": "vendor", "value": _random_upper(14)},
+                    {"name": "note", "value": _random_upper(note_size)},
+                ],
+            })
+        return requests
+    finally:
+        random.setstate(rng_state)
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100.0 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+class StageTimer:
+    """Collects latency samples per pipeline stage."""
+    def __init__(self):
+        self._samples: Dict[str, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self._samples.setdefault(stage, []).append(seconds)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        summary = {}
+        with self._lock:
+            samples = {stage: sorted(values) for stage, values in self._samples.items()}
+        for stage, values in samples.items():
+            summary[stage] = {
+                "count": len(values),
+                "mean_ms": round(sum(values) / len(values) * 1000, 3),
+                "p50_ms": round(percentile(values, 50) * 1000, 3),
+                "p95_ms": round(percentile(values, 95) * 1000, 3),
+                "p99_ms": round(percentile(values, 99) * 1000, 3),
+            }
+        return summary
+
+
+class _Completions:
+    """Request keys handed to the processor whose ack hasn't fired yet."""
+    def __init__(self):
+        self._pending = set()
+        self._cond = threading.Condition()
+
+    def start(self, key: str) -> None:
+        with self._cond:
+            self._pending.add(key)
+
+    def done(self, key: str) -> None:
+        with self._cond:
+            self._pending.discard(key)
+            self._cond.notify_all()
+
+    def wait(self, timeout: float) -> List[str]:
+        """Waits up to timeout seconds for every ack, returns the keys still waiting."""
+        with self._cond:
+            self._cond.wait_for(lambda: not self._pending, timeout)
+            return sorted(self._pending)
+
+
+def _setup_backends(config: ConsumerConfig, requests: List[Dict[str, Any]], work_dir: str) -> ConsumerConfig:
+    """Creates the buckets/table (inside an active moto mock) and loads the requests into the source."""
+    s3_client = boto3.client('s3', region_name=REGION)
+    s3_client.create_bucket(Bucket=WIDGET_BUCKET)
+    if config.storage_type == 'dynamodb':
+        boto3.client('dynamodb', region_name=REGION).create_table(
+            TableName=WIDGET_TABLE,
+            KeySchema=[{'AttributeName': 'widgetId', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'widgetId', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+
+    if config.request_source == 's3':
+        s3_client.create_bucket(Bucket=REQUEST_BUCKET)
+        for request in requests:
+            s3_client.put_object(Bucket=REQUEST_BUCKET, Key=request["requestId"], Body=json.dumps(request))
+        return config
+    elif config.request_source == 'jsonl':
+        path = os.path.join(work_dir, "requests.jsonl")
+        with open(path, 'w', encoding='utf-8') as f:
+            for request in requests:
+                f.write(json.dumps(request) + "\n")
+        return config._replace(request_path=path)
+    else:
+        path = os.path.join(work_dir, "requests")
+        os.makedirs(path)
+        for request in requests:
+            with open(os.path.join(path, request["requestId"]), 'w', encoding='utf-8') as f:
+                json.dump(request, f)
+        return config._replace(request_path=path)
+
+
+def _drain(source, processor, acknowledger, timer: StageTimer, completions: _Completions,
+           failed: Dict[str, str]) -> int:
+    """
+    Worker: handles requests until the source is empty, returns how many it handled.
+    Requests that can't be decoded, fail validation or whose coalesced write failed are recorded in failed
+    and stay claimed, so they aren't handed out again.
+    """
+    handled = 0
+    while True:
+        start = time.perf_counter()
+        try:
+            request = source.get_next_request()
+        except RequestDecodeError as e:
+            failed[e.request_key] = e.reason
+            continue
+        retrieved = time.perf_counter()
+        if request is None:
+            return handled
+        timer.record("retrieve", retrieved - start)
+
+        request_key, widget_request = request
+
+        def ack(key=request_key, start=start):
+            acknowledger.ack(key)
+            timer.record("total", time.perf_counter() - start)
+            completions.done(key)
+
+        def on_failure(error, key=request_key):
+            failed[key] = str(error)
+            completions.done(key)
+
+        completions.start(request_key)
+        try:
+            processor.process(widget_request, ack=ack, on_failure=on_failure)
+        except InvalidRequestError as e:
+            completions.done(request_key)
+            failed[request_key] = str(e)
+            continue
+        timer.record("process", time.perf_counter() - retrieved)
+        handled += 1
+
+
+def run_benchmark(config: ConsumerConfig, request_count: int, note_size: int = 300, seed: int = None,
+                  ack_timeout_s: float = 60.0) -> Dict[str, Any]:
+    """
+    Runs one benchmark and returns the report as a dict.
+    Handled requests whose ack hasn't fired ack_timeout_s after the run (e.g. a batch that ran out of
+    retries) are listed under "incomplete" instead of blocking the run forever.
+    """
+    try:
+        from moto import mock_aws
+    except ImportError:
+        raise RuntimeError("the benchmark needs moto installed (pip install moto)")
+
+    # moto still wants credentials to sign requests with
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+
+    requests = generate_requests(request_count, note_size=note_size, seed=seed)
+    json_codec.use_codec(config.json_codec)
+    METRICS.reset()
+    timer = StageTimer()
+    completions = _Completions()
+    failed: Dict[str, str] = {}
+
+    with mock_aws(), tempfile.TemporaryDirectory() as work_dir:
+        config = _setup_backends(config, requests, work_dir)
+        clients = ClientFactory.from_config(config)
+        source = create_request_source(config, clients=clients)
+        processor = Wiget_Processor(config, clients)
+
+        # time the bulk deletes as their own stage
+        delete_requests = source.delete_requests
+        def timed_delete_requests(keys):
+            start = time.perf_counter()
+            try:
+                return delete_requests(keys)
+            finally:
+                timer.record("delete_batch", time.perf_counter() - start)
+        source.delete_requests = timed_delete_requests
+        acknowledger = RequestAcknowledger(source, batch_size=config.ack_batch_size, max_delay_ms=config.ack_max_delay_ms)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=config.workers) as pool:
+            handled = sum(pool.map(lambda _: _drain(source, processor, acknowledger, timer, completions, failed),
+                                   range(config.workers)))
+        # flush batched writes, then wait until every handled request has been acked
+        processor.close()
+        incomplete = completions.wait(ack_timeout_s)
+        elapsed = time.perf_counter() - start
+        completed = handled - len(incomplete)
+        acknowledger.close()
+
+        close_source = getattr(source, "close", None)
+        if close_source is not None:
+            close_source()
+
+    return {
+        "config": {
+            "requests": request_count,
+            "note_size": note_size,
+            "request_source": config.request_source,
+            "storage_type": config.storage_type,
+            "workers": config.workers,
+            "prefetch_size": config.prefetch_size,
+            "dynamodb_batch_size": config.dynamodb_batch_size,
+            "ack_batch_size": config.ack_batch_size,
+            "json_codec": json_codec.codec().name,
+        },
+        "handled": handled,
+        "completed": completed,
+        # handled requests that were never acked, and requests rejected as undecodable or invalid
+        "incomplete": incomplete,
+        "failed": dict(sorted(failed.items())),
+        "elapsed_s": round(elapsed, 4),
+        "requests_per_sec": round(completed / elapsed, 2) if elapsed else 0.0,
+        "stages": timer.summary(),
+        # finer breakdown from the built-in hooks (list, get, decode, validate, store, ...), histogram estimates
+        "pipeline_stages": {
+            name[len('widget_stage_seconds{stage="'):-2]: summary
+            for name, summary in METRICS.snapshot().items()
+            if name.startswith('widget_stage_seconds') and summary["count"]
+        },
+    }
+
+
+def _time_per_request(fn, payloads: list, iterations: int) -> float:
+    # best of `iterations` passes over the payloads, in microseconds per payload
+    best = float('inf')
+    for _ in range(iterations):
+        start = time.perf_counter()
+        for payload in payloads:
+            fn(payload)
+        best = min(best, time.perf_counter() - start)
+    return round(best / max(1, len(payloads)) * 1e6, 3)
+
+
+def run_codec_benchmark(request_count: int = 500, note_size: int = 300, iterations: int = 20,
+                        seed: int = None) -> Dict[str, Any]:
+    """
+    Times request decoding and widget body encoding with every available JSON codec, against the
+    str-based path (bytes.decode + json.loads, json.dumps + str.encode) the consumer used before.
+    """
+    requests = generate_requests(request_count, note_size=note_size, seed=seed)
+    bodies = [json.dumps(request).encode('utf-8') for request in requests]
+    widgets = [{field: request[field] for field in ("widgetId", "owner", "label", "description", "otherAttributes")}
+               for request in requests]
+
+    results = {"str_path": {
+        "decode_us": _time_per_request(lambda body: json.loads(body.decode('utf-8')), bodies, iterations),
+        "encode_us": _time_per_request(lambda widget: json.dumps(widget).encode('utf-8'), widgets, iterations),
+    }}
+    for name in ('stdlib', 'orjson'):
+        try:
+            codec = json_codec.get_codec(name)
+        except ValueError:
+            continue
+        results[name] = {
+            "decode_us": _time_per_request(codec.loads, bodies, iterations),
+            "encode_us": _time_per_request(codec.dumps, widgets, iterations),
+        }
+    baseline = results["str_path"]
+    for result in results.values():
+        result["decode_speedup"] = round(baseline["decode_us"] / result["decode_us"], 2) if result["decode_us"] else 0.0
+        result["encode_speedup"] = round(baseline["encode_us"] / result["encode_us"], 2) if result["encode_us"] else 0.0
+    return {
+        "config": {"requests": request_count, "note_size": note_size, "iterations": iterations,
+                   "body_bytes": round(sum(map(len, bodies)) / max(1, len(bodies)))},
+        "codecs": results,
+    }
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the consumer pipeline against moto.")
+    parser.add_argument('--requests', type=int, default=500, help="Number of synthetic requests to push through.")
+    parser.add_argument('--note-size', type=int, default=300, help="Length of the `note` attribute in each request.")
+    parser.add_argument('--seed', type=int, default=None, help="Seed for the synthetic requests.")
+    parser.add_argument('--request-source', choices=['s3', 'jsonl', 'directory'], default='s3')
+    parser.add_argument('--storage-type', choices=['s3', 'dynamodb'], default='s3')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--prefetch-size', type=int, default=0)
+    parser.add_argument('--prefetch-low-water', type=int, default=None)
+    parser.add_argument('--dynamodb-batch-size', type=int, default=1)
+    parser.add_argument('--ack-batch-size', type=int, default=1000)
+    parser.add_argument('--json-codec', choices=json_codec.CODECS, default='auto')
+    parser.add_argument('--codec-only', action='store_true', help="Only time the JSON codecs, no pipeline run.")
+    parser.add_argument('--ack-timeout-s', type=float, default=60.0,
+                        help="How long to wait for outstanding acks after the run before reporting them as incomplete.")
+    parser.add_argument('--output', type=str, default=None, help="Write the JSON report here instead of stdout.")
+    args = parser.parse_args(argv)
+
+    config = ConsumerConfig(
+        storage_type=args.storage_type,
+        bucket_2_name=REQUEST_BUCKET,
+        bucket_3_name=WIDGET_BUCKET,
+        dynamodb_table_name=WIDGET_TABLE,
+        region_name=REGION,
+        polling_delay_ms=0,
+        prefetch_size=args.prefetch_size,
+        prefetch_low_water=args.prefetch_low_water,
+        workers=max(1, args.workers),
+        dynamodb_batch_size=args.dynamodb_batch_size,
+        dynamodb_batch_max_latency_ms=50,
+        ack_batch_size=args.ack_batch_size,
+        ack_max_delay_ms=50,
+        request_source=args.request_source,
+        json_codec=args.json_codec
+    )
+    if args.codec_only:
+        report = run_codec_benchmark(args.requests, note_size=args.note_size, seed=args.seed)
+    else:
+        report = run_benchmark(config, args.requests, note_size=args.note_size, seed=args.seed,
+                               ack_timeout_s=args.ack_timeout_s)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
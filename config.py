@@ -13,10 +13,62 @@ class ConsumerConfig(NamedTuple):
     dynamodb_table_name: str
     region_name: str
     polling_delay_ms: int
+    prefetch_size: int = 0
+    prefetch_low_water: int = None
+    workers: int = 1
+    max_in_flight: int = 0
+    max_polling_delay_ms: int = 5000
+    dynamodb_batch_size: int = 1
+    dynamodb_batch_max_latency_ms: int = 200
+    ack_batch_size: int = 1000
+    ack_max_delay_ms: int = 1000
+    dead_letter_bucket: str = None
+    dead_letter_prefix: str = 'dead-letter/'
+    max_attempts: int = 3
+    request_source: str = 's3'
+    request_path: str = None
+    metrics_port: int = 0
+    stats_interval_s: float = 0
+    async_logging: bool = False
+    log_rate_limit: int = 0
+    log_summary_interval_s: float = 10.0
+    shard_lease_table: str = None
+    consumer_id: str = None
+    lease_ttl_s: float = 30
+    lease_heartbeat_s: float = 10
+    shard_prefix_width: int = 1
+    dedup_cache_size: int = 0
+    dedup_ttl_s: float = 3600
+    dedup_cache_path: str = None
+    coalesce_window_ms: int = 0
+    write_buffer_bytes: int = 0
+    write_buffer_spill_path: str = None
+    attribute_format: str = 'list'
+    s3_compression: str = 'none'
+    s3_key_layout: str = 'owner'
+    s3_key_shard_chars: int = 2
+    s3_legacy_reads: bool = False
+    s3_owner_index: bool = False
+    s3_index_backfill: bool = False
+    s3_index_flush_ms: int = 500
+    json_codec: str = 'auto'
+    storage_rate_limit: float = 0
+    storage_max_rate: float = 0
+    storage_max_concurrency: int = 0
+    max_pool_connections: int = 0
+    connect_timeout_s: float = 5
+    read_timeout_s: float = 30
+    retry_mode: str = 'standard'
+    retry_max_attempts: int = 3
+    tcp_keepalive: bool = True
+    endpoint_url: str = None
+    extra_storage_types: tuple = ()
+    sink_policy: str = 'all'
 
-def parse_args() -> ConsumerConfig:
+def parse_args(argv: list = None) -> ConsumerConfig:
     """
     Parses command-line arguments to configure the Consumer program.
+    argv defaults to sys.argv[1:], pass a list to build a config from somewhere else (e.g. an env var).
     """
     parser = argparse.ArgumentParser(
         description="Consumer program to process Widget Requests from S3 Bucket 2.",
@@ -33,6 +85,22 @@ def parse_args() -> ConsumerConfig:
     )
 
     # --- RESOURCE ARGUMENTS ---
+    parser.add_argument(
+        '--request-source',
+        type=str,
+        default='s3',
+        choices=['s3', 'jsonl', 'directory'],
+        help="Where to read Widget Requests from: 's3' (Bucket 2), a 'jsonl' file or a local 'directory'.\n"
+             "The local sources replay captured traffic without AWS."
+    )
+
+    parser.add_argument(
+        '--request-path',
+        type=str,
+        default=None,
+        help="Path of the JSONL file or directory. Required if --request-source is 'jsonl' or 'directory'."
+    )
+
     parser.add_argument(
         '--bucket-2-name',
         type=str,
@@ -46,7 +114,7 @@ def parse_args() -> ConsumerConfig:
         type=str,
         required=False,
         default='jaden-hw6-widgets',
-        help="Name of the S3 bucket for storing created Widgets (Bucket 3). Required if --storage-type is 's3'."
+        help="Name of the S3 bucket for storing created Widgets (Bucket 3). Required when storing to 's3' (--storage-type or --also-store-to)."
     )
 
     parser.add_argument(
@@ -54,7 +122,93 @@ def parse_args() -> ConsumerConfig:
         type=str,
         required=False,
         default='jaden-hw6-widgets', 
-        help="Name of the DynamoDB table for storing created Widgets. Required if --storage-type is 'dynamodb'."
+        help="Name of the DynamoDB table for storing created Widgets. Required when storing to 'dynamodb' (--storage-type or --also-store-to)."
+    )
+
+    parser.add_argument(
+        '--dead-letter-bucket',
+        type=str,
+        default=None,
+        help="Bucket that malformed or repeatedly failing requests are moved to. Defaults to Bucket 2."
+    )
+
+    parser.add_argument(
+        '--dead-letter-prefix',
+        type=str,
+        default='dead-letter/',
+        help="Key prefix for quarantined requests. Keys under it are never picked up as requests."
+    )
+
+    parser.add_argument(
+        '--max-attempts',
+        type=int,
+        default=3,
+        help="Number of failed processing attempts before a request is quarantined."
+    )
+
+    parser.add_argument(
+        '--ack-batch-size',
+        type=int,
+        default=1000,
+        help="Delete processed requests from Bucket 2 with one DeleteObjects call once this many are waiting (max 1000)."
+    )
+
+    parser.add_argument(
+        '--ack-max-delay-ms',
+        type=int,
+        default=1000,
+        help="Longest a processed request may wait before its deletion is flushed."
+    )
+
+    parser.add_argument(
+        '--dynamodb-batch-size',
+        type=int,
+        default=1,
+        help="Group DynamoDB writes into BatchWriteItem calls of up to this many widgets (max 25). 1 uses one put_item per widget."
+    )
+
+    parser.add_argument(
+        '--dynamodb-batch-max-latency-ms',
+        type=int,
+        default=200,
+        help="Longest a widget may wait in a partial DynamoDB batch before it is flushed."
+    )
+
+    parser.add_argument(
+        '--shard-lease-table',
+        type=str,
+        default=None,
+        help="DynamoDB table (partition key 'leaseId') used to split the request key space between consumers.\n"
+             "Enables sharded mode, each consumer only lists the key prefixes it holds a lease on."
+    )
+
+    parser.add_argument(
+        '--consumer-id',
+        type=str,
+        default=None,
+        help="Unique id of this consumer in sharded mode. Defaults to <hostname>-<pid>."
+    )
+
+    parser.add_argument(
+        '--lease-ttl-s',
+        type=float,
+        default=30,
+        help="How long a shard lease lasts without renewal. A dead consumer's shards move after at most this long."
+    )
+
+    parser.add_argument(
+        '--lease-heartbeat-s',
+        type=float,
+        default=10,
+        help="How often shard leases are renewed and rebalanced. Must be well below --lease-ttl-s."
+    )
+
+    parser.add_argument(
+        '--shard-prefix-width',
+        type=int,
+        default=1,
+        help="Hex characters of the request key that pick its shard. 1 gives 16 shards, 2 gives 256 for larger fleets.\n"
+             "Keys without such a prefix go to one extra catch-all shard."
     )
 
     # --- OPTIONAL/ENVIRONMENT ARGUMENTS ---
@@ -70,17 +224,378 @@ def parse_args() -> ConsumerConfig:
         '--polling-delay-ms',
         type=int,
         default=100,
-        help="Polling delay in milliseconds when no request is available."
+        help="Polling delay in milliseconds when no request is available. Doubles on every empty poll up to --max-polling-delay-ms."
+    )
+
+    parser.add_argument(
+        '--max-polling-delay-ms',
+        type=int,
+        default=5000,
+        help="Ceiling in milliseconds for the polling backoff while the request bucket stays empty."
+    )
+
+    parser.add_argument(
+        '--prefetch-size',
+        type=int,
+        default=0,
+        help="Number of request keys to list per LIST call and buffer locally (max 1000). 0 lists one key per request."
+    )
+
+    parser.add_argument(
+        '--prefetch-low-water',
+        type=int,
+        default=None,
+        help="Refill the prefetch buffer once it holds this many keys or fewer. Defaults to a quarter of --prefetch-size."
+    )
+
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help="Number of worker threads retrieving and processing requests concurrently."
+    )
+
+    parser.add_argument(
+        '--max-in-flight',
+        type=int,
+        default=0,
+        help="Maximum number of requests being handled at once across all workers. 0 means one per worker."
+    )
+
+    parser.add_argument(
+        '--metrics-port',
+        type=int,
+        default=0,
+        help="Serve Prometheus metrics on http://127.0.0.1:<port>/metrics. 0 disables the endpoint."
+    )
+
+    parser.add_argument(
+        '--stats-interval-s',
+        type=float,
+        default=0,
+        help="Log a snapshot of all metrics every this many seconds. 0 disables the periodic dump."
+    )
+
+    parser.add_argument(
+        '--async-logging',
+        action='store_true',
+        help="Format and write log records on a background thread instead of in the hot loop."
+    )
+
+    parser.add_argument(
+        '--log-rate-limit',
+        type=int,
+        default=0,
+        help="Max INFO lines per message per interval (e.g. 'Found and attempting to retrieve request').\n"
+             "Suppressed lines are summarized once per interval. 0 logs everything."
+    )
+
+    parser.add_argument(
+        '--log-summary-interval-s',
+        type=float,
+        default=10.0,
+        help="Length of a log rate limiting interval in seconds."
+    )
+
+    parser.add_argument(
+        '--dedup-cache-size',
+        type=int,
+        default=0,
+        help="Remember this many completed requestIds and ack repeats without writing them again\n"
+             "(roughly 150 bytes each). 0 disables the idempotency cache."
+    )
+
+    parser.add_argument(
+        '--dedup-ttl-s',
+        type=float,
+        default=3600,
+        help="Forget completed requestIds after this many seconds. 0 keeps them until they are evicted."
+    )
+
+    parser.add_argument(
+        '--dedup-cache-path',
+        type=str,
+        default=None,
+        help="Journal file that keeps the idempotency cache across restarts. In memory only if omitted."
+    )
+
+    parser.add_argument(
+        '--coalesce-window-ms',
+        type=int,
+        default=0,
+        help="Hold requests for the same widgetId this long and fold them into one write\n"
+             "(e.g. create + update + update -> one create). 0 writes every request as it comes."
+    )
+
+    parser.add_argument(
+        '--write-buffer-bytes',
+        type=int,
+        default=0,
+        help="Hand writes to a write-behind buffer holding up to this many bytes of requests in memory,\n"
+             "so retrieval keeps going while storage is slow. 0 writes from the worker threads."
+    )
+
+    parser.add_argument(
+        '--write-buffer-spill-path',
+        type=str,
+        default=None,
+        help="File the write-behind buffer spills to once it is full, replayed on startup.\n"
+             "Without it a full buffer makes the workers wait."
+    )
+
+    parser.add_argument(
+        '--attribute-format',
+        type=str,
+        default='list',
+        choices=['list', 'map'],
+        help="How stored widgets keep otherAttributes: 'list' of {name, value} as in the request,\n"
+             "or a compact 'map' of name -> value (smaller items, fewer DynamoDB write units)."
+    )
+
+    parser.add_argument(
+        '--s3-compression',
+        type=str,
+        default='none',
+        choices=['none', 'gzip', 'zstd'],
+        help="Compress widget bodies stored in Bucket 3, 'zstd' needs the zstandard package."
+    )
+
+    parser.add_argument(
+        '--s3-key-layout',
+        type=str,
+        default='owner',
+        choices=['owner', 'hashed'],
+        help="Key layout in Bucket 3: 'owner' is widgets/{owner}/{widgetId}, 'hashed' puts a short hash of\n"
+             "the widgetId in front of the owner (widgets/{shard}/{owner}/{widgetId}) to spread busy owners\n"
+             "over many prefixes."
+    )
+
+    parser.add_argument(
+        '--s3-key-shard-chars',
+        type=int,
+        default=2,
+        help="Hex characters in the hashed layout's shard, 2 gives 256 prefixes."
+    )
+
+    parser.add_argument(
+        '--s3-legacy-reads',
+        action='store_true',
+        help="While migrating to --s3-key-layout hashed: also read widgets from their 'owner' layout keys,\n"
+             "move them on update and remove old copies on create and delete."
+    )
+
+    parser.add_argument(
+        '--s3-owner-index',
+        action='store_true',
+        help="Keep a manifest of each owner's widgetIds in Bucket 3 (widget-index/{owner}.json)\n"
+             "so one owner's widgets can be found without listing every shard. A new owner starts with an\n"
+             "empty manifest, see --s3-index-backfill for turning it on over existing widgets."
+    )
+
+    parser.add_argument(
+        '--s3-index-backfill',
+        action='store_true',
+        help="Migration step for --s3-owner-index over widgets that are already stored: an owner without a\n"
+             "manifest is listed (every shard with the hashed layout) once and the manifest starts from that.\n"
+             "Turn it off once every owner has a manifest."
+    )
+
+    parser.add_argument(
+        '--s3-index-flush-ms',
+        type=int,
+        default=500,
+        help="How often owner index changes are merged into the manifests."
+    )
+
+    parser.add_argument(
+        '--json-codec',
+        type=str,
+        default='auto',
+        choices=['auto', 'orjson', 'stdlib'],
+        help="JSON library for requests and widget bodies. 'auto' uses orjson when it is installed."
+    )
+
+    parser.add_argument(
+        '--storage-rate-limit',
+        type=float,
+        default=0,
+        help="Starting writes per second for the storage backend, e.g. the table's provisioned WCU.\n"
+             "The rate and concurrency then adapt (AIMD) to throttling and latency. 0 disables client-side limiting."
+    )
+
+    parser.add_argument(
+        '--storage-max-rate',
+        type=float,
+        default=0,
+        help="Ceiling for the adaptive storage rate. 0 means twice --storage-rate-limit."
+    )
+
+    parser.add_argument(
+        '--storage-max-concurrency',
+        type=int,
+        default=0,
+        help="Ceiling for storage calls in flight. 0 means one per worker."
+    )
+
+    parser.add_argument(
+        '--also-store-to',
+        type=str,
+        nargs='+',
+        default=[],
+        choices=['s3', 'dynamodb'],
+        help="Write every widget to these storage backends as well, in parallel with --storage-type\n"
+             "(e.g. '--storage-type dynamodb --also-store-to s3' while migrating)."
+    )
+
+    parser.add_argument(
+        '--sink-policy',
+        type=str,
+        default='all',
+        choices=['all', 'quorum', 'primary'],
+        help="When a request counts as stored with --also-store-to: 'all' sinks wrote it, a 'quorum' of them did,\n"
+             "or the 'primary' (--storage-type) did and the others are written in the background."
+    )
+
+    # --- AWS CLIENT ARGUMENTS ---
+    parser.add_argument(
+        '--max-pool-connections',
+        type=int,
+        default=0,
+        help="HTTP connections kept per AWS client (all components share one client per service).\n"
+             "0 sizes the pool from --workers."
+    )
+
+    parser.add_argument(
+        '--connect-timeout-s',
+        type=float,
+        default=5,
+        help="Timeout for opening a connection to AWS."
+    )
+
+    parser.add_argument(
+        '--read-timeout-s',
+        type=float,
+        default=30,
+        help="Timeout for reading an AWS response."
+    )
+
+    parser.add_argument(
+        '--retry-mode',
+        type=str,
+        default='standard',
+        choices=['legacy', 'standard', 'adaptive'],
+        help="botocore retry mode for every AWS client."
+    )
+
+    parser.add_argument(
+        '--retry-max-attempts',
+        type=int,
+        default=3,
+        help="Attempts per AWS call including the first one."
+    )
+
+    parser.add_argument(
+        '--no-tcp-keepalive',
+        dest='tcp_keepalive',
+        action='store_false',
+        help="Don't turn on TCP keepalive for AWS connections."
+    )
+
+    parser.add_argument(
+        '--endpoint-url',
+        type=str,
+        default=None,
+        help="Send every AWS call to this endpoint instead, e.g. a local moto server or LocalStack."
     )
 
     # Check for conditional requirements
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     
-    if args.storage_type == 's3' and not args.bucket_3_name:
-        parser.error("--bucket-3-name is required when --storage-type is 's3'.")
+    storage_types = [args.storage_type] + args.also_store_to
+    if 's3' in storage_types and not args.bucket_3_name:
+        parser.error("--bucket-3-name is required when storing to 's3' (--storage-type or --also-store-to).")
         
-    if args.storage_type == 'dynamodb' and not args.dynamodb_table_name:
-        parser.error("--dynamodb-table-name is required when --storage-type is 'dynamodb'.")
+    if 'dynamodb' in storage_types and not args.dynamodb_table_name:
+        parser.error("--dynamodb-table-name is required when storing to 'dynamodb' (--storage-type or --also-store-to).")
+
+    if len(set(storage_types)) != len(storage_types):
+        parser.error("--also-store-to can't repeat a storage backend.")
+
+    if not 0 <= args.prefetch_size <= 1000:
+        parser.error("--prefetch-size must be between 0 and 1000.")
+
+    if args.prefetch_low_water is not None and args.prefetch_size and not 0 <= args.prefetch_low_water < args.prefetch_size:
+        # a low-water mark at or above the buffer size would LIST on every request
+        parser.error("--prefetch-low-water must be at least 0 and below --prefetch-size.")
+
+    if args.shard_lease_table and args.lease_heartbeat_s >= args.lease_ttl_s:
+        parser.error("--lease-heartbeat-s must be shorter than --lease-ttl-s.")
+
+    if not 1 <= args.shard_prefix_width <= 3:
+        parser.error("--shard-prefix-width must be between 1 and 3.")
+
+    if args.shard_lease_table and args.request_source != 's3':
+        parser.error("--shard-lease-table only applies to --request-source s3.")
+
+    if args.request_source != 's3' and not args.request_path:
+        parser.error("--request-path is required when --request-source is 'jsonl' or 'directory'.")
+
+    if (args.dead_letter_bucket in (None, args.bucket_2_name)) and not args.dead_letter_prefix:
+        parser.error("--dead-letter-prefix can't be empty when quarantining into Bucket 2.")
+
+    if not 1 <= args.ack_batch_size <= 1000:
+        parser.error("--ack-batch-size must be between 1 and 1000.")
+
+    if not 1 <= args.dynamodb_batch_size <= 25:
+        parser.error("--dynamodb-batch-size must be between 1 and 25.")
+
+    if args.polling_delay_ms < 0 or args.max_polling_delay_ms < args.polling_delay_ms:
+        parser.error("--max-polling-delay-ms must be at least --polling-delay-ms (and both non-negative).")
+
+    if args.workers < 1:
+        parser.error("--workers must be at least 1.")
+
+    if args.dedup_cache_size < 0 or args.dedup_ttl_s < 0:
+        parser.error("--dedup-cache-size and --dedup-ttl-s can't be negative.")
+
+    if args.s3_compression == 'zstd':
+        try:
+            import zstandard  # noqa: F401
+        except ImportError:
+            parser.error("--s3-compression zstd needs the zstandard package (pip install zstandard).")
+
+    if not 1 <= args.s3_key_shard_chars <= 4:
+        parser.error("--s3-key-shard-chars must be between 1 and 4.")
+
+    if args.s3_legacy_reads and args.s3_key_layout == 'owner':
+        parser.error("--s3-legacy-reads only applies with --s3-key-layout hashed.")
+
+    if args.s3_index_flush_ms < 1:
+        parser.error("--s3-index-flush-ms must be at least 1.")
+
+    if args.s3_index_backfill and not args.s3_owner_index:
+        parser.error("--s3-index-backfill only applies with --s3-owner-index.")
+
+    if args.json_codec == 'orjson':
+        try:
+            import orjson  # noqa: F401
+        except ImportError:
+            parser.error("--json-codec orjson needs the orjson package (pip install orjson).")
+
+    if args.storage_rate_limit < 0 or args.storage_max_rate < 0 or args.storage_max_concurrency < 0:
+        parser.error("--storage-rate-limit, --storage-max-rate and --storage-max-concurrency can't be negative.")
+
+    if args.max_pool_connections < 0 or args.retry_max_attempts < 1:
+        parser.error("--max-pool-connections can't be negative and --retry-max-attempts must be at least 1.")
+
+    if args.write_buffer_bytes < 0:
+        parser.error("--write-buffer-bytes can't be negative.")
+
+    if args.write_buffer_spill_path and not args.write_buffer_bytes:
+        parser.error("--write-buffer-spill-path needs --write-buffer-bytes.")
+
+    if args.coalesce_window_ms < 0:
+        parser.error("--coalesce-window-ms can't be negative.")
 
     return ConsumerConfig(
         storage_type=args.storage_type.lower(),
@@ -88,7 +603,58 @@ def parse_args() -> ConsumerConfig:
         bucket_3_name=args.bucket_3_name,
         dynamodb_table_name=args.dynamodb_table_name,
         region_name=args.region_name,
-        polling_delay_ms=args.polling_delay_ms
+        polling_delay_ms=args.polling_delay_ms,
+        prefetch_size=args.prefetch_size,
+        prefetch_low_water=args.prefetch_low_water,
+        workers=args.workers,
+        max_in_flight=args.max_in_flight,
+        max_polling_delay_ms=args.max_polling_delay_ms,
+        dynamodb_batch_size=args.dynamodb_batch_size,
+        dynamodb_batch_max_latency_ms=args.dynamodb_batch_max_latency_ms,
+        ack_batch_size=args.ack_batch_size,
+        ack_max_delay_ms=args.ack_max_delay_ms,
+        dead_letter_bucket=args.dead_letter_bucket,
+        dead_letter_prefix=args.dead_letter_prefix,
+        max_attempts=args.max_attempts,
+        request_source=args.request_source,
+        request_path=args.request_path,
+        metrics_port=args.metrics_port,
+        stats_interval_s=args.stats_interval_s,
+        async_logging=args.async_logging,
+        log_rate_limit=args.log_rate_limit,
+        log_summary_interval_s=args.log_summary_interval_s,
+        shard_lease_table=args.shard_lease_table,
+        consumer_id=args.consumer_id,
+        lease_ttl_s=args.lease_ttl_s,
+        lease_heartbeat_s=args.lease_heartbeat_s,
+        shard_prefix_width=args.shard_prefix_width,
+        dedup_cache_size=args.dedup_cache_size,
+        dedup_ttl_s=args.dedup_ttl_s,
+        dedup_cache_path=args.dedup_cache_path,
+        coalesce_window_ms=args.coalesce_window_ms,
+        write_buffer_bytes=args.write_buffer_bytes,
+        write_buffer_spill_path=args.write_buffer_spill_path,
+        attribute_format=args.attribute_format,
+        s3_compression=args.s3_compression,
+        s3_key_layout=args.s3_key_layout,
+        s3_key_shard_chars=args.s3_key_shard_chars,
+        s3_legacy_reads=args.s3_legacy_reads,
+        s3_owner_index=args.s3_owner_index,
+        s3_index_backfill=args.s3_index_backfill,
+        s3_index_flush_ms=args.s3_index_flush_ms,
+        json_codec=args.json_codec,
+        storage_rate_limit=args.storage_rate_limit,
+        storage_max_rate=args.storage_max_rate,
+        storage_max_concurrency=args.storage_max_concurrency,
+        max_pool_connections=args.max_pool_connections,
+        connect_timeout_s=args.connect_timeout_s,
+        read_timeout_s=args.read_timeout_s,
+        retry_mode=args.retry_mode,
+        retry_max_attempts=args.retry_max_attempts,
+        tcp_keepalive=args.tcp_keepalive,
+        endpoint_url=args.endpoint_url,
+        extra_storage_types=tuple(args.also_store_to),
+        sink_policy=args.sink_policy
     )
 
 if __name__ == '__main__':
@@ -1,65 +1,280 @@
-import boto3
 import logging
+import signal
+import threading
 import time
-import os
-from datetime import datetime
+import random
+from concurrent.futures import ThreadPoolExecutor
 from config import parse_args
-from get_widget import  S3RequestRetriever
-from widget_processor import Wiget_Processor
-
-# --- Logging Setup ---
-log_dir = "logs"
-os.makedirs(log_dir, exist_ok=True)
-log_file_path = os.path.join(log_dir, "consumer.log")
-
-# Configure the root logger
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler(log_file_path)
-    ]
-)
+from get_widget import  RequestAcknowledger, RequestDecodeError
+from request_sources import create_request_source
+from widget_processor import Wiget_Processor, InvalidRequestError
+from polling import PollScheduler
+from quarantine import RequestQuarantine
+from metrics import METRICS, start_metrics_server, StatsDumper
+from logging_setup import configure_logging
+from sharding import ShardLeaseManager, shard_prefixes
+from throttling import is_throttle_error
+from aws_clients import ClientFactory
+import json_codec
+
+# longest the workers pause after a storage backend throttled a write
+THROTTLE_BACKOFF_S = 1.0
 
 logger = logging.getLogger(__name__)
 
 
-def init_consumer():
-    config = parse_args()
-    wiget_retriver = S3RequestRetriever(bucket_name=config.bucket_2_name, region_name=config.region_name)
-    widget_processor = Wiget_Processor(config)
+class ThrottleBackoff:
+    """
+    Pauses the workers for a random moment up to max_backoff_s after any write was throttled,
+    whether it failed in process() or later on the coalescer's thread.
+    Workers wait before they take an in-flight slot, so a pause never holds one.
+    """
+    def __init__(self, max_backoff_s: float = THROTTLE_BACKOFF_S):
+        self.max_backoff_s = max_backoff_s
+        self._until = 0.0
+        self._lock = threading.Lock()
+
+    def throttled(self) -> None:
+        with self._lock:
+            self._until = max(self._until, time.monotonic() + random.uniform(0, self.max_backoff_s))
+
+    def wait(self, stop_event: threading.Event) -> None:
+        with self._lock:
+            remaining = self._until - time.monotonic()
+        if remaining > 0:
+            stop_event.wait(remaining)
+
+
+def init_consumer(config=None, lease_manager: ShardLeaseManager = None, clients: ClientFactory = None):
+    if config is None:
+        config = parse_args()
+    json_codec.use_codec(config.json_codec)
+    # one session and one pooled client per AWS service for the retriever and the storage strategy
+    if clients is None:
+        clients = ClientFactory.from_config(config)
+    # S3 (Bucket 2) by default, a local JSONL file or directory for replays
+    # in sharded mode only the slices of the key space we hold a lease on are listed
+    wiget_retriver = create_request_source(
+        config,
+        prefixes_provider=lease_manager.owned_prefixes if lease_manager is not None else None,
+        clients=clients
+    )
+    widget_processor = Wiget_Processor(config, clients)
 
     return wiget_retriver, widget_processor
 
 
+def _failed_write(wiget_retriver, request_key: str, quarantine: RequestQuarantine = None,
+                  backoff: ThrottleBackoff = None):
+    # a write that failed after process() returned, the request is handled like one that failed in process()
+    def on_failure(error: Exception) -> None:
+        if is_throttle_error(error):
+            wiget_retriver.release_request(request_key)
+            if backoff is not None:
+                backoff.throttled()
+        elif quarantine is not None:
+            quarantine.record_failure(request_key, str(error))
+        else:
+            wiget_retriver.release_request(request_key)
+    return on_failure
 
 
-def main():
-    wiget_retriver, widget_processor = init_consumer()
+def handle_next_request(wiget_retriver, widget_processor, ack_request, quarantine: RequestQuarantine = None,
+                        backoff: ThrottleBackoff = None) -> bool:
+    """
+    Retrieves and processes one request.
+    Poison requests are handed to the quarantine (when there is one) instead of blocking the queue.
+    Throttled writes are released without counting an attempt and tell the backoff to pause the workers.
 
-    #main loop
-    while(loopContinue := True):
-        # slow down the loop
-        time.sleep(1)
-
-        # grab request
-        request = wiget_retriver.get_and_delete_next_request()
-        if request is None:
-            logger.info("No new requests found. Waiting...")
-            continue
+    Returns:
+        bool: False if there was no request to handle, or if the request went straight back into the queue
+        (a failed attempt, or a quarantine that failed). It would be the next one handed out, so the worker
+        backs off instead of spinning on it.
+    """
+    try:
+        # grab request, it stays in the bucket until the processor acks it
+        request = wiget_retriver.get_next_request()
+    except RequestDecodeError as e:
+        if quarantine is not None:
+            return quarantine.reject_undecodable(e.request_key, e.reason)
+        wiget_retriver.release_request(e.request_key)
+        return False
+    if request is None:
+        return False
 
+    request_key, widget_request = request
+    try:
         #process request
-        widget_processor.process(request)
+        widget_processor.process(
+            widget_request,
+            ack=lambda key=request_key: ack_request(key),
+            on_failure=_failed_write(wiget_retriver, request_key, quarantine, backoff)
+        )
+    except InvalidRequestError as e:
+        if quarantine is not None:
+            return quarantine.reject_invalid(request_key, str(e))
+        wiget_retriver.release_request(request_key)
+        return False
+    except Exception as e:
+        if is_throttle_error(e):
+            # the backend is overloaded, not the request: retry it later without counting an attempt
+            logger.warning(f"Worker {threading.current_thread().name} was throttled handling request {request_key}: {e}")
+            wiget_retriver.release_request(request_key)
+            if backoff is not None:
+                backoff.throttled()
+            return True
+        logger.error(f"Worker {threading.current_thread().name} failed to handle request {request_key}: {e}")
+        if quarantine is not None:
+            return quarantine.record_failure(request_key, str(e))
+        # leave it in the bucket and let it be picked up again
+        wiget_retriver.release_request(request_key)
+        return False
+    return True
 
-if __name__ == "__main__":
-    main()
+
+def run_worker(wiget_retriver, widget_processor, stop_event: threading.Event, in_flight: threading.Semaphore,
+               scheduler: PollScheduler, acknowledger: RequestAcknowledger = None,
+               quarantine: RequestQuarantine = None, backoff: ThrottleBackoff = None):
+    """
+    Worker loop: grab a request, process it, repeat until stop_event is set.
+    There is no delay between polls while requests keep coming, the scheduler backs off once the bucket is empty.
+    A request counts as in flight from the moment we start retrieving it until it is handed to the storage
+    strategy, so stopping only ever waits on the request the worker is currently holding.
+    Requests are deleted from Bucket 2 only after they have been stored, in bulk when an acknowledger is given.
+    """
+    ack_request = acknowledger.ack if acknowledger is not None else wiget_retriver.delete_request
+    while not stop_event.is_set():
+        if backoff is not None:
+            # a backend was throttled, give it a moment before taking more work
+            backoff.wait(stop_event)
+        # wait for a free in-flight slot, checking for shutdown every so often
+        if not in_flight.acquire(timeout=0.5):
+            continue
+        found_request = False
+        try:
+            found_request = handle_next_request(wiget_retriver, widget_processor, ack_request, quarantine, backoff)
+        except Exception as e:
+            logger.error(f"Worker {threading.current_thread().name} failed to retrieve a request: {e}")
+        finally:
+            in_flight.release()
+
+        if not found_request:
+            # slow down the loop while the bucket is empty (or its next request just failed)
+            delay = scheduler.next_delay()
+            logger.info("No new requests found. Waiting %.2fs...", delay)
+            stop_event.wait(delay)
+        else:
+            scheduler.record_request()
 
 
+def run_consumer(wiget_retriver, widget_processor, workers: int, max_in_flight: int, stop_event: threading.Event,
+                 scheduler: PollScheduler = None, acknowledger: RequestAcknowledger = None,
+                 quarantine: RequestQuarantine = None):
+    """
+    Runs `workers` worker loops on a thread pool and blocks until they have all finished.
+    `scheduler` holds the polling settings, every worker backs off on its own copy of it.
+    """
+    in_flight = threading.BoundedSemaphore(max(1, max_in_flight))
+    if scheduler is None:
+        scheduler = PollScheduler()
+    backoff = ThrottleBackoff()
+    if workers <= 1:
+        run_worker(wiget_retriver, widget_processor, stop_event, in_flight, scheduler, acknowledger, quarantine,
+                   backoff)
+        return
 
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="consumer-worker") as pool:
+        futures = [
+            pool.submit(run_worker, wiget_retriver, widget_processor, stop_event, in_flight, scheduler.for_worker(),
+                        acknowledger, quarantine, backoff)
+            for _ in range(workers)
+        ]
+        # waiting on the futures here (instead of inside the with block exit) keeps the
+        # main thread free to receive signals
+        while not all(f.done() for f in futures):
+            stop_event.wait(0.5)
+        for f in futures:
+            f.result()
 
 
+def install_signal_handlers(stop_event: threading.Event):
+    """
+    SIGINT/SIGTERM ask the workers to stop, they finish whatever request they are holding first.
+    """
+    def _handle_signal(signum, frame):
+        logger.info(f"Received signal {signum}, finishing in-flight requests and shutting down...")
+        stop_event.set()
+
+    signal.signal(signal.SIGINT, _handle_signal)
+    signal.signal(signal.SIGTERM, _handle_signal)
+
+
+def main():
+    config = parse_args()
+    # --- Logging Setup ---
+    logging_handle = configure_logging(
+        log_dir="logs",
+        async_logging=config.async_logging,
+        rate_limit=config.log_rate_limit,
+        summary_interval_s=config.log_summary_interval_s
+    )
+    clients = ClientFactory.from_config(config)
+    lease_manager = None
+    if config.shard_lease_table:
+        lease_manager = ShardLeaseManager(
+            config.shard_lease_table,
+            consumer_id=config.consumer_id,
+            region_name=config.region_name,
+            lease_ttl_s=config.lease_ttl_s,
+            heartbeat_s=config.lease_heartbeat_s,
+            prefixes=shard_prefixes(config.shard_prefix_width),
+            clients=clients
+        )
+        lease_manager.start()
+        logger.info(f"Sharded mode: consumer {lease_manager.consumer_id} owns {lease_manager.owned_prefixes()}")
+
+    wiget_retriver, widget_processor = init_consumer(config, lease_manager, clients)
+
+    acknowledger = RequestAcknowledger(
+        wiget_retriver,
+        batch_size=config.ack_batch_size,
+        max_delay_ms=config.ack_max_delay_ms
+    )
+
+    quarantine = RequestQuarantine(wiget_retriver, max_attempts=config.max_attempts)
+
+    metrics_server = start_metrics_server(config.metrics_port) if config.metrics_port else None
+    stats_dumper = StatsDumper(config.stats_interval_s) if config.stats_interval_s > 0 else None
+
+    stop_event = threading.Event()
+    install_signal_handlers(stop_event)
+
+    #main loop
+    run_consumer(
+        wiget_retriver,
+        widget_processor,
+        workers=config.workers,
+        max_in_flight=config.max_in_flight or config.workers,
+        stop_event=stop_event,
+        scheduler=PollScheduler(config.polling_delay_ms, config.max_polling_delay_ms),
+        acknowledger=acknowledger,
+        quarantine=quarantine
+    )
+    # write out anything still sitting in a batch, then delete everything that got stored
+    widget_processor.close()
+    acknowledger.close()
+    close_source = getattr(wiget_retriver, "close", None)
+    if close_source is not None:
+        close_source()
+    if lease_manager is not None:
+        lease_manager.close()
+    if stats_dumper is not None:
+        stats_dumper.close()
+    if metrics_server is not None:
+        metrics_server.shutdown()
+    logger.info(f"Consumer stopped. Quarantine stats: {quarantine.stats()}, final stats: {METRICS.snapshot()}")
+    # drain whatever is still queued for the log files
+    logging_handle.close()
 
 if __name__ == "__main__":
     main()
-
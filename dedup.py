@@ -0,0 +1,167 @@
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+# Duplicate suppression.
+# Requests are delivered at least once: a crash before the delete, a released claim or a redelivered
+# event notification all hand the same requestId to the processor again. The cache remembers the
+# requestIds that were completed recently so a repeat is acked without touching S3/DynamoDB.
+# With a path the completed ids are also appended to a journal file that is replayed (and compacted)
+# on startup, so the cache survives restarts. The appends are batched off the hot path: a background
+# thread writes and flushes whatever was added every flush_ms. Nothing is fsynced, a crash can lose the
+# ids of the last batch (which just means one redundant write each).
+
+_HITS = METRICS.counter("widget_dedup_lookups_total", "Idempotency cache lookups, by result.", result="hit")
+_MISSES = METRICS.counter("widget_dedup_lookups_total", "Idempotency cache lookups, by result.", result="miss")
+# registered once for every cache in the process, not rebound by each new one
+_CACHES = weakref.WeakSet()
+_ENTRIES = METRICS.gauge("widget_dedup_entries", "requestIds currently held by the idempotency caches.")
+_ENTRIES.set_function(lambda: sum(len(cache) for cache in list(_CACHES)))
+
+
+class RequestDedupCache:
+    """
+    Bounded LRU of completed requestIds, entries also expire after ttl_s.
+    Memory is bounded by max_entries (roughly 150 bytes per id). Safe to share between worker threads.
+    """
+    def __init__(self, max_entries: int = 100000, ttl_s: float = 3600, path: str = None, flush_ms: int = 200):
+        self.max_entries = max(1, max_entries)
+        self.ttl_s = ttl_s
+        self.path = path
+        self.flush_s = flush_ms / 1000.0
+        # requestId -> wall clock time it completed, oldest first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # (requestId, completed at) added since the last journal write
+        self._pending = []
+        # taken before self._lock when both are needed
+        self._journal_lock = threading.Lock()
+        self._journal = None
+        self._journal_lines = 0
+        self._stop = threading.Event()
+        self._flusher = None
+        if path:
+            self._load()
+            self._flusher = threading.Thread(target=self._flush_loop, name="dedup-journal", daemon=True)
+            self._flusher.start()
+        _CACHES.add(self)
+
+    def _expired(self, completed_at: float, now: float) -> bool:
+        return self.ttl_s > 0 and now - completed_at > self.ttl_s
+
+    def contains(self, request_id: str) -> bool:
+        """True if request_id completed within the TTL. Counts a hit or a miss."""
+        now = time.time()
+        with self._lock:
+            completed_at = self._entries.get(request_id)
+            if completed_at is not None and self._expired(completed_at, now):
+                del self._entries[request_id]
+                completed_at = None
+            if completed_at is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(request_id)
+                self.hits += 1
+        (_MISSES if completed_at is None else _HITS).inc()
+        return completed_at is not None
+
+    def add(self, request_id: str) -> None:
+        """Remembers request_id as completed, evicting the least recently used ids past max_entries."""
+        now = time.time()
+        with self._lock:
+            self._entries.pop(request_id, None)
+            self._entries[request_id] = now
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            if self.path:
+                self._pending.append((request_id, now))
+
+    def flush(self) -> None:
+        """Appends the ids added since the last flush to the journal."""
+        with self._journal_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+            if not pending or self._journal is None:
+                return
+            self._journal.write("".join(json.dumps({"id": request_id, "at": completed_at}) + "\n"
+                                        for request_id, completed_at in pending))
+            self._journal.flush()
+            self._journal_lines += len(pending)
+            # evicted and repeated ids pile up in the journal, rewrite it once it is twice the cache
+            if self._journal_lines > 2 * self.max_entries:
+                with self._lock:
+                    entries = list(self._entries.items())
+                self._compact(entries)
+
+    def _flush_loop(self) -> None:
+        while not self._stop.wait(self.flush_s):
+            try:
+                self.flush()
+            except OSError as e:
+                logger.error(f"Failed to write the dedup journal {self.path}: {e}")
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+    def _load(self) -> None:
+        """Replays the journal, drops expired ids and rewrites it with only what was kept."""
+        now = time.time()
+        if not os.path.exists(self.path):
+            self._compact()
+            return
+        with open(self.path, encoding='utf-8') as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                    request_id, completed_at = entry["id"], float(entry["at"])
+                except (ValueError, KeyError, TypeError):
+                    # a torn last line from a crash, skip it
+                    continue
+                if self._expired(completed_at, now):
+                    continue
+                self._entries.pop(request_id, None)
+                self._entries[request_id] = completed_at
+                if len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+
+        self._compact()
+        logger.info(f"Loaded {len(self._entries)} completed requestIds from {self.path}")
+
+    def _compact(self, entries: list = None) -> None:
+        """Rewrites the journal with just the cached ids and reopens it for appending."""
+        # caller holds the journal lock (or is __init__)
+        if entries is None:
+            entries = list(self._entries.items())
+        if self._journal is not None:
+            self._journal.close()
+        compacted = f"{self.path}.tmp"
+        with open(compacted, 'w', encoding='utf-8') as journal:
+            for request_id, completed_at in entries:
+                journal.write(json.dumps({"id": request_id, "at": completed_at}) + "\n")
+        os.replace(compacted, self.path)
+        self._journal = open(self.path, 'a', encoding='utf-8')
+        self._journal_lines = len(entries)
+
+    def close(self) -> None:
+        """Writes the last batch of ids and closes the journal."""
+        self._stop.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
+        with self._journal_lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
@@ -0,0 +1,218 @@
+import json
+import logging
+import os
+import queue
+import shlex
+import threading
+from typing import Any, Dict, Iterator, Optional, Tuple
+from urllib.parse import unquote_plus
+from config import ConsumerConfig, parse_args
+from get_widget import S3RequestRetriever, RequestDecodeError
+from widget_processor import Wiget_Processor, InvalidRequestError
+from quarantine import RequestQuarantine
+from throttling import is_throttle_error
+from aws_clients import ClientFactory
+import json_codec
+
+logger = logging.getLogger(__name__)
+
+# Event-driven mode.
+# Instead of listing Bucket 2, the consumer is handed S3 ObjectCreated notifications (straight from S3,
+# or wrapped in SQS/SNS messages) and goes GET -> process -> DELETE for exactly the keys they name.
+# Nothing here touches logging handlers or the filesystem at import, so a Lambda cold start only pays
+# for the imports and the first invocation builds the clients.
+#
+# Lambda: set the handler to `event_handler.handler` and pass the usual consumer flags in the
+# CONSUMER_ARGS environment variable, e.g. "--storage-type dynamodb --dynamodb-table-name widgets".
+
+
+def iter_request_keys(event: Dict[str, Any], bucket_name: str = None,
+                      skip_prefix: str = None) -> Iterator[Tuple[Optional[str], str]]:
+    """
+    Yields (SQS message id or None, request key) for every ObjectCreated record in the event.
+    Records for other buckets, other event types and S3 test events are skipped, as are keys under
+    skip_prefix (the dead-letter copies when they live in the request bucket).
+    """
+    for record in event.get('Records', []):
+        if record.get('eventSource') == 'aws:sqs':
+            message_id = record.get('messageId')
+            try:
+                body = json.loads(record.get('body') or '{}')
+                # S3 -> SNS -> SQS wraps the notification once more
+                if isinstance(body.get('Message'), str):
+                    body = json.loads(body['Message'])
+            except (ValueError, AttributeError) as e:
+                logger.warning(f"Skipping SQS message {message_id}, body is not an S3 notification: {e}")
+                continue
+            s3_records = body.get('Records', []) if isinstance(body, dict) else []
+        else:
+            message_id = None
+            s3_records = [record]
+
+        for s3_record in s3_records:
+            if not s3_record.get('eventName', '').startswith('ObjectCreated'):
+                continue
+            s3 = s3_record.get('s3', {})
+            record_bucket = s3.get('bucket', {}).get('name')
+            if bucket_name and record_bucket != bucket_name:
+                logger.warning(f"Skipping notification for bucket {record_bucket}, expected {bucket_name}")
+                continue
+            key = s3.get('object', {}).get('key')
+            if not key:
+                continue
+            # keys in notifications are URL-encoded, spaces as '+'
+            key = unquote_plus(key)
+            if skip_prefix and key.startswith(skip_prefix):
+                continue
+            yield message_id, key
+
+
+class EventProcessor:
+    """
+    Handles S3 event notifications: every key named in the event is read, processed and deleted, no listing.
+    Keys that can't be decoded or fail validation are quarantined like in polling mode. Keys whose
+    processing failed are released and reported back, the event source has to redeliver them.
+    """
+    def __init__(self, config: ConsumerConfig, retriever: S3RequestRetriever = None,
+                 processor: Wiget_Processor = None):
+        self.bucket_name = config.bucket_2_name
+        # quarantining into Bucket 2 creates objects there too, those must not be picked up as requests
+        self.skip_prefix = (config.dead_letter_prefix
+                            if config.dead_letter_bucket in (None, config.bucket_2_name) else None)
+        json_codec.use_codec(config.json_codec)
+        # only built when there is something left to build, injected parts bring their own clients
+        clients = ClientFactory.from_config(config) if retriever is None or processor is None else None
+        self.retriever = retriever or S3RequestRetriever(
+            bucket_name=config.bucket_2_name,
+            region_name=config.region_name,
+            dead_letter_bucket=config.dead_letter_bucket,
+            dead_letter_prefix=config.dead_letter_prefix,
+            clients=clients
+        )
+        self.processor = processor or Wiget_Processor(config, clients)
+        self.quarantine = RequestQuarantine(self.retriever, max_attempts=config.max_attempts)
+
+    def handle_event(self, event: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Processes every request key in the event.
+
+        Returns:
+            dict: Counts of processed/quarantined/skipped keys, the keys that failed and, for SQS
+            events, the ids of the messages that need to be redelivered.
+        """
+        deleted = set()
+        errors = {}  # key -> error of a write that failed after process() returned
+        submitted = {}  # key -> SQS message id
+        result = {'processed': 0, 'quarantined': 0, 'skipped': 0, 'failed': [], 'failed_message_ids': []}
+
+        def fail(key, message_id):
+            result['failed'].append(key)
+            if message_id is not None and message_id not in result['failed_message_ids']:
+                result['failed_message_ids'].append(message_id)
+
+        for message_id, key in iter_request_keys(event, self.bucket_name, self.skip_prefix):
+            outcome = self._handle_key(key, deleted, errors)
+            if outcome == 'submitted':
+                submitted[key] = message_id
+            elif outcome == 'failed':
+                fail(key, message_id)
+            else:
+                result[outcome] += 1
+
+        # batching strategies only ack once their batch is written, don't return before that
+        try:
+            self.processor.flush()
+        except Exception as e:
+            logger.error(f"Failed to flush stored widgets: {e}")
+        for key, message_id in submitted.items():
+            if key in deleted:
+                result['processed'] += 1
+            elif key in errors and not is_throttle_error(errors[key]):
+                if self.quarantine.record_failure(key, str(errors[key])):
+                    result['quarantined'] += 1
+                else:
+                    fail(key, message_id)
+            else:
+                self.retriever.release_request(key)
+                fail(key, message_id)
+        return result
+
+    def _handle_key(self, request_key: str, deleted: set, errors: dict) -> str:
+        try:
+            request = self.retriever.get_request(request_key)
+        except RequestDecodeError as e:
+            return 'quarantined' if self.quarantine.reject_undecodable(e.request_key, e.reason) else 'failed'
+        except Exception as e:
+            logger.error(f"Failed to retrieve request {request_key}: {e}")
+            return 'failed'
+        if request is None:
+            # already handled (and deleted) or being handled by a concurrent delivery
+            logger.info("Request %s is gone or already in progress, skipping", request_key)
+            return 'skipped'
+
+        def ack(key=request_key):
+            if self.retriever.delete_request(key):
+                deleted.add(key)
+
+        try:
+            self.processor.process(request[1], ack=ack, on_failure=lambda e, key=request_key: errors.setdefault(key, e))
+        except InvalidRequestError as e:
+            return 'quarantined' if self.quarantine.reject_invalid(request_key, str(e)) else 'failed'
+        except Exception as e:
+            logger.error(f"Failed to handle request {request_key}: {e}")
+            if is_throttle_error(e):
+                # not the request's fault, hand it back for redelivery without counting an attempt
+                self.retriever.release_request(request_key)
+                return 'failed'
+            return 'quarantined' if self.quarantine.record_failure(request_key, str(e)) else 'failed'
+        return 'submitted'
+
+    def close(self) -> None:
+        self.processor.close()
+
+
+def run_local_queue(event_queue: queue.Queue, event_processor: EventProcessor, stop_event: threading.Event,
+                    poll_timeout_s: float = 0.5) -> None:
+    """
+    Local stand-in for the Lambda runtime: handles S3 notification events put on event_queue until
+    stop_event is set. Events with failed keys are put back on the queue to be retried.
+    """
+    while not stop_event.is_set():
+        try:
+            event = event_queue.get(timeout=poll_timeout_s)
+        except queue.Empty:
+            continue
+        try:
+            result = event_processor.handle_event(event)
+            if result['failed']:
+                logger.warning(f"{len(result['failed'])} requests failed, requeueing event")
+                event_queue.put(event)
+        except Exception as e:
+            logger.error(f"Failed to handle event: {e}")
+        finally:
+            event_queue.task_done()
+
+
+_event_processor: Optional[EventProcessor] = None
+
+
+def handler(event: Dict[str, Any], context: Any = None) -> Dict[str, Any]:
+    """
+    AWS Lambda entry point. The processor is built on the first invocation and reused while the
+    container stays warm.
+
+    SQS-triggered invocations report failed messages as batchItemFailures (enable ReportBatchItemFailures
+    on the event source mapping), direct S3 invocations raise so Lambda retries the event.
+    """
+    global _event_processor
+    if _event_processor is None:
+        _event_processor = EventProcessor(parse_args(shlex.split(os.environ.get('CONSUMER_ARGS', ''))))
+
+    result = _event_processor.handle_event(event)
+    logger.info("Handled event: %d processed, %d quarantined, %d skipped, %d failed",
+                result['processed'], result['quarantined'], result['skipped'], len(result['failed']))
+    if result['failed_message_ids']:
+        return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in result['failed_message_ids']]}
+    if result['failed']:
+        raise RuntimeError(f"Failed to handle requests: {result['failed']}")
+    return {'batchItemFailures': []}
@@ -1,74 +1,547 @@
-import boto3
-import json
+import json_codec
 import logging
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, List, Optional
+from botocore.exceptions import ClientError
+from aws_clients import ClientFactory
+from metrics import METRICS
+from sharding import OTHER_KEYS, hex_shard
 
 logger = logging.getLogger(__name__)
 
+# metric handles, grabbed once so the hot path doesn't look them up
+_LIST_SECONDS = METRICS.stage("list")
+_GET_SECONDS = METRICS.stage("get")
+_DECODE_SECONDS = METRICS.stage("decode")
+_DELETE_SECONDS = METRICS.stage("delete")
+_QUARANTINE_SECONDS = METRICS.stage("quarantine")
+_EMPTY_POLLS = METRICS.counter("widget_empty_polls_total", "Polls that found no request.")
+_BUFFER_DEPTH = METRICS.gauge("widget_request_buffer_depth", "Request keys waiting in the prefetch buffer.")
+_CLAIMED = METRICS.gauge("widget_requests_claimed", "Requests handed out and not yet deleted or released.")
+
+
+class RequestDecodeError(Exception):
+    """Raised when a request object can't be decoded into a JSON request."""
+    def __init__(self, request_key: str, reason: str):
+        super().__init__(f"{request_key}: {reason}")
+        self.request_key = request_key
+        self.reason = reason
+
+
 class S3RequestRetriever:
     """
     Implements the strategy for retrieving a single Widget Request from S3 (Bucket 2).
     It reads the object with the smallest key, deletes it and returns the JSON payload.
+
+    When prefetch_size is > 0 the retriever lists up to prefetch_size keys per LIST call
+    and keeps them in a local ordered buffer, only listing again once the buffer drops
+    below low_water_mark (a quarter of prefetch_size unless given). Keys are still handed out smallest first.
+
+    Keys handed out by get_next_request are claimed until they are deleted (or released), so
+    the retriever won't hand them out again while they wait for a deferred delete. A claim
+    that is never resolved expires after claim_timeout_s and the request becomes visible again.
+
+    Requests that can't be handled are moved under dead_letter_prefix (in dead_letter_bucket, or
+    Bucket 2 itself by default) by quarantine_request. Keys under that prefix are never listed as requests.
+
+    When prefixes_provider is given (sharded mode, see sharding.ShardLeaseManager) only keys under the
+    prefixes it currently returns are listed, smallest prefix first. sharding.OTHER_KEYS stands for every
+    key that doesn't start with a hex prefix of shard_width characters.
     """
-    def __init__(self, bucket_name: str = 'jaden-hw6-requests', region_name: str = 'us-east-1'):
-        # Initialize the S3 client using the provided region
-        self.s3_client = boto3.client('s3', region_name=region_name)
+    def __init__(self, bucket_name: str = 'jaden-hw6-requests', region_name: str = 'us-east-1',
+                 prefetch_size: int = 0, low_water_mark: int = None, claim_timeout_s: float = 300,
+                 dead_letter_bucket: str = None, dead_letter_prefix: str = 'dead-letter/',
+                 prefixes_provider: Callable[[], List[str]] = None, clients: ClientFactory = None,
+                 shard_width: int = 1):
+        # Initialize the S3 client using the provided region, shared with the rest of the consumer when clients is given.
+        # Callers with a ConsumerConfig pass ClientFactory.from_config(config), the fallback has default pool and timeouts
+        self.s3_client = (clients or ClientFactory(region_name)).client('s3', region_name)
         self.bucket_name = bucket_name
 
-    def get_and_delete_next_request(self) -> dict or None:
+        # prefetch buffer (only used when prefetch_size > 0)
+        self.prefetch_size = min(prefetch_size, 1000)  # S3 caps a LIST page at 1000 keys
+        if low_water_mark is None:
+            low_water_mark = self.prefetch_size // 4
+        # at or above the buffer size every request would trigger a LIST
+        self.low_water_mark = max(0, min(low_water_mark, self.prefetch_size - 1))
+        self._buffer = deque()
+        self._buffered_keys = set()
+        # listing prefix (None lists the whole bucket) -> key to resume after
+        self._cursors: Dict[Optional[str], str] = {}
+        self._lock = threading.Lock()
+        self.prefixes_provider = prefixes_provider
+        self.shard_width = shard_width
+
+        # key -> time it was handed out, for requests that are processed but not deleted yet
+        self.claim_timeout_s = claim_timeout_s
+        self._claimed = {}
+        self._claim_lock = threading.Lock()
+
+        self.dead_letter_bucket = dead_letter_bucket or bucket_name
+        self.dead_letter_prefix = dead_letter_prefix
+
+    def _list_prefixes(self) -> List[Optional[str]]:
+        """The key prefixes to list, [None] for the whole bucket."""
+        if self.prefixes_provider is None:
+            return [None]
+        return sorted(self.prefixes_provider())
+
+    def _list_keys(self, max_keys: int, start_after: str = None, prefix: str = None) -> tuple:
         """
-        Periodically tries to read a single Widget Request from Bucket 2.
+        Lists up to max_keys request keys in key order.
 
-        Basic s3 object getter from stack overlow modded to fit requirements
+        Returns:
+            (keys, is_truncated)
+        """
+        if prefix == OTHER_KEYS:
+            return self._list_other_keys(max_keys, start_after)
+        params = {'Bucket': self.bucket_name, 'MaxKeys': max_keys}
+        if start_after:
+            params['StartAfter'] = start_after
+        if prefix:
+            params['Prefix'] = prefix
+        # quarantined requests live next to the real ones when there is no separate dead-letter bucket
+        skip_prefix = self.dead_letter_prefix if self.dead_letter_bucket == self.bucket_name else None
+
+        while True:
+            with _LIST_SECONDS.time():
+                response = self.s3_client.list_objects_v2(**params)
+            listed = [obj['Key'] for obj in response.get('Contents', [])]
+            is_truncated = response.get('IsTruncated', False)
+            if not skip_prefix:
+                return listed, is_truncated
+
+            keys = [key for key in listed if not key.startswith(skip_prefix)]
+            if keys or not is_truncated:
+                return keys, is_truncated
+            # the whole page was quarantined requests, jump straight past the dead-letter prefix
+            params['StartAfter'] = skip_prefix + chr(0x10FFFF)
+
+    def _list_other_keys(self, max_keys: int, start_after: str = None) -> tuple:
+        """
+        Lists keys of the catch-all slice, the whole bucket minus the hex slices. Instead of paging
+        through a hex slice it runs into, the listing jumps straight past it.
+        """
+        while True:
+            listed, is_truncated = self._list_keys(max_keys, start_after)
+            keys = []
+            for key in listed:
+                shard = hex_shard(key, self.shard_width)
+                if shard is not None:
+                    if keys:
+                        # the caller resumes after the last key, we jump the slice on the next call
+                        return keys, True
+                    start_after = shard + chr(0x10FFFF)
+                    break
+                keys.append(key)
+            else:
+                return keys, is_truncated
+
+    def _in_slices(self, key: str, prefixes: List[Optional[str]]) -> bool:
+        if prefixes == [None]:
+            return True
+        shard = hex_shard(key, self.shard_width)
+        if shard is None:
+            return OTHER_KEYS in prefixes
+        return any(key.startswith(prefix) for prefix in prefixes if prefix != OTHER_KEYS)
+
+    def _is_claimed(self, key: str) -> bool:
+        with self._claim_lock:
+            claimed_at = self._claimed.get(key)
+            if claimed_at is None:
+                return False
+            if time.monotonic() - claimed_at > self.claim_timeout_s:
+                logger.warning(f"Claim on request {key} expired, making it available again")
+                del self._claimed[key]
+                return False
+            return True
+
+    def release_request(self, request_key: str) -> None:
+        """
+        Gives up the claim on a request that could not be handled so it gets retried.
+        """
+        with self._claim_lock:
+            self._claimed.pop(request_key, None)
+            _CLAIMED.set(len(self._claimed))
+
+    def _refill_buffer(self, prefixes: List[Optional[str]]) -> None:
+        """
+        Tops the prefetch buffer back up with one LIST call per prefix, resuming after the last key we listed.
+        Once the listing reaches the end of the bucket (or prefix) the cursor is reset so keys that
+        landed behind it are picked up on the next pass.
+        """
+        for stale in [prefix for prefix in self._cursors if prefix not in prefixes]:
+            del self._cursors[stale]
+        listed = 0
+        for prefix in prefixes:
+            room = self.prefetch_size - len(self._buffer)
+            if room <= 0:
+                break
+            keys, is_truncated = self._list_keys(room, self._cursors.get(prefix), prefix)
+            listed += len(keys)
+            for key in keys:
+                if key not in self._buffered_keys and not self._is_claimed(key):
+                    self._buffer.append(key)
+                    self._buffered_keys.add(key)
+
+            if keys and is_truncated:
+                self._cursors[prefix] = keys[-1]
+            else:
+                # reached the end of the bucket, start from the smallest key next time
+                self._cursors.pop(prefix, None)
+        logger.debug("Prefetched %d request keys, buffer now holds %d", listed, len(self._buffer))
+        _BUFFER_DEPTH.set(len(self._buffer))
+
+    def _next_key(self) -> str or None:
+        """
+        Returns the next request key to try, or None if the bucket is empty.
+        """
+        prefixes = self._list_prefixes()
+        if self.prefetch_size <= 0:
+            with self._claim_lock:
+                # list just past the requests we are still holding on to
+                page_size = min(1 + len(self._claimed), 1000)
+            for prefix in prefixes:
+                start_after = None
+                while True:
+                    keys, is_truncated = self._list_keys(page_size, start_after, prefix)
+                    key = next((key for key in keys if not self._is_claimed(key)), None)
+                    if key is not None:
+                        return key
+                    if not keys or not is_truncated:
+                        break
+                    # the whole page is claimed, page on instead of listing the same keys again
+                    start_after = keys[-1]
+            return None
+
+        with self._lock:
+            if len(self._buffer) <= self.low_water_mark:
+                self._refill_buffer(prefixes)
+                # a wrapped listing can return nothing new while older keys are still buffered,
+                # try once more from the start of the bucket
+                if not self._buffer and self._cursors:
+                    self._refill_buffer(prefixes)
+            while self._buffer:
+                key = self._buffer.popleft()
+                self._buffered_keys.discard(key)
+                _BUFFER_DEPTH.set(len(self._buffer))
+                # drop keys from prefixes we have handed over to another consumer since listing them
+                if self._in_slices(key, prefixes):
+                    return key
+            return None
+
+    def _next_unclaimed_key(self) -> str or None:
+        """
+        Returns and claims the next request key nobody in this process is working on.
+        """
+        while True:
+            key = self._next_key()
+            if key is None:
+                return None
+            with self._claim_lock:
+                if key in self._claimed:
+                    continue
+                self._claimed[key] = time.monotonic()
+                _CLAIMED.set(len(self._claimed))
+            return key
+
+    def _read_object(self, request_key: str) -> bytes or None:
+        """
+        Reads the raw request body, returns None if another consumer already deleted it.
+        """
+        try:
+            with _GET_SECONDS.time():
+                obj = self.s3_client.get_object(
+                    Bucket=self.bucket_name,
+                    Key=request_key
+                )
+                return obj['Body'].read()
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                logger.info("Request %s was already taken by another consumer, skipping", request_key)
+                return None
+            raise
+
+    def get_next_request(self) -> tuple or None:
+        """
+        Reads the next Widget Request from Bucket 2 without deleting it.
+        Call delete_request(key) once the request has been handled.
 
         Returns:
-            dict: The parsed JSON request if successful.
+            (key, dict): The request key and parsed JSON request if successful.
             None: If no request is available.
+
+        Raises:
+            RequestDecodeError: If the next request is not valid JSON. Its key stays claimed,
+            pass it to quarantine_request (or release_request to retry it).
+        """
+        while True:
+            try:
+                request_key = self._next_unclaimed_key()
+            except Exception as e:
+                logger.error(f"Error listing objects in bucket: {e}")
+                return None
+
+            # Check if any objects were found
+            if request_key is None:
+                _EMPTY_POLLS.inc()
+                # the consumer logs the empty poll (with its backoff), no need to log it twice
+                logger.debug("No requests found in the bucket.")
+                return None
+            logger.info("Found and attempting to retrieve request: %s", request_key)
+
+            request = self._load_request(request_key)
+            if request is None:
+                # someone else got it first, move on to the next key
+                continue
+            return request
+
+    def get_request(self, request_key: str) -> tuple or None:
+        """
+        Reads one specific Widget Request (e.g. named by an S3 event notification) without listing the bucket.
+        The key is claimed the same way get_next_request claims keys.
+
+        Returns:
+            (key, dict): The request key and parsed JSON request.
+            None: If the request is gone or this process is already working on it.
+
+        Raises:
+            RequestDecodeError: If the request is not valid JSON.
+        """
+        with self._claim_lock:
+            if request_key in self._claimed:
+                return None
+            self._claimed[request_key] = time.monotonic()
+            _CLAIMED.set(len(self._claimed))
+        return self._load_request(request_key)
+
+    def _load_request(self, request_key: str) -> tuple or None:
+        """
+        Reads and decodes a claimed request, releasing the claim if it no longer exists.
+        """
+        # 2. Read the Request Object
+        try:
+            raw_body = self._read_object(request_key)
+        except Exception:
+            self.release_request(request_key)
+            raise
+        if raw_body is None:
+            self.release_request(request_key)
+            return None
+
+            # 3. Read, decode and Process the Request
+        try:
+            with _DECODE_SECONDS.time():
+                # parsed straight from the response bytes
+                widget_request = json_codec.loads(raw_body)
+            logger.info("Successfully unfurled (parsed) widget request from %s", request_key)
+        except ValueError as e:
+            # json.JSONDecodeError, or UnicodeDecodeError for bodies that aren't UTF-8
+            logger.warning(f"Warning: Malformed JSON found in request key: {request_key}")
+            raise RequestDecodeError(request_key, f"malformed JSON: {e}")
+
+        return request_key, widget_request
+
+    def delete_request(self, request_key: str) -> bool:
+        """
+        Deletes a handled request from Bucket 2.
+
+        Returns:
+            bool: True if the delete went through.
+        """
+        try:
+            with _DELETE_SECONDS.time():
+                self.s3_client.delete_object(
+                        Bucket=self.bucket_name,
+                        Key=request_key
+                )
+            logger.info("Successfully deleted request: %s", request_key)
+        except Exception as delete_e:
+                # keep the claim, the request comes back once it expires
+                logger.error(f"Failed to delete request {request_key}. Error: {delete_e}")
+                return False
+        self.release_request(request_key)
+        return True
+
+    def delete_requests(self, request_keys: list) -> list:
+        """
+        Deletes handled requests from Bucket 2 with DeleteObjects, up to 1000 keys per call.
+
+        Only the deleted keys are released, the ones that failed stay claimed until the claim expires.
+
+        Returns:
+            list: The keys that could not be deleted.
+        """
+        failed = []
+        for i in range(0, len(request_keys), 1000):
+            chunk = request_keys[i:i + 1000]
+            try:
+                with _DELETE_SECONDS.time():
+                    response = self.s3_client.delete_objects(
+                        Bucket=self.bucket_name,
+                        Delete={'Objects': [{'Key': key} for key in chunk], 'Quiet': True}
+                    )
+                errors = response.get('Errors', [])
+            except Exception as delete_e:
+                logger.error(f"Failed to delete {len(chunk)} requests. Error: {delete_e}")
+                errors = [{'Key': key} for key in chunk]
+
+            for error in errors:
+                logger.error(f"Failed to delete request {error['Key']}. Error: {error.get('Message')}")
+            failed.extend(error['Key'] for error in errors)
+            logger.info("Successfully deleted %d requests", len(chunk) - len(errors))
+
+        failed_keys = set(failed)
+        for key in request_keys:
+            if key not in failed_keys:
+                self.release_request(key)
+        return failed
+
+    def quarantine_request(self, request_key: str, reason: str, attempts: int) -> bool:
+        """
+        Moves a request that can't be handled to the dead-letter location, with the reason and
+        attempt count stored as object metadata, then deletes the original.
+
+        Returns:
+            bool: True if the request was moved.
+        """
+        dead_letter_key = f"{self.dead_letter_prefix}{request_key}"
+        try:
+            with _QUARANTINE_SECONDS.time():
+                self.s3_client.copy_object(
+                    Bucket=self.dead_letter_bucket,
+                    Key=dead_letter_key,
+                    CopySource={'Bucket': self.bucket_name, 'Key': request_key},
+                    Metadata={
+                        # metadata has to be ascii and both values together stay well under the 2KB limit
+                        'error-reason': reason.encode('ascii', 'replace').decode('ascii')[:1024],
+                        'attempts': str(attempts)
+                    },
+                    MetadataDirective='REPLACE'
+                )
+        except Exception as e:
+            logger.error(f"Failed to quarantine request {request_key}. Error: {e}")
+            self.release_request(request_key)
+            return False
+
+        logger.warning(f"Quarantined request {request_key} to {self.dead_letter_bucket}/{dead_letter_key}: {reason}")
+        self.delete_request(request_key)
+        return True
+
+    def request_attempts(self, request_key: str) -> int:
+        """
+        Failed attempts stored on the request object by record_attempts, 0 if there are none.
         """
         try:
-            # list object and max keys 1 to get the smallest key object 
-            response = self.s3_client.list_objects_v2(
+            tags = self.s3_client.get_object_tagging(Bucket=self.bucket_name, Key=request_key).get('TagSet', [])
+            return next((int(tag['Value']) for tag in tags if tag['Key'] == 'attempts'), 0)
+        except Exception as e:
+            logger.warning(f"Could not read the attempt count of request {request_key}. Error: {e}")
+            return 0
+
+    def record_attempts(self, request_key: str, attempts: int) -> None:
+        """
+        Stores the failed attempt count as a tag on the request object, so it survives a restart of the
+        consumer. Tagging doesn't rewrite the object, so unlike a copy it sends no ObjectCreated
+        notification that would hand the request to another consumer in event mode.
+        """
+        try:
+            self.s3_client.put_object_tagging(
                 Bucket=self.bucket_name,
-                MaxKeys=1
+                Key=request_key,
+                Tagging={'TagSet': [{'Key': 'attempts', 'Value': str(attempts)}]}
             )
         except Exception as e:
-            logger.error(f"Error listing objects in bucket: {e}")
+            # the count in memory still applies, only a restart would reset it
+            logger.warning(f"Could not record the attempt count of request {request_key}. Error: {e}")
 
-        # Check if any objects were found
-        if 'Contents' not in response:
-            logger.info("No requests found in the bucket.")
-            return None  
-         # Get the key of the first object
-        request_key = response['Contents'][0]['Key']
-        logger.info(f"Found and attempting to retrieve request: {request_key}")
+    def get_and_delete_next_request(self) -> dict or None:
+        """
+        Periodically tries to read a single Widget Request from Bucket 2.
 
-        # 2. Read the Request Object
-        obj = self.s3_client.get_object(
-            Bucket=self.bucket_name,
-            Key=request_key
-        )
- 
-        # Read and decode the body content
-        request_body = obj['Body'].read().decode('utf-8')
-
-            # 3. Process the Request 
+        Basic s3 object getter from stack overlow modded to fit requirements
+
+        Returns:
+            dict: The parsed JSON request if successful.
+            None: If no request is available.
+        """
         try:
-            widget_request = json.loads(request_body)
-            logger.info(f"Successfully unfurled (parsed) widget request from {request_key}")
-        except json.JSONDecodeError:
-            logger.warning(f"Warning: Malformed JSON found in request key: {request_key} returning nothing")
+            result = self.get_next_request()
+        except RequestDecodeError as e:
+            logger.warning(f"Warning: {e} returning nothing")
+            self.release_request(e.request_key)
             return None
+        if result is None:
+            return None
+        request_key, widget_request = result
 
             #4. Delete the Request Object
-        try:
-            self.s3_client.delete_object(
-                    Bucket=self.bucket_name,
-                    Key=request_key
-            )
-            logger.info(f"Successfully deleted request: {request_key}")
-        except Exception as delete_e:
-                logger.error(f"Failed to delete request {request_key}. Error: {delete_e}")
-                return None # Or handle as appropriate if deletion is critical
+        if not self.delete_request(request_key):
+            return None # Or handle as appropriate if deletion is critical
 
         return widget_request
-            
 
+
+class RequestAcknowledger:
+    """
+    Collects the keys of successfully processed requests and deletes them in bulk.
+    Works with any request source (see request_sources.RequestSource), not just S3RequestRetriever.
+
+    Keys are flushed with one DeleteObjects call per 1000 keys as soon as batch_size keys are waiting
+    or the oldest has waited max_delay_ms. Since requests are only acked after processing, a crash
+    before a flush means they are processed again (at-least-once), never lost.
+    """
+    def __init__(self, retriever, batch_size: int = 1000, max_delay_ms: int = 1000):
+        self.retriever = retriever
+        self.batch_size = max(1, min(batch_size, 1000))
+        self.max_delay_s = max_delay_ms / 1000.0
+        self._pending = []
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, name="request-ack-flusher", daemon=True)
+        self._flusher.start()
+
+    def ack(self, request_key: str) -> None:
+        """Marks a request as processed, it is deleted with the next flush."""
+        with self._lock:
+            self._pending.append(request_key)
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            if len(self._pending) < self.batch_size:
+                return
+            keys = self._take()
+        self._delete(keys)
+
+    def flush(self) -> None:
+        """Deletes everything that has been acked so far."""
+        with self._lock:
+            keys = self._take()
+        if keys:
+            self._delete(keys)
+
+    def close(self) -> None:
+        self._stop.set()
+        self._flusher.join()
+        self.flush()
+
+    def _take(self) -> list:
+        # caller holds the lock
+        keys, self._pending, self._oldest = self._pending, [], None
+        return keys
+
+    def _flush_loop(self) -> None:
+        while not self._stop.wait(self.max_delay_s / 2 or 0.05):
+            with self._lock:
+                due = self._oldest is not None and time.monotonic() - self._oldest >= self.max_delay_s
+                keys = self._take() if due else None
+            if keys:
+                self._delete(keys)
+
+    def _delete(self, keys: list) -> None:
+        failed = self.retriever.delete_requests(keys)
+        if failed:
+            # the objects are still in the bucket, they will be listed and processed again
+            logger.warning(f"{len(failed)} processed requests could not be deleted and may be redelivered")
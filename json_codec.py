@@ -0,0 +1,102 @@
+import json
+import logging
+from typing import Any, Protocol
+
+logger = logging.getLogger(__name__)
+
+# JSON codecs for the hot path.
+# Requests are parsed straight from the S3 response bytes and widget bodies are serialized straight to
+# the bytes put_object sends, without the str in between. orjson does both several times faster than
+# the stdlib and is used when it is installed (pip install orjson), the stdlib json module otherwise.
+# Whatever orjson refuses (it only writes 64-bit integers) is handed to the stdlib codec instead. When
+# reading, orjson turns integers past 64 bits into floats; requests only carry strings, so that never
+# comes up. orjson output is always compact and keeps non-ASCII characters as UTF-8 where the stdlib
+# writes \u escapes, so with orjson stored bodies lose the stdlib's whitespace after separators whether or
+# not compact is asked for. Both read back as the same value.
+#
+# The active codec is process-wide, --json-codec picks it (auto by default).
+
+CODECS = ('auto', 'orjson', 'stdlib')
+
+
+class JsonCodec(Protocol):
+    name: str
+
+    def loads(self, data: bytes) -> Any:
+        """Parses UTF-8 JSON bytes. Raises ValueError (json.JSONDecodeError or UnicodeDecodeError) if malformed."""
+        ...
+
+    def dumps(self, obj: Any, compact: bool = False) -> bytes:
+        """Serializes to UTF-8 JSON bytes, compact drops the whitespace after separators."""
+        ...
+
+
+class StdlibCodec:
+    name = 'stdlib'
+
+    def loads(self, data: bytes) -> Any:
+        # json.loads takes bytes as they are, no decode to str first
+        return json.loads(data)
+
+    def dumps(self, obj: Any, compact: bool = False) -> bytes:
+        return json.dumps(obj, separators=(',', ':') if compact else None).encode('utf-8')
+
+
+class OrjsonCodec:
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+        self._stdlib = StdlibCodec()
+
+    def loads(self, data: bytes) -> Any:
+        try:
+            return self._orjson.loads(data)
+        except self._orjson.JSONDecodeError:
+            # let the stdlib have a go, it raises for anything really malformed
+            return self._stdlib.loads(data)
+
+    def dumps(self, obj: Any, compact: bool = False) -> bytes:
+        # orjson has no whitespace option, its output is compact either way
+        try:
+            return self._orjson.dumps(obj)
+        except TypeError:
+            return self._stdlib.dumps(obj, compact)
+
+
+def get_codec(name: str = 'auto') -> JsonCodec:
+    """Builds a codec by name, 'auto' is orjson if it is installed and the stdlib otherwise."""
+    if name not in CODECS:
+        raise ValueError(f"Unsupported JSON codec: {name}")
+    if name == 'stdlib':
+        return StdlibCodec()
+    try:
+        return OrjsonCodec()
+    except ImportError:
+        if name == 'orjson':
+            raise ValueError("the orjson codec needs the orjson package (pip install orjson)")
+        return StdlibCodec()
+
+
+_codec: JsonCodec = get_codec('auto')
+
+
+def use_codec(name: str) -> JsonCodec:
+    """Switches the process-wide codec."""
+    global _codec
+    _codec = get_codec(name)
+    logger.info(f"Using the {_codec.name} JSON codec")
+    return _codec
+
+
+def codec() -> JsonCodec:
+    return _codec
+
+
+def loads(data: bytes) -> Any:
+    return _codec.loads(data)
+
+
+def dumps(obj: Any, compact: bool = False) -> bytes:
+    return _codec.dumps(obj, compact)
@@ -0,0 +1,184 @@
+import copy
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from collections import Counter
+
+# Logging setup for the consumer.
+# In async mode the hot loop renders the message and drops the record on a queue, a background QueueListener
+# thread does the rest of the formatting and the blocking file/stdout writes. Per-request INFO lines can be
+# rate-limited per message template, whatever gets dropped is reported in one summary line per interval.
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that leaves most of the formatting to the listener thread.
+    The message is rendered with its args (and a traceback turned into text) on the calling thread, so
+    mutable args are logged as they were at the call, not as they are by the time the listener gets to them.
+    Timestamps and the line layout are left to the listener's formatter, unlike the stock prepare() which
+    formats the whole line so records can be pickled.
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets at most max_per_interval records per (logger, message template) through every interval_s seconds.
+    Only applies to records below WARNING, warnings and errors always get through.
+    When an interval ends a summary of what was suppressed is logged, by the next record or, after a burst
+    followed by silence, by the timer start_summary_timer runs.
+
+    Works best with %-style calls (logger.info("Stored widget %s", widget_id)) so every request
+    shares the same template.
+    """
+    def __init__(self, max_per_interval: int, interval_s: float = 10.0, summary_logger: str = "logging_setup"):
+        super().__init__()
+        self.max_per_interval = max_per_interval
+        self.interval_s = interval_s
+        self._summary_logger = logging.getLogger(summary_logger)
+        self._seen = Counter()
+        self._suppressed = Counter()
+        self._interval_start = time.monotonic()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._timer = None
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.name == self._summary_logger.name:
+            return True
+        # the same filter sits on several handlers in sync mode, decide once per record
+        decided = getattr(record, "_rate_limit_allowed", None)
+        if decided is not None:
+            return decided
+
+        summary = None
+        with self._lock:
+            now = time.monotonic()
+            if now - self._interval_start >= self.interval_s:
+                summary = self._roll_interval(now)
+            allowed = True
+            if record.levelno < logging.WARNING:
+                key = (record.name, record.msg)
+                self._seen[key] += 1
+                if self._seen[key] > self.max_per_interval:
+                    self._suppressed[key] += 1
+                    allowed = False
+
+        record._rate_limit_allowed = allowed
+        if summary:
+            self._summary_logger.info(summary)
+        return allowed
+
+    def _roll_interval(self, now: float) -> str or None:
+        # caller holds the lock
+        suppressed, self._suppressed = self._suppressed, Counter()
+        self._seen = Counter()
+        self._interval_start = now
+        if not suppressed:
+            return None
+        top = ", ".join(f"{name}: '{msg}' x{count}" for (name, msg), count in suppressed.most_common(5))
+        return f"Suppressed {sum(suppressed.values())} log lines in the last interval ({top})"
+
+    def flush_summary(self) -> None:
+        """Logs the summary for the current (partial) interval."""
+        with self._lock:
+            summary = self._roll_interval(time.monotonic())
+        if summary:
+            self._summary_logger.info(summary)
+
+    def start_summary_timer(self) -> None:
+        """Logs the summary as soon as each interval ends, even when no record comes along to trigger it."""
+        self._timer = threading.Thread(target=self._summary_loop, name="log-rate-limit-summary", daemon=True)
+        self._timer.start()
+
+    def stop_summary_timer(self) -> None:
+        self._stop.set()
+        if self._timer is not None:
+            self._timer.join()
+
+    def _summary_loop(self) -> None:
+        while True:
+            with self._lock:
+                remaining = self._interval_start + self.interval_s - time.monotonic()
+            if self._stop.wait(max(0.0, remaining)):
+                return
+            summary = None
+            with self._lock:
+                now = time.monotonic()
+                # a record may have rolled the interval over while we were waiting
+                if now - self._interval_start >= self.interval_s:
+                    summary = self._roll_interval(now)
+            if summary:
+                self._summary_logger.info(summary)
+
+
+class LoggingHandle:
+    """What configure_logging set up, call close() on shutdown to drain the queue."""
+    def __init__(self, listener=None, rate_limiter: RateLimitFilter = None):
+        self.listener = listener
+        self.rate_limiter = rate_limiter
+
+    def close(self) -> None:
+        if self.rate_limiter is not None:
+            self.rate_limiter.stop_summary_timer()
+            self.rate_limiter.flush_summary()
+        if self.listener is not None:
+            self.listener.stop()
+
+
+def configure_logging(log_dir: str = "logs", async_logging: bool = False, rate_limit: int = 0,
+                      summary_interval_s: float = 10.0, level: int = logging.INFO) -> LoggingHandle:
+    """
+    Configures the root logger to write to stdout and <log_dir>/consumer.log.
+
+    Args:
+        async_logging: Format and write records on a background thread.
+        rate_limit: Max INFO/DEBUG lines per message template per interval, 0 disables rate limiting.
+        summary_interval_s: Length of a rate limiting interval.
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    log_file_path = os.path.join(log_dir, "consumer.log")
+
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [logging.StreamHandler(), logging.FileHandler(log_file_path)]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    rate_limiter = RateLimitFilter(rate_limit, summary_interval_s) if rate_limit > 0 else None
+    if rate_limiter is not None:
+        rate_limiter.start_summary_timer()
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.setLevel(level)
+
+    listener = None
+    if async_logging:
+        log_queue = queue.SimpleQueue()
+        queue_handler = _DeferredQueueHandler(log_queue)
+        if rate_limiter is not None:
+            queue_handler.addFilter(rate_limiter)
+        root.addHandler(queue_handler)
+        listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        listener.start()
+    else:
+        for handler in handlers:
+            if rate_limiter is not None:
+                handler.addFilter(rate_limiter)
+            root.addHandler(handler)
+
+    return LoggingHandle(listener, rate_limiter)
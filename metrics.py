@@ -0,0 +1,271 @@
+import bisect
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Tuple, List, Optional, Callable
+
+logger = logging.getLogger(__name__)
+
+# Lightweight in-process metrics for the hot path.
+# Counters, gauges and latency histograms live in a registry (METRICS by default) and can be served
+# in Prometheus text format by start_metrics_server or logged every few seconds by StatsDumper.
+# Recording is a lock + a bisect, cheap enough to leave on all the time.
+
+# seconds, tuned for network calls to S3/DynamoDB and for sub-millisecond local work
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _format_labels(labels: Labels, extra: Dict[str, str] = None) -> str:
+    pairs = list(labels) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    inner = ",".join(f'{name}="{str(value)}"' for name, value in pairs)
+    return "{" + inner + "}"
+
+
+class Counter:
+    def __init__(self):
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self) -> float:
+        return self._value
+
+    def _reset(self) -> None:
+        with self._lock:
+            self._value = 0.0
+
+
+class Gauge:
+    def __init__(self):
+        self._value = 0.0
+        self._callback: Optional[Callable[[], float]] = None
+
+    def set(self, value: float) -> None:
+        self._value = value
+
+    def set_function(self, callback: Callable[[], float]) -> None:
+        """Reads the value from callback whenever the gauge is collected."""
+        self._callback = callback
+
+    @property
+    def value(self) -> float:
+        if self._callback is not None:
+            try:
+                return float(self._callback())
+            except Exception:
+                return float('nan')
+        return self._value
+
+    def _reset(self) -> None:
+        self._value = 0.0
+
+
+class _Timer:
+    __slots__ = ("_histogram", "_start")
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._histogram.observe(time.perf_counter() - self._start)
+        return False
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+    def _reset(self) -> None:
+        with self._lock:
+            self._counts = [0] * (len(self.buckets) + 1)
+            self._sum = 0.0
+            self._count = 0
+
+    def time(self) -> _Timer:
+        """Context manager that observes how long its block took."""
+        return _Timer(self)
+
+    def snapshot(self) -> Tuple[List[int], float, int]:
+        with self._lock:
+            return list(self._counts), self._sum, self._count
+
+    def quantile(self, q: float) -> float:
+        """Estimates the q-quantile (0..1) by interpolating inside the bucket it falls in."""
+        counts, _, count = self.snapshot()
+        if count == 0:
+            return 0.0
+        target = q * count
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            if seen + bucket_count >= target and bucket_count:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (target - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+
+class MetricsRegistry:
+    """
+    Holds metrics by name and labels. Asking for the same name/labels twice returns the same metric,
+    so hot-path modules can grab their handles once at import.
+    """
+    def __init__(self):
+        self._metrics: Dict[Tuple[str, Labels], object] = {}
+        self._meta: Dict[str, Tuple[str, str]] = {}  # name -> (type, help)
+        self._lock = threading.Lock()
+
+    def _get(self, kind: str, factory, name: str, help_text: str, labels: Dict[str, str]):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is not None:
+            return metric
+        with self._lock:
+            metric = self._metrics.get(key)
+            if metric is None:
+                registered = self._meta.setdefault(name, (kind, help_text))
+                if registered[0] != kind:
+                    raise ValueError(f"metric {name} is already registered as a {registered[0]}")
+                metric = self._metrics[key] = factory()
+            return metric
+
+    def counter(self, name: str, help_text: str = "", **labels) -> Counter:
+        return self._get("counter", Counter, name, help_text, labels)
+
+    def gauge(self, name: str, help_text: str = "", **labels) -> Gauge:
+        return self._get("gauge", Gauge, name, help_text, labels)
+
+    def histogram(self, name: str, help_text: str = "", buckets: Tuple[float, ...] = DEFAULT_BUCKETS, **labels) -> Histogram:
+        return self._get("histogram", lambda: Histogram(buckets), name, help_text, labels)
+
+    def stage(self, stage: str) -> Histogram:
+        """Latency histogram for one stage of the pipeline (list, get, decode, validate, store, delete...)."""
+        return self.histogram("widget_stage_seconds", "Time spent in each pipeline stage.", stage=stage)
+
+    def reset(self) -> None:
+        """Zeroes every metric (handles stay valid), mostly for tests and benchmarks."""
+        with self._lock:
+            for metric in self._metrics.values():
+                metric._reset()
+
+    def render_prometheus(self) -> str:
+        """Renders every metric in the Prometheus text exposition format."""
+        with self._lock:
+            items = sorted(self._metrics.items(), key=lambda item: item[0])
+            meta = dict(self._meta)
+
+        lines = []
+        described = set()
+        for (name, labels), metric in items:
+            kind, help_text = meta[name]
+            if name not in described:
+                described.add(name)
+                if help_text:
+                    lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+
+            if isinstance(metric, Histogram):
+                counts, total, count = metric.snapshot()
+                cumulative = 0
+                for bound, bucket_count in zip(list(metric.buckets) + [float('inf')], counts):
+                    cumulative += bucket_count
+                    le = "+Inf" if bound == float('inf') else repr(bound)
+                    lines.append(f"{name}_bucket{_format_labels(labels, {'le': le})} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+                lines.append(f"{name}_count{_format_labels(labels)} {count}")
+            else:
+                lines.append(f"{name}{_format_labels(labels)} {metric.value}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> Dict[str, object]:
+        """Flat dict of every metric, histograms summarized as count/mean/p50/p95/p99 (ms)."""
+        with self._lock:
+            items = list(self._metrics.items())
+        snapshot = {}
+        for (name, labels), metric in sorted(items, key=lambda item: item[0]):
+            key = name + _format_labels(labels)
+            if isinstance(metric, Histogram):
+                _, total, count = metric.snapshot()
+                snapshot[key] = {
+                    "count": count,
+                    "mean_ms": round(total / count * 1000, 3) if count else 0.0,
+                    "p50_ms": round(metric.quantile(0.50) * 1000, 3),
+                    "p95_ms": round(metric.quantile(0.95) * 1000, 3),
+                    "p99_ms": round(metric.quantile(0.99) * 1000, 3),
+                }
+            else:
+                snapshot[key] = metric.value
+        return snapshot
+
+
+# default registry used by the consumer
+METRICS = MetricsRegistry()
+
+
+def start_metrics_server(port: int, registry: MetricsRegistry = METRICS, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """
+    Serves the registry at http://host:port/metrics from a daemon thread. Call .shutdown() to stop it.
+    """
+    class _MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/metrics", "/"):
+                self.send_error(404)
+                return
+            body = registry.render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # scrapes every few seconds would drown the consumer log
+            pass
+
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info(f"Serving metrics on http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+class StatsDumper:
+    """Logs a snapshot of the registry every interval_s seconds from a daemon thread."""
+    def __init__(self, interval_s: float, registry: MetricsRegistry = METRICS):
+        self.interval_s = interval_s
+        self.registry = registry
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stats-dumper", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval_s):
+            logger.info(f"Stats: {self.registry.snapshot()}")
+
+    def close(self) -> None:
+        self._stop.set()
+        self._thread.join()
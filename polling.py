@@ -0,0 +1,49 @@
+import random
+import threading
+
+# Backlog-aware polling for the consumer loop.
+# While requests keep showing up we never sleep, once the bucket comes back empty we back off
+# exponentially (with jitter so a fleet of consumers doesn't LIST in lockstep) up to a ceiling.
+
+
+class PollScheduler:
+    """
+    Decides how long to wait before the next poll of the request bucket.
+
+    Call record_request() whenever a poll returned work and next_delay() after an empty poll.
+    Every worker needs its own (see for_worker()), one shared by N workers would count each round of
+    empty polls N times and reach max_delay_ms N times sooner.
+    """
+    def __init__(self, base_delay_ms: int = 100, max_delay_ms: int = 5000, jitter: float = 0.5):
+        self.base_delay_s = max(base_delay_ms, 0) / 1000.0
+        self.max_delay_s = max(max_delay_ms / 1000.0, self.base_delay_s)
+        self.jitter = min(max(jitter, 0.0), 1.0)
+        self._empty_polls = 0
+        self._lock = threading.Lock()
+
+    def for_worker(self) -> "PollScheduler":
+        """A scheduler with the same settings and its own count of empty polls."""
+        return PollScheduler(self.base_delay_s * 1000, self.max_delay_s * 1000, self.jitter)
+
+    @property
+    def empty_polls(self) -> int:
+        """Number of empty polls in a row since work was last seen."""
+        return self._empty_polls
+
+    def record_request(self) -> None:
+        """Work showed up, go back to polling without any delay."""
+        with self._lock:
+            self._empty_polls = 0
+
+    def next_delay(self) -> float:
+        """
+        Records an empty poll and returns how many seconds to wait before polling again.
+        """
+        with self._lock:
+            attempt = self._empty_polls
+            self._empty_polls += 1
+
+        # cap the exponent so we don't build huge floats after a long idle period
+        delay = min(self.max_delay_s, self.base_delay_s * (2 ** min(attempt, 32)))
+        # keep (1 - jitter) of the delay and randomize the rest
+        return delay * (1 - self.jitter) + random.uniform(0, delay * self.jitter)
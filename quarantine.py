@@ -0,0 +1,96 @@
+import logging
+import threading
+from collections import OrderedDict
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+# Poison-message handling.
+# The retriever always hands out the smallest key first, so a request that can never be processed
+# would be picked up again and again and hold up everything behind it. Requests that can't be decoded
+# or fail validation are moved to the dead-letter location right away, requests whose processing keeps
+# failing (e.g. the storage backend rejects them) are moved once they have used up max_attempts.
+# Failed attempts are also written back to the request source (for S3 as a tag on the request object),
+# so a restarted consumer picks the count up where the last one left off.
+
+
+class RequestQuarantine:
+    """
+    Tracks failed attempts per request key and moves poison requests out of the way
+    through the request source's quarantine_request.
+    """
+    # how many keys we remember failed attempts for, oldest are forgotten first
+    MAX_TRACKED_KEYS = 10000
+
+    def __init__(self, source, max_attempts: int = 3):
+        self.source = source
+        self.max_attempts = max(1, max_attempts)
+        self._attempts = OrderedDict()
+        self._lock = threading.Lock()
+        self.metrics = {
+            'quarantined': 0,
+            'decode_errors': 0,
+            'invalid_requests': 0,
+            'processing_failures': 0,
+            'quarantine_errors': 0,
+        }
+
+    def _count_attempt(self, request_key: str) -> int:
+        with self._lock:
+            attempts = self._attempts.pop(request_key, None)
+        if attempts is None:
+            # first failure this process has seen, an earlier run may have counted some already
+            attempts = self.source.request_attempts(request_key)
+        attempts += 1
+        with self._lock:
+            self._attempts[request_key] = attempts
+            if len(self._attempts) > self.MAX_TRACKED_KEYS:
+                self._attempts.popitem(last=False)
+            return attempts
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.metrics[name] += 1
+        METRICS.counter("widget_quarantine_events_total", "Poison request handling, by event.", event=name).inc()
+
+    def _quarantine(self, request_key: str, reason: str, attempts: int) -> bool:
+        moved = self.source.quarantine_request(request_key, reason, attempts)
+        if moved:
+            with self._lock:
+                self._attempts.pop(request_key, None)
+            self._count('quarantined')
+        else:
+            self._count('quarantine_errors')
+        return moved
+
+    def reject_undecodable(self, request_key: str, reason: str) -> bool:
+        """Quarantines a request whose body could not be decoded."""
+        self._count('decode_errors')
+        return self._quarantine(request_key, reason, self._count_attempt(request_key))
+
+    def reject_invalid(self, request_key: str, reason: str) -> bool:
+        """Quarantines a request that decoded fine but failed validation."""
+        self._count('invalid_requests')
+        return self._quarantine(request_key, reason, self._count_attempt(request_key))
+
+    def record_failure(self, request_key: str, reason: str) -> bool:
+        """
+        Records a failed processing attempt. The request is quarantined once it reaches max_attempts,
+        before that it is released so it can be retried.
+
+        Returns:
+            bool: True if the request was quarantined.
+        """
+        self._count('processing_failures')
+        attempts = self._count_attempt(request_key)
+        if attempts >= self.max_attempts:
+            return self._quarantine(request_key, f"failed {attempts} times, last error: {reason}", attempts)
+        logger.warning(f"Request {request_key} failed (attempt {attempts}/{self.max_attempts}): {reason}")
+        self.source.record_attempts(request_key, attempts)
+        self.source.release_request(request_key)
+        return False
+
+    def stats(self) -> dict:
+        """Snapshot of the quarantine counters."""
+        with self._lock:
+            return dict(self.metrics)
@@ -0,0 +1,266 @@
+import json
+import json_codec
+import logging
+import mmap
+import os
+import threading
+from collections import deque
+from typing import Protocol, runtime_checkable, Optional, Tuple, Dict, Any, List
+from config import ConsumerConfig
+from get_widget import S3RequestRetriever, RequestDecodeError
+from metrics import METRICS
+from aws_clients import ClientFactory
+
+logger = logging.getLogger(__name__)
+
+_DECODE_SECONDS = METRICS.stage("decode")
+_EMPTY_POLLS = METRICS.counter("widget_empty_polls_total", "Polls that found no request.")
+
+
+@runtime_checkable
+class RequestSource(Protocol):
+    """
+    Protocol for everything the consumer can pull Widget Requests from.
+
+    get_next_request hands out (key, request) pairs in key order and keeps the key claimed
+    until it is deleted (handled), released (retry later) or quarantined (poison).
+    """
+    def get_next_request(self) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """Returns the next (key, request) or None when there is nothing to do. Raises RequestDecodeError."""
+        ...
+
+    def delete_request(self, request_key: str) -> bool:
+        """Removes a handled request."""
+        ...
+
+    def delete_requests(self, request_keys: List[str]) -> List[str]:
+        """Removes handled requests in bulk, returns the keys that could not be removed."""
+        ...
+
+    def release_request(self, request_key: str) -> None:
+        """Makes a claimed request available again."""
+        ...
+
+    def quarantine_request(self, request_key: str, reason: str, attempts: int) -> bool:
+        """Moves a poison request out of the way."""
+        ...
+
+    def request_attempts(self, request_key: str) -> int:
+        """Failed attempts recorded for a request by record_attempts, 0 if there are none."""
+        ...
+
+    def record_attempts(self, request_key: str, attempts: int) -> None:
+        """Stores the failed attempt count with the request so it outlives the consumer process."""
+        ...
+
+
+def _decode(request_key: str, raw_body: bytes) -> Dict[str, Any]:
+    try:
+        with _DECODE_SECONDS.time():
+            return json_codec.loads(raw_body)
+    except ValueError as e:
+        logger.warning(f"Warning: Malformed JSON found in request key: {request_key}")
+        raise RequestDecodeError(request_key, f"malformed JSON: {e}")
+
+
+class JsonlFileSource:
+    """
+    Streams requests from a JSON Lines file, one request per line, e.g. captured production traffic.
+
+    The file is memory-mapped and read line by line, so replaying a large capture doesn't load it into memory.
+    Keys are the zero-padded line numbers so they sort in file order. Deleting is a no-op (the file is
+    never modified), released requests are retried before moving on and quarantined lines are appended
+    to `<path>.dead-letter.jsonl`.
+    """
+    def __init__(self, path: str, dead_letter_path: str = None):
+        self.path = path
+        self.dead_letter_path = dead_letter_path or f"{path}.dead-letter.jsonl"
+        self._file = open(path, 'rb')
+        # mmap can't map an empty file
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path) else None
+        self._line_no = 0
+        self._lines: Dict[str, bytes] = {}  # claimed key -> raw line
+        self._retry = deque()
+        self._lock = threading.Lock()
+
+    def _next_line(self) -> Optional[Tuple[str, bytes]]:
+        # caller holds the lock
+        if self._retry:
+            key = self._retry.popleft()
+            return key, self._lines[key]
+        while self._map is not None:
+            line = self._map.readline()
+            if not line:
+                return None
+            self._line_no += 1
+            line = line.strip()
+            if line:
+                key = f"{self._line_no:012d}"
+                self._lines[key] = line
+                return key, line
+        return None
+
+    def get_next_request(self) -> Optional[Tuple[str, Dict[str, Any]]]:
+        with self._lock:
+            next_line = self._next_line()
+        if next_line is None:
+            _EMPTY_POLLS.inc()
+            return None
+        request_key, raw_body = next_line
+        return request_key, _decode(request_key, raw_body)
+
+    def delete_request(self, request_key: str) -> bool:
+        with self._lock:
+            self._lines.pop(request_key, None)
+        return True
+
+    def delete_requests(self, request_keys: List[str]) -> List[str]:
+        for key in request_keys:
+            self.delete_request(key)
+        return []
+
+    def release_request(self, request_key: str) -> None:
+        with self._lock:
+            if request_key in self._lines and request_key not in self._retry:
+                self._retry.append(request_key)
+
+    def quarantine_request(self, request_key: str, reason: str, attempts: int) -> bool:
+        with self._lock:
+            raw_body = self._lines.pop(request_key, b'')
+            record = {"key": request_key, "reason": reason, "attempts": attempts,
+                      "body": raw_body.decode('utf-8', 'replace')}
+            with open(self.dead_letter_path, 'a', encoding='utf-8') as dead_letter:
+                dead_letter.write(json.dumps(record) + "\n")
+        logger.warning(f"Quarantined request {request_key} to {self.dead_letter_path}: {reason}")
+        return True
+
+    def request_attempts(self, request_key: str) -> int:
+        # a replay starts from scratch, attempts are only counted in memory
+        return 0
+
+    def record_attempts(self, request_key: str, attempts: int) -> None:
+        pass
+
+    def close(self) -> None:
+        if self._map is not None:
+            self._map.close()
+        self._file.close()
+
+
+class DirectorySource:
+    """
+    Reads requests from files in a local directory, standing in for the request bucket.
+
+    Keys are the file paths relative to the directory ('/' separated) and are handed out in the same
+    order S3 lists keys, smallest first. Deleting removes the file, quarantining moves it under
+    dead_letter_prefix with a `.error.json` file next to it holding the reason and attempt count.
+    """
+    def __init__(self, directory: str, dead_letter_prefix: str = 'dead-letter/'):
+        self.directory = directory
+        self.dead_letter_prefix = dead_letter_prefix
+        self._buffer = deque()
+        self._claimed = set()
+        self._lock = threading.Lock()
+
+    def _path(self, request_key: str) -> str:
+        return os.path.join(self.directory, *request_key.split('/'))
+
+    def _list_keys(self) -> List[str]:
+        keys = []
+        for root, _, files in os.walk(self.directory):
+            rel_root = os.path.relpath(root, self.directory)
+            for name in files:
+                key = name if rel_root == '.' else f"{rel_root.replace(os.sep, '/')}/{name}"
+                if self.dead_letter_prefix and key.startswith(self.dead_letter_prefix):
+                    continue
+                keys.append(key)
+        # python sorts str by code point which matches S3's UTF-8 byte order
+        return sorted(keys)
+
+    def get_next_request(self) -> Optional[Tuple[str, Dict[str, Any]]]:
+        while True:
+            with self._lock:
+                if not self._buffer:
+                    self._buffer.extend(key for key in self._list_keys() if key not in self._claimed)
+                if not self._buffer:
+                    _EMPTY_POLLS.inc()
+                    return None
+                request_key = self._buffer.popleft()
+                if request_key in self._claimed:
+                    continue
+                self._claimed.add(request_key)
+
+            try:
+                with open(self._path(request_key), 'rb') as f:
+                    raw_body = f.read()
+            except FileNotFoundError:
+                # someone else got it first, move on to the next key
+                self.release_request(request_key)
+                continue
+            return request_key, _decode(request_key, raw_body)
+
+    def delete_request(self, request_key: str) -> bool:
+        try:
+            os.remove(self._path(request_key))
+            return True
+        except FileNotFoundError:
+            return True
+        except OSError as e:
+            logger.error(f"Failed to delete request {request_key}. Error: {e}")
+            return False
+        finally:
+            self.release_request(request_key)
+
+    def delete_requests(self, request_keys: List[str]) -> List[str]:
+        return [key for key in request_keys if not self.delete_request(key)]
+
+    def release_request(self, request_key: str) -> None:
+        with self._lock:
+            self._claimed.discard(request_key)
+
+    def quarantine_request(self, request_key: str, reason: str, attempts: int) -> bool:
+        dead_letter_path = self._path(f"{self.dead_letter_prefix}{request_key}")
+        try:
+            os.makedirs(os.path.dirname(dead_letter_path), exist_ok=True)
+            os.replace(self._path(request_key), dead_letter_path)
+            with open(f"{dead_letter_path}.error.json", 'w', encoding='utf-8') as f:
+                json.dump({"reason": reason, "attempts": attempts}, f)
+        except OSError as e:
+            logger.error(f"Failed to quarantine request {request_key}. Error: {e}")
+            self.release_request(request_key)
+            return False
+        logger.warning(f"Quarantined request {request_key} to {dead_letter_path}: {reason}")
+        self.release_request(request_key)
+        return True
+
+    def request_attempts(self, request_key: str) -> int:
+        # a file next to the request would be listed as a request itself, attempts stay in memory
+        return 0
+
+    def record_attempts(self, request_key: str, attempts: int) -> None:
+        pass
+
+
+def create_request_source(config: ConsumerConfig, prefixes_provider=None, clients: ClientFactory = None) -> RequestSource:
+    """
+    Builds the request source selected by --request-source.
+    prefixes_provider restricts the S3 source to part of the key space (sharded mode).
+    """
+    if config.request_source == 's3':
+        return S3RequestRetriever(
+            bucket_name=config.bucket_2_name,
+            region_name=config.region_name,
+            prefetch_size=config.prefetch_size,
+            low_water_mark=config.prefetch_low_water,
+            dead_letter_bucket=config.dead_letter_bucket,
+            dead_letter_prefix=config.dead_letter_prefix,
+            prefixes_provider=prefixes_provider,
+            clients=clients or ClientFactory.from_config(config),
+            shard_width=config.shard_prefix_width
+        )
+    elif config.request_source == 'jsonl':
+        return JsonlFileSource(config.request_path)
+    elif config.request_source == 'directory':
+        return DirectorySource(config.request_path, dead_letter_prefix=config.dead_letter_prefix)
+    else:
+        raise ValueError(f"Unsupported request source: {config.request_source}")
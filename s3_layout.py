@@ -0,0 +1,186 @@
+import hashlib
+import logging
+import threading
+import time
+from contextlib import nullcontext
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+from botocore.exceptions import ClientError
+import json_codec
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+# Key layouts for widgets in Bucket 3.
+#   owner   widgets/{owner}/{widgetId}            the original layout
+#   hashed  widgets/{shard}/{owner}/{widgetId}    shard = first hex chars of md5(widgetId)
+# S3 scales request rates per prefix, so with the owner layout a few busy owners put all their writes on
+# one prefix and get 503 SlowDown. The hashed layout spreads every owner over 16^shard_chars prefixes.
+# An owner's widgets then can't be listed with one prefix any more, so the OwnerIndex keeps a small
+# manifest per owner (widget-index/{owner}.json, just the widgetIds) that is read instead.
+# A new owner starts with an empty manifest. To turn the index on over widgets that are already stored,
+# run with --s3-index-backfill until every owner has a manifest: an owner without one is then listed the
+# slow way, once per process, and the first write of the manifest starts from that listing.
+
+KEY_LAYOUTS = ('owner', 'hashed')
+WIDGET_PREFIX = 'widgets'
+INDEX_PREFIX = 'widget-index'
+
+_INDEX_CONFLICTS = METRICS.counter("widget_index_conflicts_total", "Owner index writes that lost a race and were merged again.")
+
+
+def owner_segment(owner: str) -> str:
+    # strip for spaces and lowercase the owner for the key
+    return owner.replace(" ", "-").lower()
+
+
+def key_shard(widget_id: str, shard_chars: int = 2) -> str:
+    return hashlib.md5(widget_id.encode('utf-8')).hexdigest()[:shard_chars]
+
+
+def widget_key(owner: str, widget_id: str, layout: str = 'owner', shard_chars: int = 2) -> str:
+    if layout == 'hashed':
+        return f"{WIDGET_PREFIX}/{key_shard(widget_id, shard_chars)}/{owner_segment(owner)}/{widget_id}"
+    return f"{WIDGET_PREFIX}/{owner_segment(owner)}/{widget_id}"
+
+
+def index_key(owner: str) -> str:
+    return f"{INDEX_PREFIX}/{owner_segment(owner)}.json"
+
+
+def _is_conflict(error: ClientError) -> bool:
+    return error.response.get('Error', {}).get('Code') in ('PreconditionFailed', 'ConditionalRequestConflict')
+
+
+class OwnerIndex:
+    """
+    Per-owner manifests of widgetIds in S3.
+
+    Adds and removes are gathered per owner and merged into the manifest every flush_ms, so a busy
+    owner costs one read and one write per flush rather than per widget. The write is conditional on
+    the ETag that was read (or on the manifest not existing yet); when another consumer got there
+    first the manifest is read and merged again. Acks run once the manifest is written, changes whose
+    write failed go back into the pending ones and are tried again on the next flush.
+
+    `backfill(owner)` lists the widgetIds an owner already has in the bucket. It stands in for a
+    manifest that doesn't exist yet, so widgets stored before the index was turned on aren't lost.
+    Each owner is listed at most once, the listing is kept until the owner's manifest is written.
+    """
+    def __init__(self, client, bucket_name: str, flush_ms: int = 500, slot: Callable[[], Any] = nullcontext,
+                 max_retries: int = 5, backfill: Callable[[str], Iterable[str]] = None):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.flush_s = flush_ms / 1000.0
+        self.max_retries = max_retries
+        self._slot = slot
+        self._backfill = backfill
+        # owner -> widgetIds listed by backfill, until the owner's manifest is written
+        self._backfilled: Dict[str, Set[str]] = {}
+        # owner -> ({widgetId: present}, [acks])
+        self._pending: Dict[str, Tuple[Dict[str, bool], list]] = {}
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, name="owner-index", daemon=True)
+        self._flusher.start()
+
+    def add(self, owner: str, widget_id: str, ack: Optional[Callable[[], None]] = None) -> None:
+        self._change(owner, widget_id, True, ack)
+
+    def remove(self, owner: str, widget_id: str, ack: Optional[Callable[[], None]] = None) -> None:
+        self._change(owner, widget_id, False, ack)
+
+    def _change(self, owner: str, widget_id: str, present: bool, ack) -> None:
+        with self._lock:
+            changes, acks = self._pending.setdefault(owner, ({}, []))
+            # the latest change for a widget wins
+            changes[widget_id] = present
+            if ack:
+                acks.append(ack)
+
+    def widget_ids(self, owner: str) -> List[str]:
+        """The widgetIds in the owner's manifest, changes that weren't flushed yet aren't included."""
+        return sorted(self._read(owner)[0])
+
+    def _read(self, owner: str) -> Tuple[Set[str], Optional[str]]:
+        try:
+            with self._slot():
+                obj = self.client.get_object(Bucket=self.bucket_name, Key=index_key(owner))
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                return self._backfilled_ids(owner), None
+            raise
+        manifest = json_codec.loads(obj['Body'].read())
+        return set(manifest.get('widgets', [])), obj['ETag']
+
+    def _backfilled_ids(self, owner: str) -> Set[str]:
+        # no manifest yet, with a backfill the owner may still have widgets from before the index
+        if self._backfill is None:
+            return set()
+        with self._lock:
+            listed = self._backfilled.get(owner)
+        if listed is None:
+            listed = set(self._backfill(owner))
+            with self._lock:
+                listed = self._backfilled.setdefault(owner, listed)
+        return set(listed)
+
+    def _write(self, owner: str, changes: Dict[str, bool]) -> None:
+        for attempt in range(self.max_retries + 1):
+            widget_ids, etag = self._read(owner)
+            for widget_id, present in changes.items():
+                if present:
+                    widget_ids.add(widget_id)
+                else:
+                    widget_ids.discard(widget_id)
+            condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+            try:
+                with self._slot():
+                    self.client.put_object(
+                        Bucket=self.bucket_name,
+                        Key=index_key(owner),
+                        Body=json_codec.dumps({"owner": owner, "widgets": sorted(widget_ids)}, compact=True),
+                        ContentType="application/json",
+                        **condition
+                    )
+                if self._backfill is not None:
+                    # the manifest holds the listing from now on
+                    with self._lock:
+                        self._backfilled.pop(owner, None)
+                return
+            except ClientError as e:
+                if not _is_conflict(e) or attempt >= self.max_retries:
+                    raise
+                _INDEX_CONFLICTS.inc()
+                time.sleep(0.01 * (2 ** attempt))
+
+    def flush(self) -> None:
+        """Merges every pending change into the manifests."""
+        # one flush at a time, two writers of the same manifest would only conflict. The changes are taken
+        # under the same lock, so a flush never writes its changes before an earlier flush wrote older ones
+        with self._write_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            for owner, (changes, acks) in pending.items():
+                try:
+                    self._write(owner, changes)
+                except Exception as e:
+                    logger.error(f"Failed to update the widget index of {owner}, keeping {len(acks)} requests for the next flush. Error: {e}")
+                    self._requeue(owner, changes, acks)
+                    continue
+                for ack in acks:
+                    ack()
+
+    def _requeue(self, owner: str, changes: Dict[str, bool], acks: list) -> None:
+        with self._lock:
+            newer_changes, newer_acks = self._pending.get(owner, ({}, []))
+            # changes made since the flush started are newer than the ones that failed
+            self._pending[owner] = ({**changes, **newer_changes}, acks + newer_acks)
+
+    def close(self) -> None:
+        self._stop.set()
+        self._flusher.join()
+        self.flush()
+
+    def _flush_loop(self) -> None:
+        while not self._stop.wait(self.flush_s):
+            self.flush()
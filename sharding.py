@@ -0,0 +1,195 @@
+import itertools
+import logging
+import os
+import socket
+import threading
+import time
+from typing import List, Set, Dict, Optional, Tuple
+from botocore.exceptions import ClientError
+from metrics import METRICS
+from aws_clients import ClientFactory
+
+logger = logging.getLogger(__name__)
+
+# Sharded consumers.
+# Request keys are UUIDs, so their first --shard-prefix-width hex characters split the key space into
+# 16^width even slices (16 with the default width of 1, so up to 16 busy consumers; 256 with width 2).
+# Every key that doesn't start with such a prefix (uppercase, non-hex, shorter than the width) belongs
+# to one extra catch-all slice, OTHER_KEYS, so those requests are still handled by someone.
+# Each consumer process heartbeats a membership item in a DynamoDB lease table, works out which
+# slices it should own from the sorted list of live members, and takes a lease on each slice with a
+# conditional write. Leases that aren't renewed expire, so a dead consumer's slices get picked up by
+# the survivors within one lease TTL.
+#
+# Lease table: partition key `leaseId` (S), e.g.
+#   aws dynamodb create-table --table-name widget-consumer-leases \
+#       --attribute-definitions AttributeName=leaseId,AttributeType=S \
+#       --key-schema AttributeName=leaseId,KeyType=HASH --billing-mode PAY_PER_REQUEST
+
+SHARD_ALPHABET = '0123456789abcdef'
+# the catch-all slice, sorts after every hex prefix so it is listed last
+OTHER_KEYS = '~other'
+
+
+def shard_prefixes(width: int = 1) -> Tuple[str, ...]:
+    """Every hex prefix of `width` characters in key order, then the catch-all slice."""
+    return tuple(''.join(chars) for chars in itertools.product(SHARD_ALPHABET, repeat=width)) + (OTHER_KEYS,)
+
+
+def hex_shard(key: str, width: int = 1) -> Optional[str]:
+    """The hex slice a key belongs to, None if it belongs to the catch-all slice."""
+    prefix = key[:width]
+    if len(prefix) == width and all(char in SHARD_ALPHABET for char in prefix):
+        return prefix
+    return None
+
+
+SHARD_PREFIXES = shard_prefixes(1)
+
+_OWNED_SHARDS = METRICS.gauge("widget_owned_shards", "Key space slices this consumer currently holds a lease on.")
+
+
+def default_consumer_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def _now_ms() -> int:
+    # wall clock, leases are compared across hosts
+    return int(time.time() * 1000)
+
+
+class ShardLeaseManager:
+    """
+    Keeps this consumer's membership alive and holds leases on its share of the key space.
+    owned_prefixes() is what the retriever lists, it only returns slices whose lease is still valid locally.
+    """
+    def __init__(self, table_name: str, consumer_id: str = None, region_name: str = 'us-east-1',
+                 lease_ttl_s: float = 30, heartbeat_s: float = 10, prefixes=SHARD_PREFIXES,
+                 clients: ClientFactory = None):
+        self.table_name = table_name
+        self.consumer_id = consumer_id or default_consumer_id()
+        self.lease_ttl_ms = int(lease_ttl_s * 1000)
+        self.heartbeat_s = heartbeat_s
+        self.prefixes = tuple(prefixes)
+        # boto3 clients are thread safe, the heartbeat thread and close() share this one.
+        # The consumer passes ClientFactory.from_config(config), the fallback has default pool and timeouts
+        self.client = (clients or ClientFactory(region_name)).client('dynamodb', region_name)
+
+        # prefix -> local expiry (ms) of our lease on it
+        self._owned: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        """Takes the first leases right away, then keeps heartbeating from a daemon thread."""
+        self.heartbeat()
+        self._thread = threading.Thread(target=self._run, name="shard-lease-heartbeat", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.heartbeat_s):
+            try:
+                self.heartbeat()
+            except Exception as e:
+                # keep going, leases we can't renew run out on their own and owned_prefixes stops returning them
+                logger.error(f"Shard lease heartbeat failed: {e}")
+
+    def owned_prefixes(self) -> List[str]:
+        now = _now_ms()
+        with self._lock:
+            return sorted(prefix for prefix, expires_at in self._owned.items() if expires_at > now)
+
+    def live_members(self) -> List[str]:
+        """Consumer ids with an unexpired membership item, sorted."""
+        now = _now_ms()
+        members = []
+        paginator = self.client.get_paginator('scan')
+        for page in paginator.paginate(
+                TableName=self.table_name,
+                FilterExpression="begins_with(leaseId, :member) AND expiresAt > :now",
+                ExpressionAttributeValues={':member': {'S': 'member#'}, ':now': {'N': str(now)}}):
+            members.extend(item['owner']['S'] for item in page.get('Items', []))
+        return sorted(members)
+
+    def desired_prefixes(self, members: List[str]) -> Set[str]:
+        """Round-robins the slices over the live members, this consumer takes every len(members)-th one."""
+        if self.consumer_id not in members:
+            members = sorted(members + [self.consumer_id])
+        index = members.index(self.consumer_id)
+        return {prefix for i, prefix in enumerate(self.prefixes) if i % len(members) == index}
+
+    def heartbeat(self) -> None:
+        """Renews membership, then acquires/renews the slices we should own and releases the rest."""
+        now = _now_ms()
+        expires_at = now + self.lease_ttl_ms
+        self.client.put_item(
+            TableName=self.table_name,
+            Item={
+                'leaseId': {'S': f"member#{self.consumer_id}"},
+                'owner': {'S': self.consumer_id},
+                'expiresAt': {'N': str(expires_at)},
+            }
+        )
+
+        desired = self.desired_prefixes(self.live_members())
+        with self._lock:
+            currently_owned = set(self._owned)
+
+        for prefix in sorted(currently_owned - desired):
+            self._release(prefix)
+        for prefix in sorted(desired):
+            if self._acquire(prefix, now, expires_at):
+                with self._lock:
+                    self._owned[prefix] = expires_at
+            else:
+                with self._lock:
+                    self._owned.pop(prefix, None)
+        _OWNED_SHARDS.set(len(self.owned_prefixes()))
+
+    def _acquire(self, prefix: str, now: int, expires_at: int) -> bool:
+        """Takes or renews the lease on one slice, fails if someone else holds an unexpired lease on it."""
+        try:
+            self.client.put_item(
+                TableName=self.table_name,
+                Item={
+                    'leaseId': {'S': f"shard#{prefix}"},
+                    'owner': {'S': self.consumer_id},
+                    'expiresAt': {'N': str(expires_at)},
+                },
+                ConditionExpression="attribute_not_exists(leaseId) OR #owner = :me OR expiresAt < :now",
+                ExpressionAttributeNames={'#owner': 'owner'},
+                ExpressionAttributeValues={':me': {'S': self.consumer_id}, ':now': {'N': str(now)}}
+            )
+            return True
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException':
+                logger.debug("Shard %s is still leased by another consumer", prefix)
+                return False
+            raise
+
+    def _release(self, prefix: str) -> None:
+        with self._lock:
+            self._owned.pop(prefix, None)
+        try:
+            self.client.delete_item(
+                TableName=self.table_name,
+                Key={'leaseId': {'S': f"shard#{prefix}"}},
+                ConditionExpression="#owner = :me",
+                ExpressionAttributeNames={'#owner': 'owner'},
+                ExpressionAttributeValues={':me': {'S': self.consumer_id}}
+            )
+            logger.info(f"Released shard {prefix} for rebalancing")
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') != 'ConditionalCheckFailedException':
+                raise
+
+    def close(self) -> None:
+        """Stops heartbeating and hands every slice back so the other consumers pick them up right away."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        for prefix in sorted(set(self._owned)):
+            self._release(prefix)
+        self.client.delete_item(TableName=self.table_name, Key={'leaseId': {'S': f"member#{self.consumer_id}"}})
+        _OWNED_SHARDS.set(0)
@@ -0,0 +1,65 @@
+import unittest
+import threading
+
+import boto3
+from moto import mock_aws
+from config import ConsumerConfig, parse_args
+from aws_clients import ClientFactory
+import consumer
+
+
+class TestClientFactory(unittest.TestCase):
+
+    def setUp(self):
+        self.config = ConsumerConfig(
+            storage_type='dynamodb',
+            bucket_2_name='test-widget-requests',
+            bucket_3_name='',
+            dynamodb_table_name='test-widgets-table',
+            region_name='us-east-1',
+            polling_delay_ms=100,
+            workers=16,
+            retry_mode='adaptive',
+            read_timeout_s=7
+        )
+
+    def test_clients_are_tuned_from_the_config(self):
+        """Tests that pool size, timeouts, retries and keepalive come from the config."""
+        client = ClientFactory.from_config(self.config).client('s3')
+        self.assertEqual(client.meta.config.max_pool_connections, 34)
+        self.assertEqual(client.meta.config.read_timeout, 7)
+        self.assertEqual(client.meta.config.retries['mode'], 'adaptive')
+        self.assertTrue(client.meta.config.tcp_keepalive)
+
+        config = parse_args(['--storage-type', 'dynamodb', '--dynamodb-table-name', 't', '--max-pool-connections', '50',
+                             '--no-tcp-keepalive', '--endpoint-url', 'http://localhost:5000'])
+        factory = ClientFactory.from_config(config)
+        self.assertEqual(factory.client('dynamodb').meta.endpoint_url, 'http://localhost:5000')
+        self.assertEqual(factory.client('dynamodb').meta.config.max_pool_connections, 50)
+        self.assertFalse(factory.client('dynamodb').meta.config.tcp_keepalive)
+
+    @mock_aws
+    def test_retriever_and_storage_share_clients(self):
+        """Tests that the consumer builds one client per service and every thread's Table uses it."""
+        boto3.client('dynamodb', region_name='us-east-1').create_table(
+            TableName='test-widgets-table',
+            KeySchema=[{'AttributeName': 'widgetId', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'widgetId', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+        clients = ClientFactory.from_config(self.config)
+        retriever, processor = consumer.init_consumer(self.config, clients=clients)
+        self.assertIs(retriever.s3_client, clients.client('s3'))
+
+        storage = processor._storage_strategy
+        tables = []
+        thread = threading.Thread(target=lambda: tables.append(storage.table))
+        thread.start()
+        thread.join()
+        self.assertIsNot(tables[0], storage.table)
+        self.assertIs(tables[0].meta.client, storage.table.meta.client)
+        processor.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import unittest
+from unittest.mock import patch
+from config import ConsumerConfig
+from widget_processor import Wiget_Processor, InvalidRequestError
+import benchmark
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_generated_requests_match_fixture_shape(self):
+        """Tests that synthetic requests carry the fixture's fields and a note of the requested size."""
+        requests = benchmark.generate_requests(3, note_size=50, seed=1)
+        self.assertEqual(requests, benchmark.generate_requests(3, note_size=50, seed=1))
+        for request in requests:
+            self.assertEqual(set(request), {"type", "requestId", "widgetId", "owner", "label", "description", "otherAttributes"})
+            note = [attr for attr in request["otherAttributes"] if attr["name"] == "note"][0]
+            self.assertEqual(len(note["value"]), 50)
+
+    def test_codec_benchmark_compares_against_the_str_path(self):
+        """Tests the shape of the JSON codec micro-benchmark report."""
+        report = benchmark.run_codec_benchmark(request_count=5, note_size=50, iterations=2, seed=1)
+        self.assertIn("str_path", report["codecs"])
+        self.assertIn("stdlib", report["codecs"])
+        for result in report["codecs"].values():
+            self.assertGreater(result["decode_us"], 0)
+            self.assertGreater(result["encode_speedup"], 0)
+
+    def test_percentile_nearest_rank(self):
+        values = [float(v) for v in range(1, 101)]
+        self.assertEqual(benchmark.percentile(values, 50), 50.0)
+        self.assertEqual(benchmark.percentile(values, 99), 99.0)
+        self.assertEqual(benchmark.percentile([], 95), 0.0)
+
+    def test_run_benchmark_reports_every_stage(self):
+        """Tests a small end-to-end run against moto and the shape of its report."""
+        config = ConsumerConfig(
+            storage_type='dynamodb',
+            bucket_2_name=benchmark.REQUEST_BUCKET,
+            bucket_3_name=benchmark.WIDGET_BUCKET,
+            dynamodb_table_name=benchmark.WIDGET_TABLE,
+            region_name=benchmark.REGION,
+            polling_delay_ms=0,
+            prefetch_size=10,
+            prefetch_low_water=2,
+            workers=2,
+            dynamodb_batch_size=5,
+            dynamodb_batch_max_latency_ms=20,
+            ack_batch_size=5,
+            ack_max_delay_ms=20
+        )
+        report = benchmark.run_benchmark(config, request_count=12, note_size=100, seed=7)
+
+        self.assertEqual(report["handled"], 12)
+        self.assertGreater(report["requests_per_sec"], 0)
+        for stage in ("retrieve", "process", "total"):
+            self.assertEqual(report["stages"][stage]["count"], 12)
+            self.assertLessEqual(report["stages"][stage]["p50_ms"], report["stages"][stage]["p99_ms"])
+
+    def test_run_benchmark_reports_requests_that_never_complete(self):
+        """Tests that a lost ack ends the run at the deadline and invalid requests are reported, not raised."""
+        config = ConsumerConfig(
+            storage_type='s3',
+            bucket_2_name=benchmark.REQUEST_BUCKET,
+            bucket_3_name=benchmark.WIDGET_BUCKET,
+            dynamodb_table_name=benchmark.WIDGET_TABLE,
+            region_name=benchmark.REGION,
+            polling_delay_ms=0,
+            ack_max_delay_ms=20
+        )
+        lost, invalid = [request["requestId"] for request in benchmark.generate_requests(2, note_size=10, seed=3)]
+        process = Wiget_Processor.process
+
+        def flaky_process(processor, widget_data, ack=None, on_failure=None):
+            if widget_data["requestId"] == lost:
+                return
+            if widget_data["requestId"] == invalid:
+                raise InvalidRequestError("unknown request type")
+            process(processor, widget_data, ack, on_failure)
+
+        with patch.object(Wiget_Processor, 'process', flaky_process):
+            report = benchmark.run_benchmark(config, request_count=4, note_size=10, seed=3, ack_timeout_s=0.2)
+        self.assertEqual((report["handled"], report["completed"]), (3, 2))
+        self.assertEqual(report["incomplete"], [lost])
+        self.assertEqual(list(report["failed"]), [invalid])
+
+if __name__ == '__main__':
+    unittest.main()
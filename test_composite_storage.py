@@ -0,0 +1,161 @@
+import contextlib
+import io
+import unittest
+import threading
+from unittest.mock import MagicMock
+import boto3
+from moto import mock_aws
+from widget_processor import CompositeStorage, Wiget_Processor
+from config import ConsumerConfig, parse_args
+
+
+class FakeSink:
+    """Acks straight away, or fails / blocks on demand."""
+    def __init__(self, fail=False, gate=None):
+        self.fail = fail
+        self.gate = gate
+        self.stored = []
+
+    def store_widget(self, request_data, ack=None, on_failure=None):
+        if self.gate is not None:
+            self.gate.wait(5)
+        if self.fail:
+            raise RuntimeError("sink down")
+        self.stored.append(request_data['widgetId'])
+        if ack:
+            ack()
+
+    update_widget = delete_widget = store_widget
+
+
+class TestCompositeStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.widget = {"type": "create", "widgetId": "w1", "owner": "Sue Smith"}
+
+    def test_all_policy_acks_once_after_every_sink(self):
+        """Tests that 'all' acks once every sink wrote the widget and fails if any sink fails."""
+        sinks = [("s3", FakeSink()), ("dynamodb", FakeSink())]
+        composite = CompositeStorage(sinks, policy='all')
+        ack = MagicMock()
+        composite.store_widget(self.widget, ack)
+        ack.assert_called_once()
+        self.assertEqual([sink.stored for _, sink in sinks], [["w1"], ["w1"]])
+
+        failing = CompositeStorage([("up", FakeSink()), ("down", FakeSink(fail=True))], policy='all')
+        ack = MagicMock()
+        with self.assertRaises(RuntimeError):
+            failing.store_widget(self.widget, ack)
+        ack.assert_not_called()
+        self.assertEqual(failing.latency_stats()["up"]["count"], 1)
+        composite.close()
+        failing.close()
+
+    def test_quorum_policy_tolerates_a_minority_of_failures(self):
+        """Tests that 'quorum' succeeds with 2 of 3 sinks and fails with 1 of 3."""
+        composite = CompositeStorage([("a", FakeSink()), ("b", FakeSink(fail=True)), ("c", FakeSink())], policy='quorum')
+        ack = MagicMock()
+        composite.store_widget(self.widget, ack)
+        ack.assert_called_once()
+        composite.close()
+
+        composite = CompositeStorage([("a", FakeSink()), ("b", FakeSink(fail=True)), ("c", FakeSink(fail=True))], policy='quorum')
+        with self.assertRaises(RuntimeError):
+            composite.store_widget(self.widget, MagicMock())
+        composite.close()
+
+    def test_primary_policy_does_not_wait_for_secondaries(self):
+        """Tests that 'primary' acks on the primary's write while a slow secondary is still writing."""
+        gate = threading.Event()
+        secondary = FakeSink(fail=True, gate=gate)
+        composite = CompositeStorage([("dynamodb", FakeSink()), ("s3", secondary)], policy='primary')
+        ack = MagicMock()
+        composite.store_widget(self.widget, ack)
+        ack.assert_called_once()
+
+        # the secondary's failure is only counted
+        gate.set()
+        composite.close()
+        ack.assert_called_once()
+
+    def test_primary_policy_bounds_pending_secondary_writes(self):
+        """Tests that 'primary' stops taking requests once max_pending secondary writes are outstanding."""
+        gate = threading.Event()
+        secondary = FakeSink(gate=gate)
+        composite = CompositeStorage([("dynamodb", FakeSink()), ("s3", secondary)], policy='primary',
+                                     max_workers=1, max_pending=2)
+        composite.store_widget(self.widget, MagicMock())
+        composite.store_widget(self.widget, MagicMock())
+
+        third = threading.Thread(target=composite.store_widget, args=(self.widget, MagicMock()))
+        third.start()
+        third.join(0.2)
+        self.assertTrue(third.is_alive())
+
+        gate.set()
+        third.join(5)
+        self.assertFalse(third.is_alive())
+        composite.close()
+        self.assertEqual(secondary.stored, ["w1"] * 3)
+
+    def test_deferred_sink_failure_reaches_on_failure_once(self):
+        """Tests that a sink whose batched write fails later fails the request through on_failure, once."""
+        class DeferredFailingSink(FakeSink):
+            def store_widget(self, request_data, ack=None, on_failure=None):
+                on_failure(RuntimeError("batch rejected"))
+
+        composite = CompositeStorage([("a", FakeSink()), ("b", DeferredFailingSink()), ("c", DeferredFailingSink())],
+                                     policy='quorum')
+        ack, on_failure = MagicMock(), MagicMock()
+        composite.store_widget(self.widget, ack, on_failure)
+        composite.close()
+        ack.assert_not_called()
+        on_failure.assert_called_once()
+
+
+class TestFanOutConfig(unittest.TestCase):
+
+    def test_also_store_to_flags(self):
+        """Tests that --also-store-to parses into extra sinks and can't repeat --storage-type."""
+        base = ['--storage-type', 'dynamodb', '--dynamodb-table-name', 'widgets']
+        with self.assertRaises(SystemExit):
+            parse_args(base + ['--also-store-to', 'dynamodb'])
+        stderr = io.StringIO()
+        with self.assertRaises(SystemExit), contextlib.redirect_stderr(stderr):
+            parse_args(base + ['--also-store-to', 's3', '--bucket-3-name', ''])
+        self.assertIn("--bucket-3-name is required when storing to 's3' (--storage-type or --also-store-to)", stderr.getvalue())
+        config = parse_args(base + ['--also-store-to', 's3', '--bucket-3-name', 'widgets', '--sink-policy', 'primary'])
+        self.assertEqual((config.extra_storage_types, config.sink_policy), (('s3',), 'primary'))
+
+    def test_processor_writes_to_s3_and_dynamodb(self):
+        """Tests that a processor with --also-store-to stores the widget in both backends."""
+        with mock_aws():
+            s3 = boto3.client('s3', region_name='us-east-1')
+            s3.create_bucket(Bucket='widgets-bucket')
+            boto3.client('dynamodb', region_name='us-east-1').create_table(
+                TableName='widgets',
+                KeySchema=[{'AttributeName': 'widgetId', 'KeyType': 'HASH'}],
+                AttributeDefinitions=[{'AttributeName': 'widgetId', 'AttributeType': 'S'}],
+                BillingMode='PAY_PER_REQUEST'
+            )
+            config = ConsumerConfig(storage_type='dynamodb', bucket_2_name='', bucket_3_name='widgets-bucket',
+                                    dynamodb_table_name='widgets', region_name='us-east-1', polling_delay_ms=100,
+                                    extra_storage_types=('s3',))
+            processor = Wiget_Processor(config)
+            ack = MagicMock()
+            processor.process(dict(self.widget(), type="create"), ack=ack)
+            processor.close()
+
+            ack.assert_called_once()
+            item = boto3.resource('dynamodb', region_name='us-east-1').Table('widgets').get_item(Key={'widgetId': 'w1'})
+            self.assertEqual(item['Item']['owner'], "Sue Smith")
+            s3.head_object(Bucket='widgets-bucket', Key='widgets/sue-smith/w1')
+
+    @staticmethod
+    def widget():
+        return {"requestId": "r1", "widgetId": "w1", "owner": "Sue Smith", "label": "L", "description": "D",
+                "otherAttributes": [{"name": "color", "value": "blue"}]}
+
+
+if __name__ == '__main__':
+    unittest.main()
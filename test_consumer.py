@@ -1,5 +1,104 @@
 import unittest
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 import json
 
 
+import threading
+import boto3
+from moto import mock_aws
+from botocore.exceptions import ClientError
+from config import ConsumerConfig
+from get_widget import S3RequestRetriever, RequestAcknowledger
+from widget_processor import Wiget_Processor
+import consumer
+
+
+class TestConsumer(unittest.TestCase):
+
+    def setUp(self):
+        self.MOCK_REQUEST_BUCKET = 'test-widget-requests'
+        self.MOCK_WIDGET_BUCKET = 'test-widgets-s3-bucket'
+        self.MOCK_REGION = 'us-east-1'
+
+        self.standard_widget_request = {"type":"create","requestId":"938b45ec-c22f-41d2-8b23-49d905cb4821","widgetId":"632240d7-6726-4793-b350-6b75fda2adf5","owner":"Sue Smith","label":"LVAGDCHGI","description":"TVGMYIFJHKWKHEXHHNUIBZWLPOYUKTNMUUAUTYANZGT","otherAttributes":[{"name":"color","value":"blue"},{"name":"height","value":"345"}]}
+
+        self.mock_config = ConsumerConfig(
+            storage_type='s3',
+            bucket_2_name=self.MOCK_REQUEST_BUCKET,
+            bucket_3_name=self.MOCK_WIDGET_BUCKET,
+            dynamodb_table_name='',
+            region_name=self.MOCK_REGION,
+            polling_delay_ms=100,
+            prefetch_size=10,
+            prefetch_low_water=2
+        )
+
+    @mock_aws
+    def test_worker_pool_processes_every_request(self):
+        """Tests that several workers drain the request bucket without dropping or duplicating widgets."""
+        s3_client = boto3.client('s3', region_name=self.MOCK_REGION)
+        s3_client.create_bucket(Bucket=self.MOCK_REQUEST_BUCKET)
+        s3_client.create_bucket(Bucket=self.MOCK_WIDGET_BUCKET)
+
+        for i in range(12):
+            request = dict(self.standard_widget_request, requestId=f"request-{i:02d}", widgetId=f"widget-{i:02d}")
+            s3_client.put_object(Bucket=self.MOCK_REQUEST_BUCKET, Key=request["requestId"], Body=json.dumps(request))
+
+        retriever, processor = consumer.init_consumer(self.mock_config)
+        acknowledger = RequestAcknowledger(retriever, batch_size=5, max_delay_ms=50)
+        stop_event = threading.Event()
+
+        # stop once the request bucket has been drained
+        def stop_when_drained():
+            while 'Contents' in s3_client.list_objects_v2(Bucket=self.MOCK_REQUEST_BUCKET):
+                stop_event.wait(0.05)
+            stop_event.set()
+        watcher = threading.Thread(target=stop_when_drained)
+        watcher.start()
+
+        consumer.run_consumer(retriever, processor, workers=4, max_in_flight=3, stop_event=stop_event,
+                              acknowledger=acknowledger)
+        watcher.join()
+        acknowledger.close()
+
+        stored = s3_client.list_objects_v2(Bucket=self.MOCK_WIDGET_BUCKET)['Contents']
+        self.assertEqual(sorted(obj['Key'] for obj in stored), [f"widgets/sue-smith/widget-{i:02d}" for i in range(12)])
+
+    def test_throttled_writes_pause_the_workers_without_holding_a_slot(self):
+        """Tests that throttles, also of coalesced writes, release the request and pause outside the in-flight slot."""
+        throttle = ClientError({'Error': {'Code': 'SlowDown', 'Message': 'slow down'}}, 'PutObject')
+        retriever = MagicMock()
+        retriever.get_next_request.side_effect = [("request-1", {}), ("request-2", {}), None]
+        processor = MagicMock()
+        # the first request is throttled in process(), the second later on the coalescer's thread
+        processor.process.side_effect = [throttle, None]
+        backoff = consumer.ThrottleBackoff(max_backoff_s=0.2)
+
+        self.assertTrue(consumer.handle_next_request(retriever, processor, MagicMock(), backoff=backoff))
+        self.assertTrue(consumer.handle_next_request(retriever, processor, MagicMock(), backoff=backoff))
+        processor.process.call_args.kwargs['on_failure'](throttle)
+        self.assertEqual([c.args[0] for c in retriever.release_request.call_args_list], ["request-1", "request-2"])
+
+        in_flight = threading.BoundedSemaphore(1)
+        stop_event = threading.Event()
+        slots_free = []
+        def wait(event):
+            # the worker pauses here, its slot has to be free for others meanwhile
+            slots_free.append(in_flight.acquire(blocking=False))
+            in_flight.release()
+            event.set()
+        with patch.object(backoff, 'wait', side_effect=wait):
+            consumer.run_worker(retriever, processor, stop_event, in_flight, MagicMock(), backoff=backoff)
+        self.assertEqual(slots_free, [True])
+
+    def test_every_worker_gets_its_own_scheduler(self):
+        """Tests that the workers of one consumer don't share a poll backoff."""
+        schedulers = []
+        def run_worker(retriever, processor, stop_event, in_flight, scheduler, *args):
+            schedulers.append(scheduler)
+        with patch.object(consumer, 'run_worker', side_effect=run_worker):
+            consumer.run_consumer(MagicMock(), MagicMock(), workers=4, max_in_flight=4, stop_event=threading.Event())
+        self.assertEqual(len({id(scheduler) for scheduler in schedulers}), 4)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import unittest
+from unittest.mock import patch
+import json
+import os
+import tempfile
+
+import boto3
+from moto import mock_aws
+from config import ConsumerConfig
+from dedup import RequestDedupCache
+from metrics import METRICS
+from widget_processor import Wiget_Processor
+
+
+class TestRequestDedupCache(unittest.TestCase):
+
+    def test_lru_eviction_and_ttl(self):
+        """Tests that the least recently used ids are evicted first and expired ids are misses."""
+        cache = RequestDedupCache(max_entries=2, ttl_s=60)
+        cache.add("a")
+        cache.add("b")
+        self.assertTrue(cache.contains("a"))  # a is now the most recently used
+        cache.add("c")
+        self.assertFalse(cache.contains("b"))
+        self.assertTrue(cache.contains("c"))
+        self.assertEqual(cache.stats(), {"entries": 2, "hits": 2, "misses": 1})
+
+        with patch('dedup.time.time', return_value=cache._entries["a"] + 61):
+            self.assertFalse(cache.contains("a"))
+
+    def test_journal_survives_restart_and_compacts(self):
+        """Tests that completed ids are reloaded from the journal, skipping torn lines and expired ids."""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "dedup.jsonl")
+            cache = RequestDedupCache(max_entries=3, ttl_s=60, path=path)
+            for request_id in ("a", "b", "c", "d", "e", "f", "g"):
+                cache.add(request_id)
+            cache.close()
+            # compacted once it passed twice the cache size
+            with open(path) as journal:
+                self.assertLess(len(journal.readlines()), 7)
+            with open(path, 'a') as journal:
+                journal.write(json.dumps({"id": "old", "at": 0}) + "\n")
+                journal.write('{"id": "tor')
+
+            reloaded = RequestDedupCache(max_entries=3, ttl_s=60, path=path)
+            self.assertEqual(list(reloaded._entries), ["e", "f", "g"])
+            reloaded.close()
+
+
+    def test_journal_is_written_in_batches_and_entries_gauge_counts_every_cache(self):
+        """Tests that add() leaves the journal to the flusher and the gauge isn't taken over by the newest cache."""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "dedup.jsonl")
+            cache = RequestDedupCache(max_entries=10, ttl_s=60, path=path, flush_ms=60000)
+            other = RequestDedupCache(max_entries=10, ttl_s=60)
+            before = METRICS.gauge("widget_dedup_entries").value
+            cache.add("a")
+            cache.add("b")
+            other.add("c")
+            self.assertEqual(METRICS.gauge("widget_dedup_entries").value - before, 3)
+
+            self.assertEqual(os.path.getsize(path), 0)
+            cache.flush()
+            with open(path) as journal:
+                self.assertEqual([json.loads(line)["id"] for line in journal], ["a", "b"])
+            cache.close()
+
+
+class TestProcessorDedup(unittest.TestCase):
+
+    @mock_aws
+    def test_repeated_request_is_acked_without_a_second_write(self):
+        """Tests that a requestId seen before short-circuits before any call to S3."""
+        s3_client = boto3.client('s3', region_name='us-east-1')
+        s3_client.create_bucket(Bucket='test-widgets-s3-bucket')
+        config = ConsumerConfig(
+            storage_type='s3',
+            bucket_2_name='test-widget-requests',
+            bucket_3_name='test-widgets-s3-bucket',
+            dynamodb_table_name='',
+            region_name='us-east-1',
+            polling_delay_ms=100,
+            dedup_cache_size=10
+        )
+        request = {"type": "create", "requestId": "req-1", "widgetId": "w-1", "owner": "Sue Smith",
+                   "label": "L", "description": "D"}
+        processor = Wiget_Processor(config)
+        acks = []
+
+        with patch.object(processor._storage_strategy.client, 'put_object',
+                          wraps=processor._storage_strategy.client.put_object) as put_object:
+            processor.process(request, ack=lambda: acks.append(1))
+            processor.process(dict(request), ack=lambda: acks.append(2))
+            self.assertEqual(put_object.call_count, 1)
+        self.assertEqual(acks, [1, 2])
+        processor.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
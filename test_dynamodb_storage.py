@@ -2,7 +2,10 @@ import unittest
 import json
 import boto3
 from moto import mock_aws
-from widget_processor import DynamoDBStorage
+from unittest.mock import MagicMock, patch
+from botocore.exceptions import ClientError
+from throttling import is_throttle_error
+from widget_processor import DynamoDBStorage, DynamoDBBatchWriter
 from config import ConsumerConfig
 
 class TestDynamoDBStorage(unittest.TestCase):
@@ -62,5 +65,175 @@ class TestDynamoDBStorage(unittest.TestCase):
             self.assertEqual(stored_item['description'], self.standard_widget_data['description'])
             self.assertEqual(stored_item['otherAttributes'], self.standard_widget_data['otherAttributes'])
 
+    def test_batched_store_acks_after_write(self):
+        """Tests that batch mode groups puts and only acks a widget once it is in the table."""
+        with mock_aws():
+            self.dynamodb_client = boto3.client('dynamodb', region_name=self.MOCK_REGION)
+            self.dynamodb_resource = boto3.resource('dynamodb', region_name=self.MOCK_REGION)
+            self.dynamodb_client.create_table(
+                TableName=self.MOCK_TABLE_NAME,
+                KeySchema=[{'AttributeName': 'widgetId', 'KeyType': 'HASH'}],
+                AttributeDefinitions=[{'AttributeName': 'widgetId', 'AttributeType': 'S'}],
+                ProvisionedThroughput={'ReadCapacityUnits': 1, 'WriteCapacityUnits': 1}
+            )
+            mock_config = ConsumerConfig(
+                storage_type='dynamodb',
+                bucket_2_name='',
+                bucket_3_name='',
+                dynamodb_table_name=self.MOCK_TABLE_NAME,
+                region_name=self.MOCK_REGION,
+                polling_delay_ms=100,
+                dynamodb_batch_size=25,
+                dynamodb_batch_max_latency_ms=60000
+            )
+            storage = DynamoDBStorage(mock_config)
+
+            acked = []
+            for i in range(30):
+                widget = dict(self.standard_widget_data, widgetId=f"widget-{i:02d}")
+                storage.store_widget(widget, ack=lambda i=i: acked.append(i))
+
+            # the first full batch went out, the last 5 are still waiting
+            self.assertEqual(acked, list(range(25)))
+            table = self.dynamodb_resource.Table(self.MOCK_TABLE_NAME)
+            self.assertNotIn('Item', table.get_item(Key={'widgetId': 'widget-29'}))
+
+            storage.close()
+            self.assertEqual(acked, list(range(30)))
+            self.assertEqual(table.scan()['Count'], 30)
+
+    def test_update_and_delete_widget_dynamodb(self):
+        """Tests that updates apply on top of a put still waiting in the batch and deletes go through the batch."""
+        with mock_aws():
+            dynamodb_client = boto3.client('dynamodb', region_name=self.MOCK_REGION)
+            dynamodb_client.create_table(
+                TableName=self.MOCK_TABLE_NAME,
+                KeySchema=[{'AttributeName': 'widgetId', 'KeyType': 'HASH'}],
+                AttributeDefinitions=[{'AttributeName': 'widgetId', 'AttributeType': 'S'}],
+                ProvisionedThroughput={'ReadCapacityUnits': 1, 'WriteCapacityUnits': 1}
+            )
+            storage = DynamoDBStorage(ConsumerConfig(
+                storage_type='dynamodb',
+                bucket_2_name='',
+                bucket_3_name='',
+                dynamodb_table_name=self.MOCK_TABLE_NAME,
+                region_name=self.MOCK_REGION,
+                polling_delay_ms=100,
+                dynamodb_batch_size=25,
+                dynamodb_batch_max_latency_ms=60000
+            ))
+            table = boto3.resource('dynamodb', region_name=self.MOCK_REGION).Table(self.MOCK_TABLE_NAME)
+            other = dict(self.standard_widget_data, widgetId="other-widget")
+
+            storage.store_widget(self.standard_widget_data)
+            storage.store_widget(other)
+            storage.update_widget(dict(self.standard_widget_data, type="update", label="NEW-LABEL",
+                                       otherAttributes=[{"name": "color", "value": "red"}]))
+            storage.flush()
+            stored = table.get_item(Key={'widgetId': self.standard_widget_data['widgetId']})['Item']
+            self.assertEqual(stored['label'], "NEW-LABEL")
+            self.assertEqual(stored['otherAttributes'][0], {"name": "color", "value": "red"})
+
+            # an update of a stored widget reads it from the table
+            storage.update_widget(dict(other, type="update", description="NEW-DESCRIPTION"))
+            storage.delete_widget(dict(self.standard_widget_data, type="delete"))
+            storage.close()
+            self.assertNotIn('Item', table.get_item(Key={'widgetId': self.standard_widget_data['widgetId']}))
+            self.assertEqual(table.get_item(Key={'widgetId': 'other-widget'})['Item']['description'], "NEW-DESCRIPTION")
+
+    def test_update_is_conditional_on_the_version_read(self):
+        """Tests that an update whose item changed after it was read is read and applied again."""
+        with mock_aws():
+            dynamodb_client = boto3.client('dynamodb', region_name=self.MOCK_REGION)
+            dynamodb_client.create_table(
+                TableName=self.MOCK_TABLE_NAME,
+                KeySchema=[{'AttributeName': 'widgetId', 'KeyType': 'HASH'}],
+                AttributeDefinitions=[{'AttributeName': 'widgetId', 'AttributeType': 'S'}],
+                ProvisionedThroughput={'ReadCapacityUnits': 1, 'WriteCapacityUnits': 1}
+            )
+            config = ConsumerConfig(
+                storage_type='dynamodb',
+                bucket_2_name='',
+                bucket_3_name='',
+                dynamodb_table_name=self.MOCK_TABLE_NAME,
+                region_name=self.MOCK_REGION,
+                polling_delay_ms=100
+            )
+            storage = DynamoDBStorage(config)
+            widget_id = self.standard_widget_data['widgetId']
+            storage.store_widget(self.standard_widget_data)
+            table = boto3.resource('dynamodb', region_name=self.MOCK_REGION).Table(self.MOCK_TABLE_NAME)
+
+            get_item = storage.table.get_item
+            reads = []
+            def racing_get_item(**kwargs):
+                item = get_item(**kwargs)
+                if not reads:
+                    # another consumer updates the widget between our read and our write
+                    table.put_item(Item=dict(item["Item"], description="THEIRS", version=1))
+                reads.append(kwargs)
+                return item
+
+            with patch.object(storage.table, 'get_item', side_effect=racing_get_item):
+                storage.update_widget(dict(self.standard_widget_data, type="update", label="OURS", description=None))
+            stored = table.get_item(Key={'widgetId': widget_id})['Item']
+            self.assertEqual(len(reads), 2)
+            self.assertEqual((stored['label'], stored['description']), ("OURS", "THEIRS"))
+            self.assertEqual(stored['version'], 2)
+
+    def test_unprocessed_items_are_retried(self):
+        """Tests that UnprocessedItems are resent and acked only once they are written."""
+        class ThrottlingClient:
+            def __init__(self):
+                self.calls = []
+
+            def batch_write_item(self, RequestItems):
+                requests = RequestItems['widgets']
+                self.calls.append([r['PutRequest']['Item']['widgetId'] for r in requests])
+                # the first call only manages to write the first item
+                if len(self.calls) == 1:
+                    return {'UnprocessedItems': {'widgets': requests[1:]}}
+                return {'UnprocessedItems': {}}
+
+        client = ThrottlingClient()
+        writer = DynamoDBBatchWriter('widgets', client_getter=lambda: client, batch_size=3,
+                                     max_latency_ms=60000, base_backoff_ms=1)
+        acked = []
+        for widget_id in ['a', 'b', 'c']:
+            writer.add({'widgetId': widget_id}, ack=lambda w=widget_id: acked.append(w))
+        writer.close()
+
+        self.assertEqual(client.calls, [['a', 'b', 'c'], ['b', 'c']])
+        self.assertEqual(acked, ['a', 'b', 'c'])
+
+    def test_failed_batch_fails_every_item_in_it(self):
+        """Tests that a rejected batch reaches every item's on_failure instead of the add() that filled it."""
+        error = ClientError({'Error': {'Code': 'ValidationException', 'Message': 'bad item'}}, 'BatchWriteItem')
+        client = MagicMock()
+        client.batch_write_item.side_effect = error
+        writer = DynamoDBBatchWriter('widgets', client_getter=lambda: client, batch_size=3, max_latency_ms=60000)
+        acks, failures = MagicMock(), MagicMock()
+        for widget_id in ['a', 'b', 'c']:
+            writer.add({'widgetId': widget_id}, getattr(acks, widget_id), getattr(failures, widget_id))
+        writer.close()
+
+        self.assertEqual(acks.method_calls, [])
+        for widget_id in ['a', 'b', 'c']:
+            getattr(failures, widget_id).assert_called_once_with(error)
+
+    def test_items_left_unprocessed_fail_as_throttled(self):
+        """Tests that items DynamoDB still hasn't taken after the last retry are failed as throttled."""
+        client = MagicMock()
+        client.batch_write_item.side_effect = lambda RequestItems: {'UnprocessedItems': RequestItems}
+        writer = DynamoDBBatchWriter('widgets', client_getter=lambda: client, batch_size=2, max_latency_ms=60000,
+                                     max_retries=1, base_backoff_ms=1)
+        failures = []
+        writer.add({'widgetId': 'a'}, on_failure=failures.append)
+        writer.add({'widgetId': 'b'}, on_failure=failures.append)
+        writer.close()
+
+        self.assertEqual(len(failures), 2)
+        self.assertTrue(all(is_throttle_error(error) for error in failures))
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,159 @@
+import unittest
+from unittest.mock import MagicMock, patch
+import json
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+
+import boto3
+from moto import mock_aws
+from config import ConsumerConfig
+import event_handler
+
+
+def s3_event(bucket, *keys, event_name='ObjectCreated:Put'):
+    return {"Records": [
+        {"eventSource": "aws:s3", "eventName": event_name,
+         "s3": {"bucket": {"name": bucket}, "object": {"key": key}}}
+        for key in keys
+    ]}
+
+
+class TestEventHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.MOCK_REQUEST_BUCKET = 'test-widget-requests'
+        self.MOCK_WIDGET_BUCKET = 'test-widgets-s3-bucket'
+        self.MOCK_REGION = 'us-east-1'
+
+        self.standard_widget_request = {"type":"create","requestId":"938b45ec-c22f-41d2-8b23-49d905cb4821","widgetId":"632240d7-6726-4793-b350-6b75fda2adf5","owner":"Sue Smith","label":"LVAGDCHGI","description":"TVGMYIFJHKWKHEXHHNUIBZWLPOYUKTNMUUAUTYANZGT","otherAttributes":[{"name":"color","value":"blue"},{"name":"height","value":"345"}]}
+
+        self.mock_config = ConsumerConfig(
+            storage_type='s3',
+            bucket_2_name=self.MOCK_REQUEST_BUCKET,
+            bucket_3_name=self.MOCK_WIDGET_BUCKET,
+            dynamodb_table_name='',
+            region_name=self.MOCK_REGION,
+            polling_delay_ms=100
+        )
+
+    def _create_buckets(self):
+        s3_client = boto3.client('s3', region_name=self.MOCK_REGION)
+        s3_client.create_bucket(Bucket=self.MOCK_REQUEST_BUCKET)
+        s3_client.create_bucket(Bucket=self.MOCK_WIDGET_BUCKET)
+        return s3_client
+
+    @mock_aws
+    def test_event_keys_are_processed_and_deleted_without_listing(self):
+        """Tests that the keys named in an S3 notification are stored and deleted with no LIST call."""
+        s3_client = self._create_buckets()
+        s3_client.put_object(Bucket=self.MOCK_REQUEST_BUCKET, Key="request 1", Body=json.dumps(self.standard_widget_request))
+        s3_client.put_object(Bucket=self.MOCK_REQUEST_BUCKET, Key="request-2", Body=b"{not json")
+
+        processor = event_handler.EventProcessor(self.mock_config)
+        with patch.object(processor.retriever.s3_client, 'list_objects_v2') as list_objects:
+            result = processor.handle_event(s3_event(self.MOCK_REQUEST_BUCKET, "request+1", "request-2"))
+            list_objects.assert_not_called()
+
+        self.assertEqual(result['processed'], 1)
+        self.assertEqual(result['quarantined'], 1)
+        self.assertEqual(result['failed'], [])
+        remaining = [obj['Key'] for obj in s3_client.list_objects_v2(Bucket=self.MOCK_REQUEST_BUCKET).get('Contents', [])]
+        self.assertEqual(remaining, ["dead-letter/request-2"])
+        stored = s3_client.list_objects_v2(Bucket=self.MOCK_WIDGET_BUCKET)['Contents']
+        self.assertEqual(stored[0]['Key'], "widgets/sue-smith/632240d7-6726-4793-b350-6b75fda2adf5")
+
+    @mock_aws
+    def test_sqs_wrapped_failures_are_reported_per_message(self):
+        """Tests that SQS-delivered notifications are unwrapped and failed messages are reported for redelivery."""
+        s3_client = self._create_buckets()
+        s3_client.put_object(Bucket=self.MOCK_REQUEST_BUCKET, Key="request-1", Body=json.dumps(self.standard_widget_request))
+        s3_client.put_object(Bucket=self.MOCK_REQUEST_BUCKET, Key="request-2", Body=json.dumps(self.standard_widget_request))
+        event = {"Records": [
+            {"eventSource": "aws:sqs", "messageId": f"msg-{key}", "body": json.dumps(s3_event(self.MOCK_REQUEST_BUCKET, key))}
+            for key in ("request-1", "request-2")
+        ]}
+
+        processor = event_handler.EventProcessor(self.mock_config)
+        real_store = processor.processor._storage_strategy.store_widget
+        def flaky_store(request_data, ack=None, on_failure=None):
+            if flaky_store.calls == 1:
+                raise RuntimeError("storage unavailable")
+            flaky_store.calls += 1
+            real_store(request_data, ack, on_failure)
+        flaky_store.calls = 0
+
+        with patch.object(event_handler, '_event_processor', processor), \
+                patch.object(processor.processor._storage_strategy, 'store_widget', side_effect=flaky_store):
+            response = event_handler.handler(event)
+
+        self.assertEqual(response, {'batchItemFailures': [{'itemIdentifier': 'msg-request-2'}]})
+        remaining = [obj['Key'] for obj in s3_client.list_objects_v2(Bucket=self.MOCK_REQUEST_BUCKET)['Contents']]
+        self.assertEqual(remaining, ["request-2"])
+
+    @mock_aws
+    def test_own_writes_are_not_picked_up_as_requests(self):
+        """Tests that dead-letter copies in Bucket 2 and attempt counts don't come back as new requests."""
+        s3_client = self._create_buckets()
+        s3_client.put_object(Bucket=self.MOCK_REQUEST_BUCKET, Key="request-1", Body=b"{not json")
+        s3_client.put_object(Bucket=self.MOCK_REQUEST_BUCKET, Key="request-2", Body=json.dumps(self.standard_widget_request))
+
+        processor = event_handler.EventProcessor(self.mock_config)
+        self.assertEqual(processor.handle_event(s3_event(self.MOCK_REQUEST_BUCKET, "request-1"))['quarantined'], 1)
+        # S3 notifies about the dead-letter copy as well
+        result = processor.handle_event(s3_event(self.MOCK_REQUEST_BUCKET, "dead-letter/request-1",
+                                                 event_name='ObjectCreated:Copy'))
+        self.assertEqual((result['processed'], result['quarantined'], result['failed']), (0, 0, []))
+
+        # a failed attempt is counted without rewriting the request, so it sends no notification of its own
+        with patch.object(processor.processor._storage_strategy, 'store_widget', side_effect=RuntimeError("down")), \
+                patch.object(processor.retriever.s3_client, 'copy_object') as copy_object:
+            result = processor.handle_event(s3_event(self.MOCK_REQUEST_BUCKET, "request-2"))
+            copy_object.assert_not_called()
+        self.assertEqual(result['failed'], ["request-2"])
+        self.assertEqual(processor.retriever.request_attempts("request-2"), 1)
+
+        remaining = [obj['Key'] for obj in s3_client.list_objects_v2(Bucket=self.MOCK_REQUEST_BUCKET)['Contents']]
+        self.assertEqual(remaining, ["dead-letter/request-1", "request-2"])
+
+    @mock_aws
+    def test_local_queue_drives_the_processor(self):
+        """Tests the local stand-in event source."""
+        s3_client = self._create_buckets()
+        s3_client.put_object(Bucket=self.MOCK_REQUEST_BUCKET, Key="request-1", Body=json.dumps(self.standard_widget_request))
+
+        event_queue = queue.Queue()
+        stop_event = threading.Event()
+        processor = event_handler.EventProcessor(self.mock_config)
+        worker = threading.Thread(target=event_handler.run_local_queue, args=(event_queue, processor, stop_event, 0.05))
+        worker.start()
+        event_queue.put(s3_event(self.MOCK_REQUEST_BUCKET, "request-1"))
+        event_queue.put(s3_event(self.MOCK_REQUEST_BUCKET, "request-1", event_name='ObjectRemoved:Delete'))
+        event_queue.join()
+        stop_event.set()
+        worker.join()
+
+        self.assertNotIn('Contents', s3_client.list_objects_v2(Bucket=self.MOCK_REQUEST_BUCKET))
+
+    def test_injected_parts_need_no_clients(self):
+        """Tests that a processor built from an injected retriever and processor builds no AWS clients."""
+        with patch.object(event_handler.ClientFactory, 'from_config') as from_config:
+            processor = event_handler.EventProcessor(self.mock_config, retriever=MagicMock(), processor=MagicMock())
+        from_config.assert_not_called()
+        self.assertIsInstance(processor.quarantine, event_handler.RequestQuarantine)
+
+    def test_import_has_no_side_effects(self):
+        """Tests that importing the handler doesn't create log directories or install logging handlers."""
+        with tempfile.TemporaryDirectory() as workdir:
+            script = ("import logging, event_handler; "
+                      "assert not logging.getLogger().handlers, logging.getLogger().handlers")
+            env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(event_handler.__file__)))
+            subprocess.run([sys.executable, "-c", script], cwd=workdir, env=env, check=True)
+            self.assertEqual(os.listdir(workdir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
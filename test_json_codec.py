@@ -0,0 +1,61 @@
+import unittest
+import importlib.util
+import json
+import json_codec
+from json_codec import get_codec
+
+
+class TestJsonCodec(unittest.TestCase):
+
+    def setUp(self):
+        self.request = {"type": "create", "requestId": "r1", "widgetId": "w1", "owner": "Zoë Smith",
+                        "otherAttributes": [{"name": "note", "value": "x" * 300}]}
+
+    def _codecs(self):
+        names = ['stdlib'] + (['orjson'] if importlib.util.find_spec('orjson') else [])
+        return [get_codec(name) for name in names]
+
+    def test_codecs_round_trip_bytes(self):
+        """Tests that every codec parses UTF-8 bytes and serializes back to bytes the stdlib reads."""
+        body = json.dumps(self.request).encode('utf-8')
+        for codec in self._codecs():
+            with self.subTest(codec=codec.name):
+                self.assertEqual(codec.loads(body), self.request)
+                encoded = codec.dumps(self.request, compact=True)
+                self.assertIsInstance(encoded, bytes)
+                self.assertNotIn(b', ', encoded)
+                self.assertEqual(json.loads(encoded), self.request)
+                # orjson only writes 64-bit integers, the stdlib takes over
+                self.assertEqual(json.loads(codec.dumps({"quantity": 2 ** 70})), {"quantity": 2 ** 70})
+
+    def test_default_output_reads_back_the_same(self):
+        """Tests that non-compact output, the default for stored bodies, reads back as the same value with every codec."""
+        for codec in self._codecs():
+            with self.subTest(codec=codec.name):
+                encoded = codec.dumps(self.request)
+                self.assertIsInstance(encoded, bytes)
+                self.assertEqual(json.loads(encoded), self.request)
+
+    def test_malformed_bodies_raise_value_error(self):
+        """Tests that bad JSON and bodies that aren't UTF-8 both surface as ValueError."""
+        for codec in self._codecs():
+            with self.subTest(codec=codec.name):
+                with self.assertRaises(ValueError):
+                    codec.loads(b'{"type": "create",')
+                with self.assertRaises(ValueError):
+                    codec.loads(b'{"owner": "\xff\xfe"}')
+
+    def test_use_codec(self):
+        """Tests switching the process-wide codec and rejecting unknown ones."""
+        previous = json_codec.codec().name
+        try:
+            self.assertEqual(json_codec.use_codec('stdlib').name, 'stdlib')
+            self.assertEqual(json_codec.dumps({"a": 1}), b'{"a": 1}')
+        finally:
+            json_codec.use_codec('auto' if previous == 'orjson' else previous)
+        with self.assertRaises(ValueError):
+            get_codec('simdjson')
+
+
+if __name__ == '__main__':
+    unittest.main()
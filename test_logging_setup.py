@@ -0,0 +1,89 @@
+import unittest
+import logging
+import os
+import queue
+import tempfile
+import time
+from logging_setup import RateLimitFilter, configure_logging, _DeferredQueueHandler
+
+
+class TestLoggingSetup(unittest.TestCase):
+
+    def setUp(self):
+        # configure_logging replaces the root handlers, put the test runner's back afterwards
+        root = logging.getLogger()
+        saved_handlers, saved_level = list(root.handlers), root.level
+        def restore():
+            for handler in list(root.handlers):
+                root.removeHandler(handler)
+                handler.close()
+            for handler in saved_handlers:
+                root.addHandler(handler)
+            root.setLevel(saved_level)
+        self.addCleanup(restore)
+
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def _read_log(self):
+        with open(os.path.join(self.tmp_dir.name, "consumer.log")) as f:
+            return f.read()
+
+    def test_rate_limit_filter_suppresses_and_summarizes(self):
+        """Tests that only max_per_interval lines per template pass and the rest are summarized."""
+        rate_limiter = RateLimitFilter(max_per_interval=2, interval_s=3600)
+        hot_logger = logging.getLogger("get_widget")
+
+        allowed = [rate_limiter.filter(hot_logger.makeRecord("get_widget", logging.INFO, __file__, 1,
+                                                             "Found request: %s", (i,), None))
+                   for i in range(5)]
+        self.assertEqual(allowed, [True, True, False, False, False])
+
+        # warnings are never dropped
+        warning = hot_logger.makeRecord("get_widget", logging.WARNING, __file__, 1, "Malformed JSON in %s", ("k",), None)
+        self.assertTrue(rate_limiter.filter(warning))
+
+        with self.assertLogs("logging_setup", level="INFO") as logs:
+            rate_limiter.flush_summary()
+        self.assertIn("Suppressed 3 log lines", logs.output[0])
+        self.assertIn("Found request: %s", logs.output[0])
+
+    def test_async_logging_writes_through_background_listener(self):
+        """Tests that async mode formats and writes records on the listener thread and drains them on close."""
+        handle = configure_logging(log_dir=self.tmp_dir.name, async_logging=True, rate_limit=1, summary_interval_s=3600)
+        self.assertIsNotNone(handle.listener)
+
+        hot_logger = logging.getLogger("widget_processor")
+        for i in range(3):
+            hot_logger.info("S3 Strategy: Storing widget %s in %s", f"widget-{i}", "bucket")
+        handle.close()
+
+        log = self._read_log()
+        self.assertIn("S3 Strategy: Storing widget widget-0 in bucket", log)
+        self.assertNotIn("widget-1", log)
+        self.assertIn("Suppressed 2 log lines", log)
+
+    def test_summary_is_logged_when_the_interval_ends(self):
+        """Tests that a burst followed by silence still gets its summary line."""
+        rate_limiter = RateLimitFilter(max_per_interval=1, interval_s=0.1)
+        with self.assertLogs("logging_setup", level="INFO") as logs:
+            rate_limiter.start_summary_timer()
+            for i in range(3):
+                rate_limiter.filter(logging.getLogger("get_widget").makeRecord(
+                    "get_widget", logging.INFO, __file__, 1, "Found request: %s", (i,), None))
+            time.sleep(0.3)
+            rate_limiter.stop_summary_timer()
+        self.assertIn("Suppressed 2 log lines", logs.output[0])
+
+    def test_queued_records_keep_the_args_they_were_logged_with(self):
+        """Tests that the queue handler renders the message before a mutable arg can change."""
+        handler = _DeferredQueueHandler(queue.SimpleQueue())
+        widget = {"label": "before"}
+        record = logging.getLogger("widget_processor").makeRecord(
+            "widget_processor", logging.INFO, __file__, 1, "Storing %s", (widget,), None)
+        prepared = handler.prepare(record)
+        widget["label"] = "after"
+        self.assertEqual(logging.Formatter("%(message)s").format(prepared), "Storing {'label': 'before'}")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+import urllib.request
+from metrics import MetricsRegistry, Histogram, start_metrics_server
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram_buckets_and_quantiles(self):
+        """Tests that observations land in the right buckets and quantiles are estimated inside them."""
+        histogram = Histogram(buckets=(0.01, 0.1, 1.0))
+        for value in (0.005, 0.01, 0.05, 0.5, 2.0):
+            histogram.observe(value)
+
+        counts, total, count = histogram.snapshot()
+        self.assertEqual(counts, [2, 1, 1, 1])
+        self.assertEqual(count, 5)
+        self.assertAlmostEqual(total, 2.565)
+        self.assertLessEqual(histogram.quantile(0.5), 0.1)
+        self.assertGreater(histogram.quantile(0.5), 0.01)
+
+    def test_registry_renders_prometheus_text(self):
+        """Tests that the registry reuses handles and renders counters, gauges and histograms."""
+        registry = MetricsRegistry()
+        self.assertIs(registry.stage("get"), registry.stage("get"))
+
+        registry.counter("widget_requests_total", "Requests.", outcome="processed").inc(3)
+        registry.gauge("widget_request_buffer_depth", "Depth.").set_function(lambda: 7)
+        with registry.stage("get").time():
+            pass
+
+        text = registry.render_prometheus()
+        self.assertIn('# TYPE widget_requests_total counter', text)
+        self.assertIn('widget_requests_total{outcome="processed"} 3.0', text)
+        self.assertIn('widget_request_buffer_depth 7.0', text)
+        self.assertIn('widget_stage_seconds_bucket{stage="get",le="+Inf"} 1', text)
+        self.assertIn('widget_stage_seconds_count{stage="get"} 1', text)
+
+        registry.reset()
+        self.assertEqual(registry.snapshot()['widget_requests_total{outcome="processed"}'], 0.0)
+
+    def test_metrics_endpoint_serves_registry(self):
+        """Tests the local HTTP endpoint."""
+        registry = MetricsRegistry()
+        registry.counter("widget_empty_polls_total", "Empty polls.").inc()
+        server = start_metrics_server(0, registry)
+        self.addCleanup(server.shutdown)
+
+        url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+        with urllib.request.urlopen(url) as response:
+            body = response.read().decode("utf-8")
+        self.assertIn("widget_empty_polls_total 1.0", body)
+
+if __name__ == '__main__':
+    unittest.main()
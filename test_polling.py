@@ -0,0 +1,35 @@
+import unittest
+from polling import PollScheduler
+
+
+class TestPollScheduler(unittest.TestCase):
+
+    def test_backoff_grows_to_ceiling_and_resets_on_work(self):
+        """Tests that empty polls back off exponentially up to the ceiling and work resets the delay."""
+        scheduler = PollScheduler(base_delay_ms=100, max_delay_ms=1000, jitter=0)
+
+        delays = [scheduler.next_delay() for _ in range(6)]
+        self.assertEqual(delays, [0.1, 0.2, 0.4, 0.8, 1.0, 1.0])
+
+        scheduler.record_request()
+        self.assertEqual(scheduler.empty_polls, 0)
+        self.assertEqual(scheduler.next_delay(), 0.1)
+
+    def test_jitter_stays_within_bounds(self):
+        """Tests that jittered delays never exceed the un-jittered delay or drop below the kept share."""
+        scheduler = PollScheduler(base_delay_ms=200, max_delay_ms=200, jitter=0.5)
+        for _ in range(50):
+            delay = scheduler.next_delay()
+            self.assertGreaterEqual(delay, 0.1)
+            self.assertLessEqual(delay, 0.2)
+
+    def test_workers_back_off_on_their_own_count(self):
+        """Tests that each worker's scheduler keeps the settings but counts only its own empty polls."""
+        shared = PollScheduler(base_delay_ms=100, max_delay_ms=1000, jitter=0)
+        first, second = shared.for_worker(), shared.for_worker()
+        self.assertEqual([first.next_delay() for _ in range(3)], [0.1, 0.2, 0.4])
+        self.assertEqual(second.next_delay(), 0.1)
+        self.assertEqual((second.max_delay_s, second.jitter), (1.0, 0))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import unittest
+import json
+from unittest.mock import patch
+import boto3
+from moto import mock_aws
+from config import ConsumerConfig
+from get_widget import S3RequestRetriever
+from widget_processor import Wiget_Processor
+from quarantine import RequestQuarantine
+import consumer
+
+
+class TestRequestQuarantine(unittest.TestCase):
+
+    def setUp(self):
+        self.MOCK_REQUEST_BUCKET = 'test-widget-requests'
+        self.MOCK_WIDGET_BUCKET = 'test-widgets-s3-bucket'
+        self.MOCK_REGION = 'us-east-1'
+
+        self.standard_widget_request = {"type":"create","requestId":"938b45ec-c22f-41d2-8b23-49d905cb4821","widgetId":"632240d7-6726-4793-b350-6b75fda2adf5","owner":"Sue Smith","label":"LVAGDCHGI","description":"TVGMYIFJHKWKHEXHHNUIBZWLPOYUKTNMUUAUTYANZGT","otherAttributes":[{"name":"color","value":"blue"}]}
+
+        self.mock_config = ConsumerConfig(
+            storage_type='s3',
+            bucket_2_name=self.MOCK_REQUEST_BUCKET,
+            bucket_3_name=self.MOCK_WIDGET_BUCKET,
+            dynamodb_table_name='',
+            region_name=self.MOCK_REGION,
+            polling_delay_ms=100
+        )
+
+    @mock_aws
+    def test_poison_requests_are_moved_out_of_the_way(self):
+        """Tests that malformed and invalid requests are quarantined and the request behind them still gets processed."""
+        s3_client = boto3.client('s3', region_name=self.MOCK_REGION)
+        s3_client.create_bucket(Bucket=self.MOCK_REQUEST_BUCKET)
+        s3_client.create_bucket(Bucket=self.MOCK_WIDGET_BUCKET)
+
+        s3_client.put_object(Bucket=self.MOCK_REQUEST_BUCKET, Key='request-0', Body=b'{"type": "create", ')
+        s3_client.put_object(Bucket=self.MOCK_REQUEST_BUCKET, Key='request-1',
+                             Body=json.dumps(dict(self.standard_widget_request, type='explode')))
+        s3_client.put_object(Bucket=self.MOCK_REQUEST_BUCKET, Key='request-2',
+                             Body=json.dumps(self.standard_widget_request))
+
+        retriever = S3RequestRetriever(bucket_name=self.MOCK_REQUEST_BUCKET, region_name=self.MOCK_REGION)
+        processor = Wiget_Processor(self.mock_config)
+        quarantine = RequestQuarantine(retriever)
+
+        for _ in range(3):
+            self.assertTrue(consumer.handle_next_request(retriever, processor, retriever.delete_request, quarantine))
+        self.assertFalse(consumer.handle_next_request(retriever, processor, retriever.delete_request, quarantine))
+
+        keys = [obj['Key'] for obj in s3_client.list_objects_v2(Bucket=self.MOCK_REQUEST_BUCKET)['Contents']]
+        self.assertEqual(keys, ['dead-letter/request-0', 'dead-letter/request-1'])
+
+        metadata = s3_client.head_object(Bucket=self.MOCK_REQUEST_BUCKET, Key='dead-letter/request-1')['Metadata']
+        self.assertEqual(metadata['attempts'], '1')
+        self.assertIn('unknown request type', metadata['error-reason'])
+
+        self.assertIn('Contents', s3_client.list_objects_v2(Bucket=self.MOCK_WIDGET_BUCKET))
+        stats = quarantine.stats()
+        self.assertEqual((stats['quarantined'], stats['decode_errors'], stats['invalid_requests']), (2, 1, 1))
+
+    @mock_aws
+    def test_repeated_failures_quarantine_after_max_attempts(self):
+        """Tests that a request that keeps failing is retried until max_attempts and then quarantined."""
+        s3_client = boto3.client('s3', region_name=self.MOCK_REGION)
+        s3_client.create_bucket(Bucket=self.MOCK_REQUEST_BUCKET)
+        s3_client.put_object(Bucket=self.MOCK_REQUEST_BUCKET, Key='request-0',
+                             Body=json.dumps(self.standard_widget_request))
+
+        class FailingProcessor:
+            def process(self, widget_data, ack=None):
+                raise RuntimeError("backend unavailable")
+
+        retriever = S3RequestRetriever(bucket_name=self.MOCK_REQUEST_BUCKET, region_name=self.MOCK_REGION)
+        quarantine = RequestQuarantine(retriever, max_attempts=3)
+
+        for _ in range(3):
+            consumer.handle_next_request(retriever, FailingProcessor(), retriever.delete_request, quarantine)
+
+        keys = [obj['Key'] for obj in s3_client.list_objects_v2(Bucket=self.MOCK_REQUEST_BUCKET)['Contents']]
+        self.assertEqual(keys, ['dead-letter/request-0'])
+        metadata = s3_client.head_object(Bucket=self.MOCK_REQUEST_BUCKET, Key='dead-letter/request-0')['Metadata']
+        self.assertEqual(metadata['attempts'], '3')
+        self.assertEqual(quarantine.stats()['processing_failures'], 3)
+
+    @mock_aws
+    def test_attempts_survive_a_restart_and_failed_quarantines_back_off(self):
+        """Tests that attempts are stored on the request and a request that can't be quarantined isn't retried at once."""
+        s3_client = boto3.client('s3', region_name=self.MOCK_REGION)
+        s3_client.create_bucket(Bucket=self.MOCK_REQUEST_BUCKET)
+        s3_client.put_object(Bucket=self.MOCK_REQUEST_BUCKET, Key='request-0',
+                             Body=json.dumps(self.standard_widget_request))
+
+        class FailingProcessor:
+            def process(self, widget_data, ack=None):
+                raise RuntimeError("backend unavailable")
+
+        retriever = S3RequestRetriever(bucket_name=self.MOCK_REQUEST_BUCKET, region_name=self.MOCK_REGION)
+        self.assertFalse(consumer.handle_next_request(retriever, FailingProcessor(), retriever.delete_request,
+                                                      RequestQuarantine(retriever, max_attempts=3)))
+
+        # a restarted consumer continues counting from the tag on the request
+        retriever = S3RequestRetriever(bucket_name=self.MOCK_REQUEST_BUCKET, region_name=self.MOCK_REGION)
+        quarantine = RequestQuarantine(retriever, max_attempts=3)
+        consumer.handle_next_request(retriever, FailingProcessor(), retriever.delete_request, quarantine)
+        self.assertEqual(retriever.request_attempts('request-0'), 2)
+
+        # the dead-letter copy fails, so the worker backs off instead of picking the same key up right away
+        with patch.object(retriever, 'quarantine_request', return_value=False):
+            self.assertFalse(consumer.handle_next_request(retriever, FailingProcessor(), retriever.delete_request, quarantine))
+        self.assertEqual(quarantine.stats()['quarantine_errors'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
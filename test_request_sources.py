@@ -0,0 +1,77 @@
+import unittest
+import json
+import os
+import tempfile
+from get_widget import S3RequestRetriever, RequestDecodeError
+from request_sources import RequestSource, JsonlFileSource, DirectorySource
+
+
+class TestRequestSources(unittest.TestCase):
+
+    def setUp(self):
+        self.standard_widget_request = {"type":"create","requestId":"938b45ec-c22f-41d2-8b23-49d905cb4821","widgetId":"632240d7-6726-4793-b350-6b75fda2adf5","owner":"Sue Smith","label":"LVAGDCHGI","description":"TVGMYIFJHKWKHEXHHNUIBZWLPOYUKTNMUUAUTYANZGT","otherAttributes":[{"name":"color","value":"blue"}]}
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def test_sources_implement_protocol(self):
+        """Tests that the S3 retriever and the local sources all satisfy RequestSource."""
+        path = os.path.join(self.tmp_dir.name, "requests.jsonl")
+        open(path, 'w').close()
+        jsonl_source = JsonlFileSource(path)
+        self.addCleanup(jsonl_source.close)
+
+        self.assertIsInstance(S3RequestRetriever(), RequestSource)
+        self.assertIsInstance(jsonl_source, RequestSource)
+        self.assertIsInstance(DirectorySource(self.tmp_dir.name), RequestSource)
+
+    def test_jsonl_source_streams_lines_in_order(self):
+        """Tests that the JSONL source hands out lines in order, retries released ones and quarantines bad ones."""
+        path = os.path.join(self.tmp_dir.name, "requests.jsonl")
+        with open(path, 'w') as f:
+            f.write(json.dumps(dict(self.standard_widget_request, requestId="r1")) + "\n")
+            f.write("{not json\n")
+            f.write("\n")
+            f.write(json.dumps(dict(self.standard_widget_request, requestId="r3")) + "\n")
+        source = JsonlFileSource(path)
+        self.addCleanup(source.close)
+
+        key, request = source.get_next_request()
+        self.assertEqual((key, request["requestId"]), ("000000000001", "r1"))
+        source.release_request(key)
+        self.assertEqual(source.get_next_request()[1]["requestId"], "r1")
+
+        with self.assertRaises(RequestDecodeError) as ctx:
+            source.get_next_request()
+        self.assertTrue(source.quarantine_request(ctx.exception.request_key, ctx.exception.reason, 1))
+
+        self.assertEqual(source.get_next_request()[1]["requestId"], "r3")
+        self.assertIsNone(source.get_next_request())
+
+        with open(source.dead_letter_path) as f:
+            dead_letter = json.loads(f.readline())
+        self.assertEqual((dead_letter["key"], dead_letter["body"]), ("000000000002", "{not json"))
+
+    def test_directory_source_mimics_bucket_order(self):
+        """Tests that the directory source hands out files smallest key first and deletes/quarantines them."""
+        for key in ["b-request", "a-request", "nested/c-request"]:
+            path = os.path.join(self.tmp_dir.name, *key.split('/'))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                json.dump(dict(self.standard_widget_request, requestId=key), f)
+        source = DirectorySource(self.tmp_dir.name)
+
+        first_key, _ = source.get_next_request()
+        second_key, _ = source.get_next_request()
+        third_key, _ = source.get_next_request()
+        self.assertEqual([first_key, second_key, third_key], ["a-request", "b-request", "nested/c-request"])
+        self.assertIsNone(source.get_next_request())
+
+        self.assertEqual(source.delete_requests([first_key, second_key]), [])
+        self.assertTrue(source.quarantine_request(third_key, "bad widget", 2))
+        self.assertIsNone(source.get_next_request())
+
+        with open(os.path.join(self.tmp_dir.name, "dead-letter", "nested", "c-request.error.json")) as f:
+            self.assertEqual(json.load(f), {"reason": "bad widget", "attempts": 2})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+import unittest
+import json
+from unittest.mock import MagicMock, patch
+import boto3
+from moto import mock_aws
+from s3_layout import OwnerIndex, widget_key, key_shard, index_key
+from widget_processor import S3Storage
+from config import ConsumerConfig
+
+
+class TestKeyLayout(unittest.TestCase):
+
+    def test_hashed_layout_spreads_an_owner_over_shards(self):
+        """Tests that the hashed layout puts a stable shard in front of the owner segment."""
+        self.assertEqual(widget_key("Sue Smith", "w1"), "widgets/sue-smith/w1")
+        self.assertEqual(widget_key("Sue Smith", "w1", 'hashed'), f"widgets/{key_shard('w1')}/sue-smith/w1")
+        self.assertEqual(len(key_shard("w1", 3)), 3)
+        shards = {widget_key("Sue Smith", f"widget-{i}", 'hashed', 1).split('/')[1] for i in range(200)}
+        self.assertEqual(len(shards), 16)
+
+
+class TestS3Layout(unittest.TestCase):
+
+    def setUp(self):
+        self.BUCKET = 'test-widgets-s3-bucket'
+
+    def _config(self, **overrides):
+        settings = dict(storage_type='s3', bucket_2_name='', bucket_3_name=self.BUCKET, dynamodb_table_name='',
+                        region_name='us-east-1', polling_delay_ms=100)
+        settings.update(overrides)
+        return ConsumerConfig(**settings)
+
+    def _request(self, widget_id, request_type="create", **fields):
+        return dict({"type": request_type, "requestId": f"r-{widget_id}", "widgetId": widget_id,
+                     "owner": "Sue Smith", "label": "L", "otherAttributes": []}, **fields)
+
+    def _keys(self, s3):
+        return sorted(obj['Key'] for obj in s3.list_objects_v2(Bucket=self.BUCKET).get('Contents', []))
+
+    @mock_aws
+    def test_owner_index_tracks_widgets_and_acks_after_the_manifest(self):
+        """Tests that creates and deletes reach the owner's manifest before they are acked."""
+        s3 = boto3.client('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket=self.BUCKET)
+        storage = S3Storage(self._config(s3_key_layout='hashed', s3_owner_index=True, s3_index_flush_ms=60000))
+        acks = MagicMock()
+        for widget_id in ("w1", "w2", "w3"):
+            storage.store_widget(self._request(widget_id), getattr(acks, widget_id))
+        storage.delete_widget(self._request("w2", "delete"), acks.delete)
+        self.assertEqual(acks.method_calls, [])
+
+        storage.flush()
+        self.assertEqual(len(acks.method_calls), 4)
+        manifest = json.loads(s3.get_object(Bucket=self.BUCKET, Key=index_key("Sue Smith"))['Body'].read())
+        self.assertEqual(manifest["widgets"], ["w1", "w3"])
+        self.assertEqual(storage.list_widget_keys("Sue Smith"),
+                         [widget_key("Sue Smith", w, 'hashed') for w in ("w1", "w3")])
+        storage.close()
+
+    @mock_aws
+    def test_index_merges_again_after_a_concurrent_write(self):
+        """Tests that a manifest write that lost a race re-reads the manifest instead of overwriting it."""
+        s3 = boto3.client('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket=self.BUCKET)
+        other = OwnerIndex(s3, self.BUCKET, flush_ms=60000)
+        other.add("Sue Smith", "w1")
+        other.close()
+
+        index = OwnerIndex(s3, self.BUCKET, flush_ms=60000)
+        index.add("Sue Smith", "w2")
+        read = index._read
+        # the first read misses the other consumer's manifest, like a read just before its write
+        with patch.object(index, '_read', side_effect=[(set(), None), read("Sue Smith")]):
+            index.flush()
+        index.close()
+        self.assertEqual(index.widget_ids("Sue Smith"), ["w1", "w2"])
+
+    @mock_aws
+    def test_index_turned_on_over_existing_widgets_backfills(self):
+        """Tests that with the backfill an owner without a manifest is listed once and the first manifest starts from that."""
+        s3 = boto3.client('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket=self.BUCKET)
+        config = self._config(s3_key_layout='hashed', s3_key_shard_chars=1)
+        S3Storage(config).store_widget(self._request("w1"))
+        S3Storage(config).store_widget(self._request("w2"))
+
+        # without the backfill a missing manifest is just empty
+        storage = S3Storage(config._replace(s3_owner_index=True, s3_index_flush_ms=60000))
+        self.assertEqual(storage.list_widget_keys("Sue Smith"), [])
+        storage.close()
+
+        storage = S3Storage(config._replace(s3_owner_index=True, s3_index_backfill=True, s3_index_flush_ms=60000))
+        expected = [widget_key("Sue Smith", w, 'hashed', 1) for w in ("w1", "w2")]
+        with patch.object(storage, '_listed_widget_keys', wraps=storage._listed_widget_keys) as listed:
+            self.assertEqual(storage.list_widget_keys("Sue Smith"), expected)
+            self.assertEqual(storage.list_widget_keys("Sue Smith"), expected)
+            storage.store_widget(self._request("w3"))
+            storage.close()
+            listed.assert_called_once_with("Sue Smith")
+        manifest = json.loads(s3.get_object(Bucket=self.BUCKET, Key=index_key("Sue Smith"))['Body'].read())
+        self.assertEqual(manifest["widgets"], ["w1", "w2", "w3"])
+
+    @mock_aws
+    def test_failed_index_write_is_kept_for_the_next_flush(self):
+        """Tests that changes whose manifest write failed stay pending, under changes made since."""
+        s3 = boto3.client('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket=self.BUCKET)
+        index = OwnerIndex(s3, self.BUCKET, flush_ms=60000)
+        acks = MagicMock()
+        index.add("Sue Smith", "w1", acks.w1)
+        index.add("Sue Smith", "w2", acks.w2)
+        def failing_write(owner, changes):
+            # a newer change for w2 comes in while the write is failing
+            index.remove("Sue Smith", "w2", acks.removed)
+            raise RuntimeError("index unavailable")
+        with patch.object(index, '_write', side_effect=failing_write):
+            index.flush()
+        self.assertEqual(acks.method_calls, [])
+
+        index.close()
+        self.assertEqual(index.widget_ids("Sue Smith"), ["w1"])
+        self.assertEqual([c[0] for c in acks.method_calls], ["w1", "w2", "removed"])
+
+    @mock_aws
+    def test_legacy_reads_find_and_move_old_widgets(self):
+        """Tests that with legacy reads old-layout widgets are updated into the new layout and deleted everywhere."""
+        s3 = boto3.client('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket=self.BUCKET)
+        S3Storage(self._config()).store_widget(self._request("w1"))
+        S3Storage(self._config()).store_widget(self._request("w2"))
+
+        storage = S3Storage(self._config(s3_key_layout='hashed', s3_legacy_reads=True))
+        self.assertEqual(storage.list_widget_keys("Sue Smith"), ["widgets/sue-smith/w1", "widgets/sue-smith/w2"])
+
+        storage.update_widget(self._request("w1", "update", label="NEW"))
+        self.assertEqual(self._keys(s3), sorted([widget_key("Sue Smith", "w1", 'hashed'), "widgets/sue-smith/w2"]))
+        stored = json.loads(s3.get_object(Bucket=self.BUCKET, Key=widget_key("Sue Smith", "w1", 'hashed'))['Body'].read())
+        self.assertEqual(stored["label"], "NEW")
+
+        storage.delete_widget(self._request("w2", "delete"))
+        self.assertEqual(self._keys(s3), [widget_key("Sue Smith", "w1", 'hashed')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,7 @@ import unittest
 import json
 import boto3
 from moto import mock_aws
+from unittest.mock import patch
 from widget_processor import S3Storage
 from config import ConsumerConfig
 
@@ -52,5 +53,73 @@ class TestS3Storage(unittest.TestCase):
         self.assertEqual(retrieved_data['description'], self.standard_widget_data['description'])
         self.assertEqual(retrieved_data['otherAttributes'], self.standard_widget_data['otherAttributes'])
 
+    @mock_aws
+    def test_update_and_delete_widget_s3(self):
+        """Tests that updates merge into the stored widget and deletes remove it."""
+        s3_client = boto3.client('s3', region_name=self.MOCK_REGION)
+        s3_client.create_bucket(Bucket=self.MOCK_BUCKET_NAME)
+        storage = S3Storage(ConsumerConfig(
+            storage_type='s3',
+            bucket_2_name='',
+            bucket_3_name=self.MOCK_BUCKET_NAME,
+            dynamodb_table_name='',
+            region_name=self.MOCK_REGION,
+            polling_delay_ms=100
+        ))
+        widget_key = f"widgets/sue-smith/{self.standard_widget_data['widgetId']}"
+        storage.store_widget(self.standard_widget_data)
+
+        acked = []
+        storage.update_widget(dict(self.standard_widget_data, type="update", label="NEW-LABEL", description=None,
+                                   otherAttributes=[{"name": "color", "value": "red"}, {"name": "note", "value": ""}]),
+                              ack=lambda: acked.append("update"))
+        updated = json.loads(s3_client.get_object(Bucket=self.MOCK_BUCKET_NAME, Key=widget_key)['Body'].read())
+        self.assertEqual(updated['label'], "NEW-LABEL")
+        self.assertEqual(updated['description'], self.standard_widget_data['description'])
+        attributes = {attr['name']: attr['value'] for attr in updated['otherAttributes']}
+        self.assertEqual(attributes['color'], "red")
+        self.assertEqual(attributes['note'], "")
+
+        storage.delete_widget(dict(self.standard_widget_data, type="delete"), ack=lambda: acked.append("delete"))
+        self.assertNotIn('Contents', s3_client.list_objects_v2(Bucket=self.MOCK_BUCKET_NAME))
+
+        # updating a widget that is gone is skipped, but the request is still done with
+        storage.update_widget(dict(self.standard_widget_data, type="update"), ack=lambda: acked.append("missing"))
+        self.assertNotIn('Contents', s3_client.list_objects_v2(Bucket=self.MOCK_BUCKET_NAME))
+        self.assertEqual(acked, ["update", "delete", "missing"])
+
+    @mock_aws
+    def test_update_is_applied_again_after_a_concurrent_write(self):
+        """Tests that an update whose object changed after it was read is read and applied again."""
+        s3_client = boto3.client('s3', region_name=self.MOCK_REGION)
+        s3_client.create_bucket(Bucket=self.MOCK_BUCKET_NAME)
+        storage = S3Storage(ConsumerConfig(
+            storage_type='s3',
+            bucket_2_name='',
+            bucket_3_name=self.MOCK_BUCKET_NAME,
+            dynamodb_table_name='',
+            region_name=self.MOCK_REGION,
+            polling_delay_ms=100
+        ))
+        widget_key = f"widgets/sue-smith/{self.standard_widget_data['widgetId']}"
+        storage.store_widget(self.standard_widget_data)
+
+        read = storage._get_widget
+        reads = []
+        def racing_read(key):
+            result = read(key)
+            if not reads:
+                # another consumer writes its update between our read and our write
+                s3_client.put_object(Bucket=self.MOCK_BUCKET_NAME, Key=widget_key,
+                                     Body=json.dumps(dict(self.standard_widget_data, description="THEIRS")))
+            reads.append(key)
+            return result
+
+        with patch.object(storage, '_get_widget', side_effect=racing_read):
+            storage.update_widget(dict(self.standard_widget_data, type="update", label="OURS", description=None))
+        updated = json.loads(s3_client.get_object(Bucket=self.MOCK_BUCKET_NAME, Key=widget_key)['Body'].read())
+        self.assertEqual(len(reads), 2)
+        self.assertEqual((updated['label'], updated['description']), ("OURS", "THEIRS"))
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,89 @@
+import unittest
+import json
+import boto3
+from moto import mock_aws
+from get_widget import S3RequestRetriever
+from sharding import ShardLeaseManager, SHARD_PREFIXES, OTHER_KEYS, shard_prefixes
+
+
+class TestShardLeases(unittest.TestCase):
+
+    def setUp(self):
+        self.MOCK_LEASE_TABLE = 'test-consumer-leases'
+        self.MOCK_REQUEST_BUCKET = 'test-widget-requests'
+        self.MOCK_REGION = 'us-east-1'
+
+    def _create_lease_table(self):
+        boto3.client('dynamodb', region_name=self.MOCK_REGION).create_table(
+            TableName=self.MOCK_LEASE_TABLE,
+            KeySchema=[{'AttributeName': 'leaseId', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'leaseId', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+
+    def _manager(self, consumer_id):
+        return ShardLeaseManager(self.MOCK_LEASE_TABLE, consumer_id=consumer_id, region_name=self.MOCK_REGION,
+                                 lease_ttl_s=30, heartbeat_s=10)
+
+    @mock_aws
+    def test_slices_rebalance_when_consumers_join_and_leave(self):
+        """Tests that the key space is split between live consumers and handed back when one leaves."""
+        self._create_lease_table()
+        consumer_a = self._manager('consumer-a')
+        consumer_b = self._manager('consumer-b')
+
+        consumer_a.heartbeat()
+        self.assertEqual(consumer_a.owned_prefixes(), list(SHARD_PREFIXES))
+
+        # b joins but a still holds every lease until its next heartbeat
+        consumer_b.heartbeat()
+        self.assertEqual(consumer_b.owned_prefixes(), [])
+
+        consumer_a.heartbeat()
+        consumer_b.heartbeat()
+        self.assertEqual(consumer_a.owned_prefixes(), list(SHARD_PREFIXES[0::2]))
+        self.assertEqual(consumer_b.owned_prefixes(), list(SHARD_PREFIXES[1::2]))
+
+        consumer_a.close()
+        consumer_b.heartbeat()
+        self.assertEqual(consumer_b.owned_prefixes(), list(SHARD_PREFIXES))
+
+    @mock_aws
+    def test_retriever_only_lists_owned_prefixes(self):
+        """Tests that a sharded retriever only hands out keys from its own slices."""
+        s3_client = boto3.client('s3', region_name=self.MOCK_REGION)
+        s3_client.create_bucket(Bucket=self.MOCK_REQUEST_BUCKET)
+        keys = ['0aaa', '1bbb', '2ccc', '3ddd', 'f000']
+        for key in keys:
+            s3_client.put_object(Bucket=self.MOCK_REQUEST_BUCKET, Key=key, Body=json.dumps({"requestId": key}))
+
+        for prefetch_size in (0, 10):
+            retriever = S3RequestRetriever(bucket_name=self.MOCK_REQUEST_BUCKET, region_name=self.MOCK_REGION,
+                                           prefetch_size=prefetch_size, prefixes_provider=lambda: ['3', '1'])
+            retrieved = []
+            while (request := retriever.get_next_request()) is not None:
+                retrieved.append(request[0])
+            self.assertEqual(retrieved, ['1bbb', '3ddd'])
+
+    @mock_aws
+    def test_catch_all_slice_covers_keys_without_a_hex_prefix(self):
+        """Tests that wider prefixes still leave no key unleased, the catch-all slice gets the rest."""
+        self.assertEqual(len(shard_prefixes(2)), 257)
+        self.assertEqual((shard_prefixes(2)[0], shard_prefixes(2)[-1]), ('00', OTHER_KEYS))
+
+        s3_client = boto3.client('s3', region_name=self.MOCK_REGION)
+        s3_client.create_bucket(Bucket=self.MOCK_REQUEST_BUCKET)
+        for key in ['-x', '0aaa', '0z11', 'Abc', 'f000', 'zz']:
+            s3_client.put_object(Bucket=self.MOCK_REQUEST_BUCKET, Key=key, Body=json.dumps({"requestId": key}))
+
+        for prefetch_size in (0, 10):
+            retriever = S3RequestRetriever(bucket_name=self.MOCK_REQUEST_BUCKET, region_name=self.MOCK_REGION,
+                                           prefetch_size=prefetch_size, shard_width=2,
+                                           prefixes_provider=lambda: [OTHER_KEYS, '0a'])
+            retrieved = []
+            while (request := retriever.get_next_request()) is not None:
+                retrieved.append(request[0])
+            self.assertEqual(retrieved, ['0aaa', '-x', '0z11', 'Abc', 'zz'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import time
+
+from botocore.exceptions import ClientError
+from throttling import TokenBucket, AdaptiveLimiter, is_throttle_error
+from widget_processor import DynamoDBBatchWriter
+import consumer
+
+
+def throttle_error(code='ProvisionedThroughputExceededException'):
+    return ClientError({'Error': {'Code': code, 'Message': 'slow down'}}, 'PutItem')
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_bucket_paces_to_rate(self):
+        """Tests that after the initial burst tokens are handed out at the configured rate."""
+        bucket = TokenBucket(rate=50, burst=5)
+        start = time.monotonic()
+        for _ in range(15):
+            bucket.acquire()
+        # 5 from the burst, 10 more at 50/s
+        self.assertGreaterEqual(time.monotonic() - start, 0.18)
+        self.assertFalse(bucket.acquire(tokens=5, timeout=0.01))
+
+
+class TestAdaptiveLimiter(unittest.TestCase):
+
+    def test_aimd(self):
+        """Tests that a throttle halves rate and concurrency once per interval and quiet intervals add back."""
+        limiter = AdaptiveLimiter("test", rate=100, max_rate=200, max_concurrency=8,
+                                  increase_step=10, adjust_interval_s=0.05)
+
+        for _ in range(3):
+            with self.assertRaises(ClientError):
+                with limiter.slot():
+                    raise throttle_error()
+        self.assertEqual((limiter.rate, limiter.concurrency), (50, 4))
+
+        time.sleep(0.06)
+        with limiter.slot():
+            pass
+        self.assertEqual((limiter.rate, limiter.concurrency), (60, 5))
+
+        # errors that aren't throttles don't move the limits
+        with self.assertRaises(ValueError):
+            with limiter.slot():
+                raise ValueError("bad request")
+        self.assertEqual(limiter.stats()["in_flight"], 0)
+        self.assertTrue(is_throttle_error(throttle_error('SlowDown')))
+        self.assertFalse(is_throttle_error(throttle_error('AccessDenied')))
+
+    def test_batch_writer_retries_a_throttled_batch(self):
+        """Tests that a batch rejected with ProvisionedThroughputExceeded is retried instead of dropped."""
+        client = MagicMock()
+        client.batch_write_item.side_effect = [throttle_error(), {'UnprocessedItems': {}}]
+        limiter = AdaptiveLimiter("dynamodb", rate=1000, max_concurrency=2)
+        writer = DynamoDBBatchWriter('widgets', client_getter=lambda: client, batch_size=2,
+                                     max_latency_ms=60000, base_backoff_ms=1, limiter=limiter)
+        acked = []
+        writer.add({'widgetId': 'a'}, ack=lambda: acked.append('a'))
+        writer.add({'widgetId': 'b'}, ack=lambda: acked.append('b'))
+        writer.close()
+
+        self.assertEqual(client.batch_write_item.call_count, 2)
+        self.assertEqual(acked, ['a', 'b'])
+        self.assertEqual(limiter.rate, 500)
+
+
+class TestConsumerThrottling(unittest.TestCase):
+
+    def test_throttled_request_is_released_without_counting_an_attempt(self):
+        """Tests that throttling doesn't push a healthy request towards quarantine."""
+        retriever = MagicMock()
+        retriever.get_next_request.return_value = ("request-1", {"type": "create"})
+        processor = MagicMock()
+        processor.process.side_effect = throttle_error()
+        quarantine = MagicMock()
+
+        with patch.object(consumer.time, 'sleep'):
+            self.assertTrue(consumer.handle_next_request(retriever, processor, MagicMock(), quarantine))
+        retriever.release_request.assert_called_once_with("request-1")
+        quarantine.record_failure.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import unittest
+import gzip
+import importlib.util
+import json
+
+import boto3
+from moto import mock_aws
+from config import ConsumerConfig
+from widget_processor import S3Storage, DynamoDBStorage
+from widget_encoding import encode_widget, decode_widget, encode_s3_body, decode_s3_body, savings_report
+
+
+class TestWidgetEncoding(unittest.TestCase):
+
+    def setUp(self):
+        self.MOCK_REGION = 'us-east-1'
+        self.widget_request = {"type": "create", "requestId": "r1", "widgetId": "w1", "owner": "Sue Smith",
+                               "label": "LVAGDCHGI", "description": "TVGMYIFJHKWKHEXHHNUIBZWLPOYUKTNMUUAUTYANZGT",
+                               "otherAttributes": [{"name": f"attr-{i}", "value": "x" * 20} for i in range(50)]}
+
+    def _config(self, **overrides):
+        settings = dict(
+            storage_type='s3',
+            bucket_2_name='',
+            bucket_3_name='test-widgets-s3-bucket',
+            dynamodb_table_name='test-widgets-table',
+            region_name=self.MOCK_REGION,
+            polling_delay_ms=100,
+            attribute_format='map'
+        )
+        settings.update(overrides)
+        return ConsumerConfig(**settings)
+
+    def test_map_encoding_round_trips(self):
+        """Tests that flattened attributes decode back to the request's list and unflattenable ones are left alone."""
+        widget = {"widgetId": "w1", "otherAttributes": self.widget_request["otherAttributes"]}
+        encoded = encode_widget(widget, 'map')
+        self.assertEqual(encoded["otherAttributes"]["attr-0"], "x" * 20)
+        self.assertEqual(decode_widget(encoded), widget)
+
+        duplicated = {"widgetId": "w1", "otherAttributes": [{"name": "a", "value": "1"}, {"name": "a", "value": "2"}]}
+        self.assertIs(encode_widget(duplicated, 'map'), duplicated)
+
+        body, content_encoding = encode_s3_body(widget, 'map', 'gzip')
+        self.assertEqual(content_encoding, 'gzip')
+        self.assertEqual(decode_s3_body(body, content_encoding), widget)
+
+    @unittest.skipUnless(importlib.util.find_spec('zstandard'), "zstandard is not installed")
+    def test_zstd_round_trips(self):
+        """Tests the optional zstd compression."""
+        body, content_encoding = encode_s3_body(self.widget_request, 'map', 'zstd')
+        self.assertEqual(content_encoding, 'zstd')
+        self.assertEqual(decode_s3_body(body, content_encoding)["otherAttributes"], self.widget_request["otherAttributes"])
+
+    @mock_aws
+    def test_s3_compressed_widget_is_stored_with_content_encoding_and_updates(self):
+        """Tests that compressed S3 bodies carry a ContentEncoding and are read back by updates."""
+        s3_client = boto3.client('s3', region_name=self.MOCK_REGION)
+        s3_client.create_bucket(Bucket='test-widgets-s3-bucket')
+        storage = S3Storage(self._config(s3_compression='gzip'))
+        storage.store_widget(self.widget_request)
+        storage.update_widget({"type": "update", "requestId": "r2", "widgetId": "w1", "owner": "Sue Smith",
+                               "otherAttributes": [{"name": "attr-0", "value": "changed"}]})
+
+        obj = s3_client.get_object(Bucket='test-widgets-s3-bucket', Key="widgets/sue-smith/w1")
+        self.assertEqual(obj['ContentEncoding'], 'gzip')
+        stored = json.loads(gzip.decompress(obj['Body'].read()))
+        self.assertEqual(len(stored["otherAttributes"]), 50)
+        self.assertEqual(stored["otherAttributes"]["attr-0"], "changed")
+
+    @mock_aws
+    def test_dynamodb_stores_attributes_as_a_map(self):
+        """Tests that DynamoDB items hold a native map and updates round-trip through it."""
+        dynamodb = boto3.resource('dynamodb', region_name=self.MOCK_REGION)
+        table = dynamodb.create_table(
+            TableName='test-widgets-table',
+            KeySchema=[{'AttributeName': 'widgetId', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'widgetId', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+        storage = DynamoDBStorage(self._config(storage_type='dynamodb'))
+        storage.store_widget(self.widget_request)
+        storage.update_widget({"type": "update", "requestId": "r2", "widgetId": "w1", "owner": "Sue Smith",
+                               "otherAttributes": [{"name": "attr-1", "value": "changed"}]})
+
+        item = table.get_item(Key={'widgetId': 'w1'})['Item']
+        self.assertIsInstance(item["otherAttributes"], dict)
+        self.assertEqual(item["otherAttributes"]["attr-1"], "changed")
+        self.assertEqual(len(item["otherAttributes"]), 50)
+        expected = [dict(attr, value="changed") if attr["name"] == "attr-1" else attr
+                    for attr in self.widget_request["otherAttributes"]]
+        self.assertEqual(decode_widget(item)["otherAttributes"], expected)
+
+    def test_attribute_order_survives_a_map_that_loses_it(self):
+        """Tests that with keep_order the request's attribute order comes back from a map in any order."""
+        widget = {"widgetId": "w1", "otherAttributes": [{"name": n, "value": n.upper()} for n in ("zeta", "alpha", "mid")]}
+        encoded = encode_widget(widget, 'map', keep_order=True)
+        # a DynamoDB map comes back in its own order
+        reordered = dict(encoded, otherAttributes=dict(sorted(encoded["otherAttributes"].items())))
+        self.assertEqual(decode_widget(reordered), widget)
+        self.assertNotIn("otherAttributeNames", encode_widget(widget, 'map'))
+
+    def test_report_shows_bytes_and_write_units_saved(self):
+        """Tests that the savings report counts the smaller map encoding and compressed bodies."""
+        report = savings_report([self.widget_request], 'map', 'gzip')
+        totals = report["totals"]
+        self.assertLess(totals["s3_compact_bytes"], totals["s3_bytes"])
+        self.assertLess(totals["dynamodb_compact_bytes"], totals["dynamodb_bytes"])
+        self.assertLessEqual(totals["dynamodb_compact_wcu"], totals["dynamodb_wcu"])
+        self.assertGreater(report["saved_per_widget"]["dynamodb_bytes"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+import json
+import boto3
+from moto import mock_aws
+from widget_request import WidgetRequest, InvalidRequestError
+from widget_processor import S3Storage
+from config import ConsumerConfig
+
+
+class TestWidgetRequest(unittest.TestCase):
+
+    def setUp(self):
+        self.request = {"type": "Create", "requestId": "r1", "widgetId": "w1", "owner": "Sue Smith",
+                        "label": "L", "otherAttributes": [{"name": "color", "value": "blue"}]}
+
+    def test_parse_reports_every_problem(self):
+        """Tests that validation collects a FieldError per problem instead of stopping at the first."""
+        with self.assertRaises(InvalidRequestError) as raised:
+            WidgetRequest.parse({"type": "rename", "widgetId": 7, "owner": "Sue Smith",
+                                 "label": ["L"], "otherAttributes": [{"value": "x"}]})
+        self.assertEqual([(e.field, e.code) for e in raised.exception.errors],
+                         [('type', 'unknown'), ('widgetId', 'type'), ('requestId', 'missing'),
+                          ('label', 'type'), ('otherAttributes[0]', 'type')])
+        self.assertIn("requestId is required", str(raised.exception))
+
+        with self.assertRaises(InvalidRequestError):
+            WidgetRequest.parse(["not", "an", "object"])
+
+    def test_request_is_a_read_only_view(self):
+        """Tests that the model wraps the decoded dict without copying it and reads like it."""
+        request = WidgetRequest.parse(self.request)
+        self.assertIs(request.to_dict(), self.request)
+        self.assertIs(WidgetRequest.parse(request), request)
+        self.assertEqual((request.request_type, request["owner"], request.get("description")), ('create', "Sue Smith", None))
+        self.assertEqual(dict(request), self.request)
+        self.assertFalse(hasattr(request, "__dict__"))
+
+        # label/description are optional, the stored widget just leaves them out
+        self.assertEqual(request.stored_widget(), {"widgetId": "w1", "owner": "Sue Smith", "label": "L",
+                                                   "otherAttributes": [{"name": "color", "value": "blue"}]})
+        self.assertEqual(request.s3_key(), "widgets/sue-smith/w1")
+
+    def test_s3_stores_widget_without_description(self):
+        """Tests that a create without a description is stored instead of failing with a KeyError."""
+        with mock_aws():
+            s3 = boto3.client('s3', region_name='us-east-1')
+            s3.create_bucket(Bucket='widgets')
+            config = ConsumerConfig(storage_type='s3', bucket_2_name='', bucket_3_name='widgets',
+                                    dynamodb_table_name='', region_name='us-east-1', polling_delay_ms=100)
+            S3Storage(config).store_widget(self.request)
+            stored = json.loads(s3.get_object(Bucket='widgets', Key='widgets/sue-smith/w1')['Body'].read())
+            self.assertEqual(stored["label"], "L")
+            self.assertNotIn("description", stored)
+
+
+if __name__ == '__main__':
+    unittest.main()
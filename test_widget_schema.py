@@ -1,9 +1,10 @@
 import unittest
 import json
+from unittest.mock import patch
 import boto3
 from moto import mock_aws
-from get_widget import S3RequestRetriever
-from config import ConsumerConfig
+from get_widget import S3RequestRetriever, RequestAcknowledger
+from config import ConsumerConfig, parse_args
 
 # all tests came from a cool library called moto that can mock aws services for testing
 # i found a cool articl walking though it here https://caylent.com/blog/mocking-aws-calls-using-moto
@@ -44,5 +45,116 @@ class TestWidgetSchema(unittest.TestCase):
             remaining_objects = self.s3_client.list_objects_v2(Bucket=self.MOCK_BUCKET_NAME)
             self.assertNotIn('Contents', remaining_objects)
 
+    def test_prefetch_buffer_hands_out_smallest_key_first(self):
+        """Tests that the buffered retriever lists keys in batches and still returns them in key order."""
+        with mock_aws():
+            self.s3_client = boto3.client('s3', region_name=self.MOCK_REGION)
+            self.s3_client.create_bucket(Bucket=self.MOCK_BUCKET_NAME)
+            self.retriever = S3RequestRetriever(
+                bucket_name=self.MOCK_BUCKET_NAME,
+                region_name=self.MOCK_REGION,
+                prefetch_size=3,
+                low_water_mark=1
+            )
+
+            keys = [f"request-{i:03d}" for i in range(7)]
+            for key in reversed(keys):
+                request = dict(self.standard_widget_request, requestId=key)
+                self.s3_client.put_object(Bucket=self.MOCK_BUCKET_NAME, Key=key, Body=json.dumps(request))
+
+            # simulate another consumer grabbing a key that is already in our buffer
+            self.assertEqual(self.retriever.get_and_delete_next_request()["requestId"], keys[0])
+            self.s3_client.delete_object(Bucket=self.MOCK_BUCKET_NAME, Key=keys[1])
+
+            retrieved = [keys[0]]
+            while (request := self.retriever.get_and_delete_next_request()) is not None:
+                retrieved.append(request["requestId"])
+
+            self.assertEqual(retrieved, [key for key in keys if key != keys[1]])
+            remaining_objects = self.s3_client.list_objects_v2(Bucket=self.MOCK_BUCKET_NAME)
+            self.assertNotIn('Contents', remaining_objects)
+
+    def test_prefetch_low_water_defaults_below_the_buffer_size(self):
+        """Tests that a small prefetch buffer isn't refilled with a LIST on every request."""
+        with mock_aws():
+            self.s3_client = boto3.client('s3', region_name=self.MOCK_REGION)
+            self.s3_client.create_bucket(Bucket=self.MOCK_BUCKET_NAME)
+            retriever = S3RequestRetriever(bucket_name=self.MOCK_BUCKET_NAME, region_name=self.MOCK_REGION,
+                                           prefetch_size=8)
+            self.assertEqual(retriever.low_water_mark, 2)
+            self.assertEqual(S3RequestRetriever(prefetch_size=8, low_water_mark=100).low_water_mark, 7)
+
+            for i in range(8):
+                self.s3_client.put_object(Bucket=self.MOCK_BUCKET_NAME, Key=f"request-{i}",
+                                          Body=json.dumps(self.standard_widget_request))
+            with patch.object(retriever, '_list_keys', wraps=retriever._list_keys) as list_keys:
+                for _ in range(6):
+                    retriever.get_next_request()
+            self.assertEqual(list_keys.call_count, 1)
+
+        base = ['--storage-type', 's3', '--prefetch-size', '100']
+        self.assertEqual(parse_args(base).prefetch_low_water, None)
+        with self.assertRaises(SystemExit):
+            parse_args(base + ['--prefetch-low-water', '100'])
+
+    def test_acknowledger_deletes_processed_requests_in_bulk(self):
+        """Tests that requests stay in the bucket until acked and are then deleted in DeleteObjects batches."""
+        with mock_aws():
+            self.s3_client = boto3.client('s3', region_name=self.MOCK_REGION)
+            self.s3_client.create_bucket(Bucket=self.MOCK_BUCKET_NAME)
+            self.retriever = S3RequestRetriever(bucket_name=self.MOCK_BUCKET_NAME, region_name=self.MOCK_REGION)
+            acknowledger = RequestAcknowledger(self.retriever, batch_size=3, max_delay_ms=60000)
+
+            keys = [f"request-{i}" for i in range(5)]
+            for key in keys:
+                self.s3_client.put_object(Bucket=self.MOCK_BUCKET_NAME, Key=key, Body=json.dumps(self.standard_widget_request))
+
+            # requests waiting for their ack are not handed out twice
+            retrieved = []
+            while (request := self.retriever.get_next_request()) is not None:
+                retrieved.append(request[0])
+            self.assertEqual(retrieved, keys)
+
+            for key in keys[:4]:
+                acknowledger.ack(key)
+            remaining = [obj['Key'] for obj in self.s3_client.list_objects_v2(Bucket=self.MOCK_BUCKET_NAME)['Contents']]
+            self.assertEqual(remaining, keys[3:])
+
+            # a request that failed processing becomes available again
+            self.retriever.release_request(keys[4])
+            self.assertEqual(self.retriever.get_next_request()[0], keys[4])
+
+            acknowledger.close()
+            remaining = [obj['Key'] for obj in self.s3_client.list_objects_v2(Bucket=self.MOCK_BUCKET_NAME)['Contents']]
+            self.assertEqual(remaining, keys[4:])
+
+    def test_claims_page_past_held_requests_and_survive_failed_deletes(self):
+        """Tests that a full page of claimed keys doesn't stall the retriever and failed deletes keep their claim."""
+        with mock_aws():
+            self.s3_client = boto3.client('s3', region_name=self.MOCK_REGION)
+            self.s3_client.create_bucket(Bucket=self.MOCK_BUCKET_NAME)
+            retriever = S3RequestRetriever(bucket_name=self.MOCK_BUCKET_NAME, region_name=self.MOCK_REGION)
+            keys = [f"request-{i}" for i in range(5)]
+            for key in keys:
+                self.s3_client.put_object(Bucket=self.MOCK_BUCKET_NAME, Key=key, Body=json.dumps(self.standard_widget_request))
+
+            list_keys = retriever._list_keys
+            # pages of 2 keys stand in for the 1000 key cap on a LIST page
+            with patch.object(retriever, '_list_keys',
+                              side_effect=lambda max_keys, start_after=None, prefix=None: list_keys(min(max_keys, 2), start_after, prefix)):
+                retrieved = [retriever.get_next_request()[0] for _ in range(5)]
+            self.assertEqual(retrieved, keys)
+
+            delete_objects = retriever.s3_client.delete_objects
+            def fail_one(**kwargs):
+                kwargs['Delete']['Objects'] = kwargs['Delete']['Objects'][1:]
+                response = delete_objects(**kwargs)
+                response['Errors'] = [{'Key': keys[0], 'Message': 'InternalError'}]
+                return response
+            with patch.object(retriever.s3_client, 'delete_objects', side_effect=fail_one):
+                self.assertEqual(retriever.delete_requests(keys), [keys[0]])
+            # still claimed, so it isn't handed out again before the claim expires
+            self.assertIsNone(retriever.get_next_request())
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,167 @@
+import unittest
+import os
+import tempfile
+import threading
+import time
+from unittest.mock import MagicMock
+from botocore.exceptions import ClientError
+from config import ConsumerConfig
+from widget_processor import Wiget_Processor
+from write_buffer import WriteBehindBuffer
+
+
+def request(widget_id, label="L"):
+    return {"requestId": f"r-{widget_id}-{label}", "widgetId": widget_id, "owner": "Sue Smith", "label": label,
+            "otherAttributes": [{"name": "note", "value": "x" * 200}]}
+
+
+class RecordingSink:
+    def __init__(self, gate=None, failures=0):
+        self.gate = gate
+        self.failures = failures
+        self.writes = []
+        self.lock = threading.Lock()
+
+    def write(self, request_type, request, ack, on_failure=None):
+        if self.gate is not None:
+            self.gate.wait(5)
+        with self.lock:
+            if self.failures:
+                self.failures -= 1
+                raise ClientError({'Error': {'Code': 'SlowDown', 'Message': 'slow down'}}, 'PutObject')
+            self.writes.append((request_type, request["widgetId"], request["label"]))
+        if ack:
+            ack()
+
+
+class TestWriteBehindBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.spill_path = os.path.join(self.tmp.name, "spill.jsonl")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_writes_in_memory_are_acked_after_the_sink(self):
+        """Tests that buffered writes reach the sink, are retried while throttled and acked afterwards."""
+        sink = RecordingSink(failures=2)
+        buffer = WriteBehindBuffer(sink.write, max_bytes=1024 * 1024, workers=2, base_backoff_s=0.001)
+        ack = MagicMock()
+        buffer.put('create', request("w1"), ack)
+        self.assertTrue(buffer.flush(timeout=5))
+        buffer.close()
+
+        self.assertEqual(sink.writes, [('create', 'w1', 'L')])
+        ack.assert_called_once()
+
+    def test_spills_when_full_and_drains_in_order(self):
+        """Tests that writes past max_bytes go to the spill file, are acked there and drained in order."""
+        gate = threading.Event()
+        sink = RecordingSink(gate=gate)
+        buffer = WriteBehindBuffer(sink.write, max_bytes=600, spill_path=self.spill_path, workers=3)
+        acks = MagicMock()
+        for i in range(10):
+            buffer.put('update', request("w1", label=str(i)), getattr(acks, f"ack{i}"))
+
+        # the stalled sink holds the first write, at most one more fits in memory, the rest spilled and are acked
+        self.assertGreaterEqual(len(acks.method_calls), 8)
+        self.assertGreater(os.path.getsize(self.spill_path), 0)
+
+        gate.set()
+        self.assertTrue(buffer.flush(timeout=5))
+        buffer.close()
+        self.assertEqual([label for _, _, label in sink.writes], [str(i) for i in range(10)])
+        self.assertEqual(len(acks.method_calls), 10)
+        self.assertEqual(os.path.getsize(self.spill_path), 0)
+
+    def test_spilled_write_stays_in_the_file_until_the_sink_acks_it(self):
+        """Tests that a spilled write a queueing sink took but hasn't stored yet is still replayed after a stop."""
+        queued, gate = [], threading.Event()
+        def queueing_sink(request_type, request, ack, on_failure=None):
+            gate.wait(5)
+            queued.append((request["widgetId"], ack, on_failure))
+
+        buffer = WriteBehindBuffer(queueing_sink, max_bytes=1, spill_path=self.spill_path, workers=1)
+        # w1 holds the drain thread, w0 waits in memory, w2 and w3 spill
+        for widget_id in ("w1", "w0", "w2", "w3"):
+            buffer.put('create', request(widget_id))
+            time.sleep(0.05)
+        gate.set()
+        self.assertFalse(buffer.flush(timeout=0.5))
+        self.assertEqual([widget_id for widget_id, _, _ in queued], ["w1", "w0", "w2", "w3"])
+        self.assertEqual(buffer.pending(), 2)
+
+        # the sink stores w2 and rejects w3, only w2 is done with
+        spilled = {widget_id: (ack, on_failure) for widget_id, ack, on_failure in queued}
+        spilled["w2"][0]()
+        spilled["w3"][1](ClientError({'Error': {'Code': 'ValidationException', 'Message': 'bad'}}, 'PutItem'))
+        self.assertTrue(buffer.flush(timeout=5))
+        buffer.close()
+        self.assertEqual(os.path.getsize(self.spill_path), 0)
+        with open(f"{self.spill_path}.failed") as failed:
+            self.assertIn('"w3"', failed.read())
+
+    def test_spilled_write_is_replayed_when_the_sink_never_acked_it(self):
+        """Tests that a spilled write whose queued write was lost with the process is written by the next run."""
+        gate = threading.Event()
+        buffer = WriteBehindBuffer(lambda *args: gate.wait(5), max_bytes=1, spill_path=self.spill_path, workers=1)
+        for widget_id in ("w1", "w0", "w2"):
+            buffer.put('create', request(widget_id))
+            time.sleep(0.05)
+        gate.set()
+        buffer.close(timeout=0.2)
+
+        sink = RecordingSink()
+        buffer = WriteBehindBuffer(sink.write, max_bytes=1024, spill_path=self.spill_path, workers=1)
+        self.assertTrue(buffer.flush(timeout=5))
+        buffer.close()
+        self.assertEqual([widget_id for _, widget_id, _ in sink.writes], ["w2"])
+
+    def test_spill_file_is_replayed_on_startup(self):
+        """Tests that spilled writes left by a stopped consumer are written by the next one, torn lines skipped."""
+        sink = RecordingSink(failures=1000)
+        buffer = WriteBehindBuffer(sink.write, max_bytes=1, spill_path=self.spill_path, workers=1, base_backoff_s=10)
+        for i in range(3):
+            buffer.put('create', request(f"w{i}"))
+        buffer.close(timeout=0.05)
+        with open(self.spill_path, 'ab') as spill:
+            spill.write(b'{"type":"create","requ')
+
+        sink = RecordingSink()
+        buffer = WriteBehindBuffer(sink.write, max_bytes=1024, spill_path=self.spill_path, workers=2)
+        self.assertTrue(buffer.flush(timeout=5))
+        buffer.close()
+        # the first write was held in memory by the old buffer, its source request was never acked
+        self.assertEqual(sorted(widget_id for _, widget_id, _ in sink.writes), ["w1", "w2"])
+
+    def test_rejected_write_is_handed_to_on_failure(self):
+        """Tests that a write the sink rejects for good isn't acked and its error goes to on_failure."""
+        error = ClientError({'Error': {'Code': 'ValidationException', 'Message': 'bad item'}}, 'PutItem')
+        buffer = WriteBehindBuffer(MagicMock(side_effect=error), max_bytes=1024 * 1024, workers=1)
+        ack, on_failure = MagicMock(), MagicMock()
+        buffer.put('create', request("w1"), ack, on_failure)
+        self.assertTrue(buffer.flush(timeout=5))
+        buffer.close()
+
+        ack.assert_not_called()
+        on_failure.assert_called_once_with(error)
+
+    def test_processor_flush_gives_up_after_its_timeout(self):
+        """Tests that the processor's flush returns once its timeout passes and leaves the write buffered."""
+        config = ConsumerConfig(storage_type='s3', bucket_2_name='', bucket_3_name='widgets', dynamodb_table_name='',
+                                region_name='us-east-1', polling_delay_ms=100, write_buffer_bytes=1024 * 1024)
+        processor = Wiget_Processor(config)
+        sink = RecordingSink(failures=1000)
+        processor._storage_strategy = MagicMock(store_widget=lambda request, ack, on_failure: sink.write('create', request, ack, on_failure))
+        processor.process(dict(request("w1"), type="create"))
+
+        start = time.monotonic()
+        self.assertFalse(processor.flush(timeout=0.2))
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual(processor._buffer.pending(), 1)
+        processor._buffer.close(timeout=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
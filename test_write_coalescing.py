@@ -0,0 +1,130 @@
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock
+from widget_processor import WriteCoalescer, apply_update, compose_updates
+
+
+class TestWriteCoalescer(unittest.TestCase):
+
+    def setUp(self):
+        self.create = {"type": "create", "requestId": "r1", "widgetId": "w1", "owner": "Sue Smith",
+                       "label": "L1", "description": "D1", "otherAttributes": [{"name": "color", "value": "blue"}]}
+
+    def _coalescer(self):
+        writes = []
+        def write(request_type, request, ack, on_failure=None):
+            writes.append((request_type, request))
+            if ack:
+                ack()
+        # a window long enough that only flush() writes
+        return WriteCoalescer(write, window_ms=60000), writes
+
+    def test_create_and_updates_collapse_into_one_create(self):
+        """Tests that a create followed by updates becomes a single create with the updates applied."""
+        coalescer, writes = self._coalescer()
+        acks = MagicMock()
+        coalescer.add('create', self.create, acks.create)
+        coalescer.add('update', {"widgetId": "w1", "label": "L2", "otherAttributes": [{"name": "size", "value": "9"}]}, acks.first)
+        coalescer.add('update', {"widgetId": "w1", "otherAttributes": [{"name": "color", "value": ""}]}, acks.second)
+        coalescer.close()
+
+        self.assertEqual(len(writes), 1)
+        request_type, request = writes[0]
+        self.assertEqual(request_type, 'create')
+        self.assertEqual(request['label'], "L2")
+        self.assertEqual(request['description'], "D1")
+        self.assertEqual(request['otherAttributes'], [{"name": "color", "value": ""}, {"name": "size", "value": "9"}])
+        self.assertEqual([c[0] for c in acks.method_calls], ['create', 'first', 'second'])
+
+    def test_delete_wins_and_widgets_are_kept_apart(self):
+        """Tests that a trailing delete replaces earlier requests and updates after a delete are dropped."""
+        coalescer, writes = self._coalescer()
+        coalescer.add('create', self.create)
+        coalescer.add('update', {"widgetId": "w1", "label": "L2"})
+        coalescer.add('delete', {"widgetId": "w1", "owner": "Sue Smith"})
+        coalescer.add('update', {"widgetId": "w1", "label": "L3"})
+        coalescer.add('update', {"widgetId": "w2", "label": "A"})
+        coalescer.add('update', {"widgetId": "w2", "description": "B"})
+        coalescer.close()
+
+        self.assertEqual([(t, r['widgetId']) for t, r in writes], [('delete', 'w1'), ('update', 'w2')])
+        self.assertEqual((writes[1][1]['label'], writes[1][1]['description']), ("A", "B"))
+
+    def test_failed_write_reaches_every_folded_request(self):
+        """Tests that a failed coalesced write leaves the acks alone and hands the error to each request."""
+        error = RuntimeError("boom")
+        coalescer = WriteCoalescer(MagicMock(side_effect=error), window_ms=60000)
+        acks, failures = MagicMock(), MagicMock()
+        coalescer.add('create', self.create, acks.create, failures.create)
+        coalescer.add('update', {"widgetId": "w1", "label": "L2"}, acks.update, failures.update)
+        coalescer.close()
+
+        acks.assert_not_called()
+        self.assertEqual(acks.method_calls, [])
+        failures.create.assert_called_once_with(error)
+        failures.update.assert_called_once_with(error)
+
+    def test_expired_writes_run_on_the_workers(self):
+        """Tests that coalesced writes of different widgets run in parallel, one at a time per widget."""
+        running, most_running, order = set(), [0], []
+        lock = threading.Lock()
+        def write(request_type, request, ack, on_failure=None):
+            with lock:
+                self.assertNotIn(request['widgetId'], running)
+                running.add(request['widgetId'])
+                most_running[0] = max(most_running[0], len(running))
+                order.append((request['widgetId'], request['label']))
+            time.sleep(0.05)
+            with lock:
+                running.discard(request['widgetId'])
+
+        coalescer = WriteCoalescer(write, window_ms=1, workers=8)
+        for i in range(8):
+            coalescer.add('update', {"widgetId": f"w{i}", "label": "first"})
+        time.sleep(0.02)
+        # w0 is being written, its next write waits for that one
+        coalescer.add('update', {"widgetId": "w0", "label": "second"})
+        started = time.monotonic()
+        coalescer.close()
+
+        self.assertGreater(most_running[0], 1)
+        self.assertLess(time.monotonic() - started, 0.4)
+        self.assertEqual([label for widget_id, label in order if widget_id == "w0"], ["first", "second"])
+
+    def test_add_blocks_while_max_pending_widgets_are_held(self):
+        """Tests that a new widget waits for room while requests for a held widget are still folded in."""
+        coalescer, writes = self._coalescer()
+        coalescer.max_pending = 2
+        coalescer.add('update', {"widgetId": "w1", "label": "A"})
+        coalescer.add('update', {"widgetId": "w2", "label": "B"})
+        coalescer.add('update', {"widgetId": "w2", "label": "C"})
+
+        adder = threading.Thread(target=coalescer.add, args=('update', {"widgetId": "w3", "label": "D"}))
+        adder.start()
+        adder.join(0.1)
+        self.assertTrue(adder.is_alive())
+
+        coalescer.flush()
+        adder.join(1)
+        self.assertFalse(adder.is_alive())
+        coalescer.close()
+        self.assertEqual([(r['widgetId'], r['label']) for _, r in writes], [("w1", "A"), ("w2", "C"), ("w3", "D")])
+
+    def test_composed_updates_match_sequential_updates(self):
+        """Tests that folding two updates has the same effect as applying them one after the other."""
+        widget = {"widgetId": "w1", "label": "L", "description": "D",
+                  "otherAttributes": [{"name": "a", "value": "1"}, {"name": "b", "value": "2"}]}
+        first = {"label": "L2", "otherAttributes": [{"name": "a", "value": ""}, {"name": "c", "value": "3"}]}
+        second = {"description": "D2", "otherAttributes": [{"name": "b", "value": "20"}, {"name": "a", "value": "10"}]}
+
+        composed = apply_update(widget, compose_updates(first, second))
+        sequential = apply_update(apply_update(widget, first), second)
+        # attribute order isn't meaningful, compare them by name
+        self.assertEqual({a['name']: a['value'] for a in composed.pop('otherAttributes')},
+                         {a['name']: a['value'] for a in sequential.pop('otherAttributes')})
+        self.assertEqual(composed, sequential)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,203 @@
+import logging
+import threading
+import time
+from botocore.exceptions import ClientError
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+# Client-side flow control for the storage backends.
+# Each backend gets an AdaptiveLimiter: a token bucket caps the request rate and a dynamic limit caps
+# how many calls are in flight. Both follow AIMD, every interval without throttling adds a little
+# (rate += increase_step, concurrency += 1 while latency stays under target), a throttle response
+# (ProvisionedThroughputExceededException, SlowDown, ...) cuts them by decrease_factor. The rate is
+# seeded from the configured capacity (e.g. the table's WCU) so a fresh consumer starts near it
+# instead of discovering it through a throttle storm.
+
+THROTTLE_ERROR_CODES = frozenset((
+    'ProvisionedThroughputExceededException',
+    'ThrottlingException',
+    'Throttling',
+    'RequestLimitExceeded',
+    'TooManyRequestsException',
+    'SlowDown',
+))
+
+
+def is_throttle_error(error: BaseException) -> bool:
+    """True for AWS errors that mean 'slow down' rather than 'this request is bad'."""
+    if not isinstance(error, ClientError):
+        return False
+    return error.response.get('Error', {}).get('Code') in THROTTLE_ERROR_CODES
+
+
+class TokenBucket:
+    """
+    Classic token bucket: refills at `rate` tokens per second up to `burst`.
+    A rate of 0 means unlimited.
+    """
+    def __init__(self, rate: float, burst: float = None):
+        self._lock = threading.Lock()
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+
+    def set_rate(self, rate: float) -> None:
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = rate
+            self.burst = max(1.0, rate)
+            self._tokens = min(self._tokens, self.burst)
+
+    def _refill(self, now: float) -> None:
+        # caller holds the lock
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self, tokens: float = 1, timeout: float = None) -> bool:
+        """Waits until `tokens` are available and takes them. Returns False if that takes longer than timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                if self.rate <= 0:
+                    return True
+                now = time.monotonic()
+                self._refill(now)
+                # a request bigger than the bucket only has to wait for a full bucket
+                needed = min(tokens, self.burst)
+                if self._tokens >= needed:
+                    self._tokens -= needed
+                    return True
+                wait = (needed - self._tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                return False
+            time.sleep(min(wait, 0.1))
+
+
+class _Slot:
+    __slots__ = ("_limiter", "_tokens", "_start")
+
+    def __init__(self, limiter, tokens):
+        self._limiter = limiter
+        self._tokens = tokens
+
+    def __enter__(self):
+        self._limiter.acquire(self._tokens)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._limiter.release(time.perf_counter() - self._start,
+                              throttled=exc is not None and is_throttle_error(exc),
+                              succeeded=exc is None)
+        return False
+
+
+class AdaptiveLimiter:
+    """
+    AIMD rate and concurrency limit for one backend. Safe to share between worker threads.
+
+        with limiter.slot():
+            table.put_item(...)
+
+    Throttle errors raised inside the block are seen by the limiter and still propagate.
+    """
+    def __init__(self, name: str, rate: float, max_rate: float = None, min_rate: float = 1.0,
+                 max_concurrency: int = 8, increase_step: float = None, decrease_factor: float = 0.5,
+                 latency_target_ms: float = 250, adjust_interval_s: float = 1.0):
+        self.name = name
+        self.min_rate = min(min_rate, rate)
+        self.max_rate = max_rate or rate * 2
+        self.max_concurrency = max(1, max_concurrency)
+        # probe upwards by ~5% of the seeded capacity per interval
+        self.increase_step = increase_step or max(1.0, rate * 0.05)
+        self.decrease_factor = decrease_factor
+        self.latency_target_s = latency_target_ms / 1000.0
+        self.adjust_interval_s = adjust_interval_s
+
+        self.bucket = TokenBucket(rate)
+        self.concurrency = self.max_concurrency
+        self._in_flight = 0
+        self._cond = threading.Condition()
+        self._latency_ewma = None
+        self._last_adjust = time.monotonic()
+        self._last_cut = float('-inf')
+
+        self._rate_gauge = METRICS.gauge("widget_backend_rate_limit", "Allowed requests per second, by backend.", backend=name)
+        self._concurrency_gauge = METRICS.gauge("widget_backend_concurrency_limit", "Allowed calls in flight, by backend.", backend=name)
+        self._throttles = METRICS.counter("widget_backend_throttles_total", "Throttle responses, by backend.", backend=name)
+        self._publish()
+
+    @property
+    def rate(self) -> float:
+        return self.bucket.rate
+
+    def _publish(self) -> None:
+        self._rate_gauge.set(self.bucket.rate)
+        self._concurrency_gauge.set(self.concurrency)
+
+    def slot(self, tokens: float = 1) -> _Slot:
+        """Context manager around one call (or one batch of `tokens` writes)."""
+        return _Slot(self, tokens)
+
+    def acquire(self, tokens: float = 1) -> None:
+        with self._cond:
+            while self._in_flight >= self.concurrency:
+                self._cond.wait()
+            self._in_flight += 1
+        self.bucket.acquire(tokens)
+
+    def release(self, latency_s: float, throttled: bool = False, succeeded: bool = True) -> None:
+        with self._cond:
+            self._in_flight -= 1
+            if throttled:
+                self._throttles.inc()
+                self._on_throttle()
+            elif succeeded:
+                self._on_success(latency_s)
+            self._cond.notify_all()
+
+    def _on_throttle(self) -> None:
+        # caller holds the condition
+        now = time.monotonic()
+        if now - self._last_cut < self.adjust_interval_s:
+            # one cut per interval, a burst of throttles from the same window is one signal
+            return
+        self._last_cut = self._last_adjust = now
+        self.bucket.set_rate(max(self.min_rate, self.bucket.rate * self.decrease_factor))
+        self.concurrency = max(1, int(self.concurrency * self.decrease_factor))
+        self._publish()
+        logger.warning(f"{self.name} is throttling, backing off to {self.bucket.rate:.1f}/s and {self.concurrency} in flight")
+
+    def _on_success(self, latency_s: float) -> None:
+        # caller holds the condition
+        self._latency_ewma = latency_s if self._latency_ewma is None else 0.8 * self._latency_ewma + 0.2 * latency_s
+        now = time.monotonic()
+        if now - self._last_adjust < self.adjust_interval_s:
+            return
+        self._last_adjust = now
+        self.bucket.set_rate(min(self.max_rate, self.bucket.rate + self.increase_step))
+        if self._latency_ewma <= self.latency_target_s:
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+        elif self.concurrency > 1:
+            # slower than target without throttling yet, stop piling on
+            self.concurrency -= 1
+        self._publish()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {"rate": self.bucket.rate, "concurrency": self.concurrency, "in_flight": self._in_flight,
+                    "latency_ms": round((self._latency_ewma or 0) * 1000, 3)}
+
+
+def create_storage_limiter(config, backend: str = None) -> AdaptiveLimiter or None:
+    """Builds the limiter for a storage backend (--storage-type by default), None when --storage-rate-limit is 0."""
+    if config.storage_rate_limit <= 0:
+        return None
+    return AdaptiveLimiter(
+        backend or config.storage_type,
+        rate=config.storage_rate_limit,
+        max_rate=config.storage_max_rate or None,
+        max_concurrency=config.storage_max_concurrency or config.workers
+    )
@@ -0,0 +1,208 @@
+import argparse
+import gzip
+import json
+import math
+import sys
+from decimal import Decimal
+from typing import Any, Dict, List, Optional, Tuple
+import json_codec
+
+# Storage encodings for widgets.
+# The verbose form keeps otherAttributes as the request has them, a list of {"name", "value"} dicts.
+# The compact form flattens them to a {name: value} map, which drops the repeated "name"/"value"
+# keys from every attribute and lets DynamoDB store them as a native map. S3 bodies can also be
+# compressed (gzip, or zstd when the zstandard package is installed) with a matching ContentEncoding.
+# Readers accept every form, so switching encodings doesn't need a migration.
+# JSON objects in S3 keep the order of the map, DynamoDB maps don't, so DynamoDB items also get the names
+# in their order (otherAttributeNames, keep_order) and widgets read back list their attributes as the
+# request did.
+#
+#   python widget_encoding.py requests.jsonl --attribute-format map --compression gzip
+
+ATTRIBUTE_FORMATS = ('list', 'map')
+# next to a flattened map, the attribute names in the request's order
+ATTRIBUTE_ORDER_KEY = 'otherAttributeNames'
+COMPRESSIONS = ('none', 'gzip', 'zstd')
+
+# DynamoDB bills writes in 1 KB units
+WRITE_UNIT_BYTES = 1024
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError("zstd compression needs the zstandard package (pip install zstandard)")
+    return zstandard
+
+
+def attributes_to_map(attributes: Any) -> Optional[Dict[str, Any]]:
+    """
+    Flattens [{"name": n, "value": v}, ...] to {n: v}.
+    Returns None when that would lose something (duplicate or non-string names, extra keys).
+    """
+    if not isinstance(attributes, list):
+        return None
+    flattened = {}
+    for attr in attributes:
+        if not isinstance(attr, dict) or set(attr) != {'name', 'value'}:
+            return None
+        name = attr['name']
+        if not isinstance(name, str) or not name or name in flattened:
+            return None
+        flattened[name] = attr['value']
+    return flattened
+
+
+def encode_widget(widget: Dict[str, Any], attribute_format: str = 'list', keep_order: bool = False) -> Dict[str, Any]:
+    """
+    Returns the widget in the given attribute format, widgets that can't be flattened stay as they are.
+    keep_order stores the attribute order next to the map, for stores whose maps don't keep it (DynamoDB).
+    """
+    if attribute_format != 'map':
+        return widget
+    flattened = attributes_to_map(widget.get('otherAttributes', []))
+    if flattened is None:
+        return widget
+    encoded = dict(widget, otherAttributes=flattened)
+    if keep_order and len(flattened) > 1:
+        encoded[ATTRIBUTE_ORDER_KEY] = list(flattened)
+    return encoded
+
+
+def decode_widget(item: Dict[str, Any]) -> Dict[str, Any]:
+    """Turns a stored widget in any attribute format back into the request's list form, in the request's order."""
+    attributes = item.get('otherAttributes')
+    if not isinstance(attributes, dict):
+        return item
+    decoded = dict(item)
+    names = decoded.pop(ATTRIBUTE_ORDER_KEY, None)
+    if not isinstance(names, list) or sorted(names) != sorted(attributes):
+        # no order stored (S3 keeps the map's own order), or one that doesn't match the map
+        names = list(attributes)
+    decoded['otherAttributes'] = [{'name': name, 'value': attributes[name]} for name in names]
+    return decoded
+
+
+def compress(body: bytes, compression: str = 'none') -> Tuple[bytes, Optional[str]]:
+    """Returns (body, ContentEncoding to store it with, None for an uncompressed body)."""
+    if compression == 'gzip':
+        # mtime=0 keeps the output identical for identical widgets
+        return gzip.compress(body, compresslevel=6, mtime=0), 'gzip'
+    if compression == 'zstd':
+        return _zstd().ZstdCompressor(level=3).compress(body), 'zstd'
+    return body, None
+
+
+def decompress(body: bytes, content_encoding: Optional[str]) -> bytes:
+    """Undoes compress() based on the object's ContentEncoding."""
+    if content_encoding == 'gzip':
+        return gzip.decompress(body)
+    if content_encoding == 'zstd':
+        return _zstd().ZstdDecompressor().decompress(body)
+    return body
+
+
+def encode_s3_body(widget: Dict[str, Any], attribute_format: str = 'list',
+                   compression: str = 'none') -> Tuple[bytes, Optional[str]]:
+    # the compact encoding drops the whitespace json.dumps puts in by default as well
+    body = json_codec.dumps(encode_widget(widget, attribute_format), compact=attribute_format == 'map')
+    return compress(body, compression)
+
+
+def decode_s3_body(body: bytes, content_encoding: Optional[str] = None) -> Dict[str, Any]:
+    return decode_widget(json_codec.loads(decompress(body, content_encoding)))
+
+
+def dynamodb_item_size(value: Any) -> int:
+    """
+    Approximates the size DynamoDB bills an item at: attribute names and string values by their
+    UTF-8 length, numbers by about one byte per two digits, plus 3 bytes and 1 byte per element for
+    maps and lists.
+    """
+    if isinstance(value, dict):
+        return 3 + sum(len(str(name).encode('utf-8')) + dynamodb_item_size(v) + 1 for name, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return 3 + sum(dynamodb_item_size(v) + 1 for v in value)
+    if isinstance(value, str):
+        return len(value.encode('utf-8'))
+    if isinstance(value, bool) or value is None:
+        return 1
+    if isinstance(value, (int, float, Decimal)):
+        digits = len(str(value).lstrip('-').replace('.', '').lstrip('0')) or 1
+        return math.ceil(digits / 2) + 1
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    return len(str(value).encode('utf-8'))
+
+
+def _top_level_size(item: Dict[str, Any]) -> int:
+    # top level attributes have no map overhead
+    return sum(len(name.encode('utf-8')) + dynamodb_item_size(value) for name, value in item.items())
+
+
+def write_capacity_units(item: Dict[str, Any]) -> int:
+    return max(1, math.ceil(_top_level_size(item) / WRITE_UNIT_BYTES))
+
+
+def widget_report(widget: Dict[str, Any], attribute_format: str = 'map', compression: str = 'gzip') -> Dict[str, Any]:
+    """Bytes and write units one widget takes in the verbose encoding vs the selected one."""
+    compact_item = encode_widget(widget, attribute_format, keep_order=True)
+    verbose_body, _ = encode_s3_body(widget)
+    compact_body, _ = encode_s3_body(widget, attribute_format, compression)
+    return {
+        "widgetId": widget.get("widgetId"),
+        "s3_bytes": len(verbose_body),
+        "s3_compact_bytes": len(compact_body),
+        "dynamodb_bytes": _top_level_size(widget),
+        "dynamodb_compact_bytes": _top_level_size(compact_item),
+        "dynamodb_wcu": write_capacity_units(widget),
+        "dynamodb_compact_wcu": write_capacity_units(compact_item),
+    }
+
+
+def savings_report(widgets: List[Dict[str, Any]], attribute_format: str = 'map', compression: str = 'gzip') -> Dict[str, Any]:
+    """Per-widget reports plus totals and the average saved per widget."""
+    widgets_report = [widget_report(widget, attribute_format, compression) for widget in widgets]
+    totals = {key: sum(r[key] for r in widgets_report) for key in widgets_report[0] if key != "widgetId"} if widgets_report else {}
+    count = max(1, len(widgets_report))
+    return {
+        "attribute_format": attribute_format,
+        "compression": compression,
+        "widgets": widgets_report,
+        "totals": totals,
+        "saved_per_widget": {
+            "s3_bytes": round((totals.get("s3_bytes", 0) - totals.get("s3_compact_bytes", 0)) / count, 1),
+            "dynamodb_bytes": round((totals.get("dynamodb_bytes", 0) - totals.get("dynamodb_compact_bytes", 0)) / count, 1),
+            "dynamodb_wcu": round((totals.get("dynamodb_wcu", 0) - totals.get("dynamodb_compact_wcu", 0)) / count, 3),
+        },
+    }
+
+
+def _stored_widget(request: Dict[str, Any]) -> Dict[str, Any]:
+    # the fields the storage strategies keep from a create request
+    widget = {field: request.get(field) for field in ("widgetId", "owner", "label", "description")}
+    widget["otherAttributes"] = request.get("otherAttributes", [])
+    return widget
+
+
+def main(argv: List[str] = None) -> Dict[str, Any]:
+    parser = argparse.ArgumentParser(description="Reports the bytes and DynamoDB write units a compact widget encoding saves.")
+    parser.add_argument('requests_file', help="JSON Lines file of widget create requests (e.g. captured traffic).")
+    parser.add_argument('--attribute-format', choices=ATTRIBUTE_FORMATS, default='map')
+    parser.add_argument('--compression', choices=COMPRESSIONS, default='gzip')
+    parser.add_argument('--per-widget', action='store_true', help="Include every widget in the output, not just the totals.")
+    args = parser.parse_args(argv)
+
+    with open(args.requests_file, encoding='utf-8') as f:
+        widgets = [_stored_widget(json.loads(line)) for line in f if line.strip()]
+    report = savings_report(widgets, args.attribute_format, args.compression)
+    if not args.per_widget:
+        report.pop("widgets")
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -1,148 +1,1039 @@
-import boto3
-import json
 import logging
-from typing import Protocol, runtime_checkable, Dict, Any
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import nullcontext
+from botocore.exceptions import ClientError
+from typing import Protocol, runtime_checkable, Dict, Any, Callable, Optional, List
 from config import ConsumerConfig
+from metrics import METRICS
+from dedup import RequestDedupCache
+from widget_encoding import encode_widget, decode_widget, encode_s3_body, decode_s3_body
+from widget_request import WidgetRequest, InvalidRequestError
+from throttling import AdaptiveLimiter, create_storage_limiter, is_throttle_error
+from aws_clients import ClientFactory
+from write_buffer import WriteBehindBuffer
+from s3_layout import OwnerIndex, WIDGET_PREFIX, owner_segment, widget_key
 
 logger = logging.getLogger(__name__)
 
+_VALIDATE_SECONDS = METRICS.stage("validate")
+_STORE_SECONDS = METRICS.stage("store")
+_BATCH_WRITE_SECONDS = METRICS.stage("batch_write")
+_PROCESSED = METRICS.counter("widget_requests_total", "Requests handled by the processor, by outcome.", outcome="processed")
+_SKIPPED = METRICS.counter("widget_requests_total", "Requests handled by the processor, by outcome.", outcome="skipped")
+_FAILED = METRICS.counter("widget_requests_total", "Requests handled by the processor, by outcome.", outcome="failed")
+_DUPLICATES = METRICS.counter("widget_requests_total", "Requests handled by the processor, by outcome.", outcome="duplicate")
+_COALESCED = METRICS.counter("widget_coalesced_requests_total", "Requests folded into a later write for the same widget.")
+_UPDATE_CONFLICTS = METRICS.counter("widget_update_conflicts_total", "Updates that lost a race with another write and were applied again.")
+
+# how often an update is read and applied again after another writer changed the widget in between
+UPDATE_CONFLICT_RETRIES = 5
+
+# called once a request has been durably handled and its source object can be deleted
+Ack = Optional[Callable[[], None]]
+# called instead of the ack when a write that was deferred (coalesced) fails, with the error
+Failure = Optional[Callable[[Exception], None]]
+
+def _merge_attributes(current: Optional[List[dict]], changes: Optional[List[dict]]) -> List[dict]:
+    # attributes are matched by name, a changed attribute keeps its place and new ones go last
+    merged = OrderedDict((attr.get('name'), attr) for attr in current or [])
+    for attr in changes or []:
+        merged[attr.get('name')] = attr
+    return list(merged.values())
+
+
+def apply_update(widget: Dict[str, Any], update_request: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Returns a copy of widget with an update request applied.
+    label and description are replaced when the request has them, otherAttributes are matched by name
+    and set to the request's value. widgetId and owner never change.
+    """
+    updated = dict(widget)
+    for field in ('label', 'description'):
+        if update_request.get(field) is not None:
+            updated[field] = update_request[field]
+    if update_request.get('otherAttributes'):
+        updated['otherAttributes'] = _merge_attributes(widget.get('otherAttributes'), update_request['otherAttributes'])
+    return updated
+
+
+def compose_updates(first: Dict[str, Any], second: Dict[str, Any]) -> Dict[str, Any]:
+    """Folds two update requests for the same widget into one that has the effect of applying both in order."""
+    composed = dict(second)
+    for field in ('label', 'description'):
+        if second.get(field) is None and first.get(field) is not None:
+            composed[field] = first[field]
+    composed['otherAttributes'] = _merge_attributes(first.get('otherAttributes'), second.get('otherAttributes'))
+    return composed
+
+
+def _is_missing(error: ClientError) -> bool:
+    return error.response.get('Error', {}).get('Code') in ('NoSuchKey', '404')
+
+
+def _is_conflict(error: ClientError) -> bool:
+    # S3 If-Match / If-None-Match and DynamoDB ConditionExpression failures
+    return error.response.get('Error', {}).get('Code') in ('PreconditionFailed', 'ConditionalRequestConflict',
+                                                            'ConditionalCheckFailedException')
 
 
 @runtime_checkable
 class StorageStrategy(Protocol):
-    """Protocol for all storage mechanisms."""
-    def store_widget(self, request_data: Dict[str, Any]) -> None:
+    """
+    Protocol for all storage mechanisms.
+    `ack` is called once the change is written (strategies that buffer writes may call it later).
+    A write that fails while the method runs raises, `on_failure` gets the error of a buffered write
+    that fails later on.
+    """
+    def store_widget(self, request_data: Dict[str, Any], ack: Ack = None, on_failure: Failure = None) -> None:
         """Stores the widget data in the underlying service."""
         ...
 
+    def update_widget(self, request_data: Dict[str, Any], ack: Ack = None, on_failure: Failure = None) -> None:
+        """Applies an update request to a stored widget, updates of missing widgets are skipped."""
+        ...
+
+    def delete_widget(self, request_data: Dict[str, Any], ack: Ack = None, on_failure: Failure = None) -> None:
+        """Deletes a stored widget, deleting a missing widget is not an error."""
+        ...
+
 
 class S3Storage:
-    def __init__(self, config: ConsumerConfig):
-        self.client = boto3.client('s3', region_name=config.region_name)
+    def __init__(self, config: ConsumerConfig, limiter: AdaptiveLimiter = None, clients: ClientFactory = None):
+        self.client = (clients or ClientFactory.from_config(config)).client('s3')
         self.bucket_name = config.bucket_3_name
+        self.attribute_format = config.attribute_format
+        self.compression = config.s3_compression
+        # paces calls to Bucket 3 and backs off on SlowDown
+        self.limiter = limiter
+        self.key_layout = config.s3_key_layout
+        self.shard_chars = config.s3_key_shard_chars
+        # while migrating to the hashed layout, widgets are also looked for (and cleaned up) at their old keys
+        self.legacy_reads = config.s3_legacy_reads and config.s3_key_layout != 'owner'
 
-    def store_widget(self, request_data: Dict[str, Any]) -> None:
+        self._index = None
+        if config.s3_owner_index:
+            self._index = OwnerIndex(self.client, self.bucket_name, flush_ms=config.s3_index_flush_ms, slot=self._slot,
+                                     backfill=self._listed_widget_ids if config.s3_index_backfill else None)
+
+    def _slot(self):
+        return self.limiter.slot() if self.limiter is not None else nullcontext()
+
+    def _key(self, request: WidgetRequest) -> str:
+        return request.s3_key(self.key_layout, self.shard_chars)
+
+    def _indexed(self, request: WidgetRequest, present: bool, ack: Ack) -> None:
+        # with an owner index the ack waits until the widget is in (or out of) the manifest
+        if self._index is None:
+            if ack:
+                ack()
+        elif present:
+            self._index.add(request.owner, request.widget_id, ack)
+        else:
+            self._index.remove(request.owner, request.widget_id, ack)
+
+    def _delete_legacy(self, request: WidgetRequest) -> None:
+        # so a stale copy at the old key is never read back
+        with self._slot():
+            self.client.delete_object(Bucket=self.bucket_name, Key=request.s3_key('owner'))
+
+    def store_widget(self, request_data: Dict[str, Any], ack: Ack = None, on_failure: Failure = None) -> None:
 
         """
-        Stores widget data in S3 bucket.
+        Stores widget data in S3 bucket. Writes are never deferred (owner index changes are retried
+        until they are written), so on_failure isn't used.
         """
-        widget_id = request_data.get("widgetId")
-        owner = request_data.get("owner")
-        request_id = request_data.get("requestId")
-        #type = request_data.get("type")
+        # already checked by the processor, a plain dict from any other caller is checked here
+        request = WidgetRequest.parse(request_data)
+        body, content_encoding = request.s3_body(self.attribute_format, self.compression)
+        self._put_body(self._key(request), body, content_encoding)
+        if self.legacy_reads:
+            self._delete_legacy(request)
+        logger.info("S3 Strategy: Storing widget %s in %s", request.widget_id, self.bucket_name)
+        self._indexed(request, True, ack)
 
-        # make sure the required fields are present
-        try: 
-            assert widget_id is not None, "widgetId is required in request_data"
-            assert owner is not None, "owner is required in request_data"
-            assert request_id is not None, "requestId is required in request_data"
+    def _put_widget(self, widget_key: str, widget_data: Dict[str, Any], etag: Optional[str]) -> None:
+        # only if the object is still the one that was read (or still missing, for a widget being migrated)
+        condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+        body, content_encoding = encode_s3_body(widget_data, self.attribute_format, self.compression)
+        self._put_body(widget_key, body, content_encoding, condition)
 
-        except AssertionError as e:
-            logger.error(f"S3 Strategy Error: {e}")
-            return None
+    def _put_body(self, widget_key: str, body: bytes, content_encoding: Optional[str], condition: dict = None) -> None:
+        params = dict(condition or {})
+        if content_encoding:
+            params["ContentEncoding"] = content_encoding
+        with self._slot():
+            self.client.put_object(
+                    Bucket=self.bucket_name,
+                    Key=widget_key,
+                    Body=body,
+                    ContentType="application/json",
+                    **params
+            )
+
+    def _get_widget(self, widget_key: str) -> tuple:
+        """(widget, ETag), (None, None) if there is no such object."""
+        try:
+            with self._slot():
+                obj = self.client.get_object(Bucket=self.bucket_name, Key=widget_key)
+        except ClientError as e:
+            if not _is_missing(e):
+                raise
+            return None, None
+        return decode_s3_body(obj['Body'].read(), obj.get('ContentEncoding')), obj['ETag']
+
+    def update_widget(self, request_data: Dict[str, Any], ack: Ack = None, on_failure: Failure = None) -> None:
+        """
+        Reads the stored widget, applies the update and writes it back if the object hasn't changed since,
+        otherwise it is read and updated again. A widget still at its legacy key is moved to the configured
+        layout on the way.
+        """
+        request = WidgetRequest.parse(request_data)
+        widget_id = request.widget_id
+        widget_key = self._key(request)
+        for attempt in range(UPDATE_CONFLICT_RETRIES + 1):
+            widget, etag = self._get_widget(widget_key)
+            migrated = False
+            if widget is None and self.legacy_reads:
+                widget = self._get_widget(request.s3_key('owner'))[0]
+                migrated = widget is not None
+            if widget is None:
+                _SKIPPED.inc()
+                logger.warning(f"S3 Strategy: Widget {widget_id} doesn't exist, skipping update")
+                if ack:
+                    ack()
+                return
+            try:
+                self._put_widget(widget_key, apply_update(widget, request), etag)
+                break
+            except ClientError as e:
+                if not _is_conflict(e) or attempt >= UPDATE_CONFLICT_RETRIES:
+                    raise
+                _UPDATE_CONFLICTS.inc()
+                time.sleep(0.01 * (2 ** attempt))
+
+        logger.info("S3 Strategy: Updated widget %s in %s", widget_id, self.bucket_name)
+        if migrated:
+            self._delete_legacy(request)
+            self._indexed(request, True, ack)
+        elif ack:
+            ack()
+
+    def delete_widget(self, request_data: Dict[str, Any], ack: Ack = None, on_failure: Failure = None) -> None:
+        """
+        Deletes the widget object, S3 doesn't mind if it is already gone.
+        """
+        request = WidgetRequest.parse(request_data)
+        with self._slot():
+            self.client.delete_object(Bucket=self.bucket_name, Key=self._key(request))
+        if self.legacy_reads:
+            self._delete_legacy(request)
+        logger.info("S3 Strategy: Deleted widget %s from %s", request.widget_id, self.bucket_name)
+        self._indexed(request, False, ack)
+
+    def _list_keys(self, prefix: str) -> List[str]:
+        keys = []
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket_name, Prefix=prefix):
+            keys.extend(obj['Key'] for obj in page.get('Contents', []))
+        return keys
+
+    def _listed_widget_keys(self, owner: str) -> List[str]:
+        # without the index, the hashed layout has to list every shard
+        if self.key_layout == 'owner':
+            return self._list_keys(f"{WIDGET_PREFIX}/{owner_segment(owner)}/")
+        keys = []
+        for shard in range(16 ** self.shard_chars):
+            keys.extend(self._list_keys(f"{WIDGET_PREFIX}/{shard:0{self.shard_chars}x}/{owner_segment(owner)}/"))
+        return keys
+
+    def _listed_widget_ids(self, owner: str) -> List[str]:
+        # backfills the owner index for an owner that has no manifest yet
+        return [key.rsplit('/', 1)[1] for key in self._listed_widget_keys(owner)]
+
+    def list_widget_keys(self, owner: str) -> List[str]:
+        """
+        Keys of an owner's widgets. With an owner index that is one read of the manifest, the hashed layout
+        without one has to list every shard. Legacy keys are included while legacy reads are on.
+        """
+        if self._index is not None:
+            keys = [widget_key(owner, widget_id, self.key_layout, self.shard_chars)
+                    for widget_id in self._index.widget_ids(owner)]
+        else:
+            keys = self._listed_widget_keys(owner)
+        if self.legacy_reads:
+            # an owner named like a shard shares its legacy prefix with that shard, legacy keys have 3 parts
+            legacy = [key for key in self._list_keys(f"{WIDGET_PREFIX}/{owner_segment(owner)}/") if key.count('/') == 2]
+            keys = sorted(set(keys).union(legacy))
+        return keys
+
+    def flush(self) -> None:
+        """Writes pending owner index changes."""
+        if self._index is not None:
+            self._index.flush()
+
+    def close(self) -> None:
+        if self._index is not None:
+            self._index.close()
+
+
+class DynamoDBBatchWriter:
+    """
+    Groups DynamoDB puts and deletes into BatchWriteItem calls of up to 25 items.
+
+    A batch is sent as soon as it is full or when its oldest item has waited max_latency_ms.
+    UnprocessedItems are retried with exponential backoff and each item's ack only runs once
+    DynamoDB has confirmed that item, so a crash before then leaves the source request in place.
+    A batch that fails (or items still unprocessed once the retries run out) calls the on_failure of
+    every item in it, never raises out of whichever add() happened to fill the batch.
+    """
+    MAX_BATCH_SIZE = 25
+
+    def __init__(self, table_name: str, client_getter: Callable[[], Any], batch_size: int = 25,
+                 max_latency_ms: int = 200, max_retries: int = 5, base_backoff_ms: int = 50,
+                 limiter: AdaptiveLimiter = None):
+        self.table_name = table_name
+        self.limiter = limiter
+        self._client_getter = client_getter
+        self.batch_size = max(1, min(batch_size, self.MAX_BATCH_SIZE))
+        self.max_latency_s = max_latency_ms / 1000.0
+        self.max_retries = max_retries
+        self.base_backoff_s = base_backoff_ms / 1000.0
+
+        # widgetId -> (write request, [acks], [failure callbacks]), dicts keep insertion order so the oldest item is first
+        self._pending: Dict[str, tuple] = {}
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, name="dynamodb-batch-flusher", daemon=True)
+        self._flusher.start()
+
+    def add(self, item: Dict[str, Any], ack: Ack = None, on_failure: Failure = None) -> None:
+        """
+        Queues a put for the next batch. A second write for the same widget before the batch goes out
+        replaces the first (BatchWriteItem rejects duplicate keys), both acks run once it is written.
+        """
+        self._queue(item["widgetId"], {"PutRequest": {"Item": item}}, ack, on_failure)
+
+    def delete(self, widget_id: str, ack: Ack = None, on_failure: Failure = None) -> None:
+        """Queues a delete for the next batch, replacing any pending put for the widget."""
+        self._queue(widget_id, {"DeleteRequest": {"Key": {"widgetId": widget_id}}}, ack, on_failure)
+
+    def pending(self, widget_id: str) -> Optional[Dict[str, Any]]:
+        """The write request still waiting to go out for a widget, if any."""
+        with self._lock:
+            entry = self._pending.get(widget_id)
+            return entry[0] if entry else None
+
+    def _queue(self, widget_id: str, write_request: Dict[str, Any], ack: Ack, on_failure: Failure) -> None:
+        batch = None
+        with self._lock:
+            _, acks, failures = self._pending.pop(widget_id, (None, [], []))
+            if ack:
+                acks.append(ack)
+            if on_failure:
+                failures.append(on_failure)
+            self._pending[widget_id] = (write_request, acks, failures)
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            if len(self._pending) >= self.batch_size:
+                batch = self._take_batch()
+        if batch:
+            self._write_batch(batch)
+
+    def flush(self) -> None:
+        """Writes everything that is still pending."""
+        while True:
+            with self._lock:
+                batch = self._take_batch()
+            if not batch:
+                return
+            self._write_batch(batch)
+
+    def close(self) -> None:
+        self._stop.set()
+        self._flusher.join()
+        self.flush()
+
+    def _take_batch(self) -> List[tuple]:
+        # caller holds the lock
+        batch = []
+        for widget_id in list(self._pending)[:self.batch_size]:
+            batch.append(self._pending.pop(widget_id))
+        self._oldest = time.monotonic() if self._pending else None
+        return batch
+
+    def _flush_loop(self) -> None:
+        while not self._stop.wait(self.max_latency_s / 2 or 0.05):
+            with self._lock:
+                due = self._oldest is not None and time.monotonic() - self._oldest >= self.max_latency_s
+                batch = self._take_batch() if due else None
+            if batch:
+                self._write_batch(batch)
+
+    @staticmethod
+    def _widget_id(write_request: Dict[str, Any]) -> str:
+        if "PutRequest" in write_request:
+            return write_request["PutRequest"]["Item"]["widgetId"]
+        return write_request["DeleteRequest"]["Key"]["widgetId"]
 
-        
-        widget_data = {
-                "widgetId": widget_id,
-                "owner": request_data["owner"],
-                "label": request_data["label"],
-                "description": request_data["description"],
-                "otherAttributes": request_data.get("otherAttributes", [])
-                }
-        # strip for spaces and lowercase the owner for the key
-        ownerstr = owner.replace(" ", "-").lower()
-        widget_key = f"widgets/{ownerstr}/{widget_id}"
-        self.client.put_object(
-                Bucket=self.bucket_name,
-                Key=widget_key,
-                Body=json.dumps(widget_data),
-                ContentType="application/json"
-        )
-        logger.info(f"S3 Strategy: Storing widget {widget_id} in {self.bucket_name}")
+    @staticmethod
+    def _fail(failures: List[Callable[[Exception], None]], error: Exception) -> None:
+        for on_failure in failures:
+            try:
+                on_failure(error)
+            except Exception as callback_error:
+                logger.error(f"DynamoDB Batch Error: failure callback failed. Error: {callback_error}")
 
+    def _write_batch(self, batch: List[tuple]) -> None:
+        acks_by_id = {self._widget_id(req): acks for req, acks, _ in batch}
+        failures_by_id = {self._widget_id(req): failures for req, _, failures in batch}
+        requests = [req for req, _, _ in batch]
+        client = self._client_getter()
+
+        attempt = 0
+        while requests:
+            if self.limiter is not None:
+                self.limiter.acquire(len(requests))
+            start = time.perf_counter()
+            try:
+                with _BATCH_WRITE_SECONDS.time():
+                    response = client.batch_write_item(RequestItems={self.table_name: requests})
+                unprocessed = response.get("UnprocessedItems", {}).get(self.table_name, [])
+            except Exception as e:
+                if self.limiter is not None:
+                    self.limiter.release(time.perf_counter() - start, throttled=is_throttle_error(e), succeeded=False)
+                if not is_throttle_error(e):
+                    # one bad item fails the whole call, every request in it hears about it
+                    logger.error(f"DynamoDB Batch Error: failed to write {len(requests)} widgets. Error: {e}")
+                    for req in requests:
+                        self._fail(failures_by_id.get(self._widget_id(req), []), e)
+                    return
+                # the whole batch was throttled, retry all of it below
+                unprocessed = requests
+            else:
+                if self.limiter is not None:
+                    # unprocessed items are DynamoDB throttling part of the batch
+                    self.limiter.release(time.perf_counter() - start, throttled=bool(unprocessed))
+
+            # everything that didn't come back unprocessed is written
+            unprocessed_ids = {self._widget_id(req) for req in unprocessed}
+            for req in requests:
+                widget_id = self._widget_id(req)
+                if widget_id not in unprocessed_ids:
+                    for ack in acks_by_id.pop(widget_id, []):
+                        ack()
+            logger.info("DynamoDB Batch: wrote %d widgets to %s", len(requests) - len(unprocessed), self.table_name)
+
+            requests = unprocessed
+            if not requests:
+                break
+            if attempt >= self.max_retries:
+                # DynamoDB kept throttling these, their requests are released to be tried again later
+                logger.error(f"DynamoDB Batch Error: giving up on {len(requests)} unprocessed widgets after {attempt} retries")
+                error = ClientError({"Error": {"Code": "ProvisionedThroughputExceededException",
+                                               "Message": f"still unprocessed after {attempt} retries"}},
+                                    "BatchWriteItem")
+                for req in requests:
+                    self._fail(failures_by_id.get(self._widget_id(req), []), error)
+                break
+            time.sleep(self.base_backoff_s * (2 ** attempt))
+            attempt += 1
 
 
 class DynamoDBStorage:
-    def __init__(self, config: ConsumerConfig):
-        dyno = boto3.resource('dynamodb', region_name=config.region_name)
-        self.table = dyno.Table(config.dynamodb_table_name)
+    def __init__(self, config: ConsumerConfig, limiter: AdaptiveLimiter = None, clients: ClientFactory = None):
+        self.region_name = config.region_name
+        self._clients = clients or ClientFactory.from_config(config)
+        self.table_name = config.dynamodb_table_name
+        self.attribute_format = config.attribute_format
+        # boto3 resources are not thread safe (clients are), so every worker thread gets its own Table,
+        # they all share the factory's one DynamoDB client
+        self._local = threading.local()
+        # paces calls to the table and backs off on ProvisionedThroughputExceededException
+        self.limiter = limiter
+
+        self._batch_writer = None
+        if config.dynamodb_batch_size > 1:
+            self._batch_writer = DynamoDBBatchWriter(
+                self.table_name,
+                client_getter=lambda: self.table.meta.client,
+                batch_size=config.dynamodb_batch_size,
+                max_latency_ms=config.dynamodb_batch_max_latency_ms,
+                limiter=limiter
+            )
+
+    def _slot(self):
+        return self.limiter.slot() if self.limiter is not None else nullcontext()
 
-    def store_widget(self, request_data: dict):
+    @property
+    def table(self):
+        table = getattr(self._local, "table", None)
+        if table is None:
+            table = self._local.table = self._clients.dynamodb_table(self.table_name)
+        return table
+
+    def store_widget(self, request_data: dict, ack: Ack = None, on_failure: Failure = None):
         """
-        Stores widget data in a DynamoDB table, flattening otherAttributes.
-    
+        Stores widget data in a DynamoDB table, flattening otherAttributes to a map with --attribute-format map.
+
         """
-    
-        # 1. Basic Validation (Same logic as your S3 example)
-        widget_id = request_data.get("widgetId")
-        owner = request_data.get("owner")
-        request_id = request_data.get("requestId")
-        type_check = request_data.get("type")
 
-        try:
-            assert widget_id is not None, "widgetId is required in request_data"
-            assert owner is not None, "owner is required in request_data"
-            assert request_id is not None, "requestId is required in request_data"
+        # already checked by the processor, a plain dict from any other caller is checked here
+        request = WidgetRequest.parse(request_data)
+        widget_id = request.widget_id
+        widget_data = request.dynamodb_item(self.attribute_format)
 
-        except AssertionError as e:
-            logger.error(f"DynamoDB Strategy Error: {e}")
-            return None
+        if self._batch_writer is not None:
+            self._batch_writer.add(widget_data, ack, on_failure)
+            return
 
-        widget_data = {
-                "widgetId": widget_id,
-                "owner": request_data["owner"],
-                "label": request_data["label"],
-                "description": request_data["description"],
-                "otherAttributes": request_data.get("otherAttributes", [])
-                }
-    
         try:
-            
-            self.table.put_item(Item=widget_data)
-            logger.info(f"DynamoDB Strategy Success: Stored widget {widget_id} in table")
+
+            with self._slot():
+                self.table.put_item(Item=widget_data)
+            logger.info("DynamoDB Strategy Success: Stored widget %s in table", widget_id)
         except Exception as e:
             logger.error(f"DynamoDB Put Error: Failed to store widget {widget_id}. Error: {e}")
             raise
+        if ack:
+            ack()
+
+    def update_widget(self, request_data: dict, ack: Ack = None, on_failure: Failure = None):
+        """
+        Applies an update request to the stored item (or to the put still waiting in the batch writer).
+        A stored item is written back only if its version is still the one that was read, otherwise
+        it is read and updated again.
+        """
+        request = WidgetRequest.parse(request_data)
+        widget_id = request.widget_id
+        pending = self._batch_writer.pending(widget_id) if self._batch_writer is not None else None
+        if pending is not None and "PutRequest" in pending:
+            # not written yet, the batch writer replaces its pending put with the updated one
+            widget = encode_widget(apply_update(decode_widget(pending["PutRequest"]["Item"]), request), self.attribute_format,
+                                   keep_order=True)
+            self._batch_writer.add(widget, ack, on_failure)
+            return
+        if pending is None:
+            for attempt in range(UPDATE_CONFLICT_RETRIES + 1):
+                with self._slot():
+                    item = self.table.get_item(Key={"widgetId": widget_id}, ConsistentRead=True).get("Item")
+                if item is None:
+                    break
+                try:
+                    self._put_versioned(item, request)
+                    logger.info("DynamoDB Strategy Success: Updated widget %s in table", widget_id)
+                    if ack:
+                        ack()
+                    return
+                except ClientError as e:
+                    if not _is_conflict(e) or attempt >= UPDATE_CONFLICT_RETRIES:
+                        raise
+                    _UPDATE_CONFLICTS.inc()
+                    time.sleep(0.01 * (2 ** attempt))
+
+        # missing, or a delete is still waiting in the batch writer
+        _SKIPPED.inc()
+        logger.warning(f"DynamoDB Strategy: Widget {widget_id} doesn't exist, skipping update")
+        if ack:
+            ack()
+
+    def _put_versioned(self, item: Dict[str, Any], request: WidgetRequest) -> None:
+        # items written by a create have no version yet, every update bumps it
+        version = item.get("version")
+        widget = encode_widget(apply_update(decode_widget(item), request), self.attribute_format, keep_order=True)
+        widget["version"] = (version or 0) + 1
+        if version is None:
+            condition = "attribute_exists(widgetId) AND attribute_not_exists(#version)"
+            values = {}
+        else:
+            condition = "#version = :version"
+            values = {"ExpressionAttributeValues": {":version": version}}
+        with self._slot():
+            self.table.put_item(Item=widget, ConditionExpression=condition,
+                                ExpressionAttributeNames={"#version": "version"}, **values)
+
+    def delete_widget(self, request_data: dict, ack: Ack = None, on_failure: Failure = None):
+        """
+        Deletes the widget item, deleting a missing item is a no-op in DynamoDB.
+        """
+        widget_id = WidgetRequest.parse(request_data).widget_id
+        if self._batch_writer is not None:
+            self._batch_writer.delete(widget_id, ack, on_failure)
+            return
+        with self._slot():
+            self.table.delete_item(Key={"widgetId": widget_id})
+        logger.info("DynamoDB Strategy Success: Deleted widget %s from table", widget_id)
+        if ack:
+            ack()
+
+    def flush(self) -> None:
+        """Writes any widgets waiting in the batch writer, the writer keeps running."""
+        if self._batch_writer is not None:
+            self._batch_writer.flush()
+
+    def close(self) -> None:
+        """Flushes any widgets still waiting in the batch writer."""
+        if self._batch_writer is not None:
+            self._batch_writer.close()
+
+
+
+
+class _FanOutAck:
+    """
+    Runs the request's ack once `required` of the counted sinks have acked their write, or its on_failure
+    once so many of them failed that it can't happen any more. Only one of the two ever runs.
+    """
+    __slots__ = ("_ack", "_on_failure", "_required", "_counted", "_acked", "_failed", "_settled", "_lock")
+
+    def __init__(self, ack: Ack, required: int, counted: set, on_failure: Failure = None):
+        self._ack = ack
+        self._on_failure = on_failure
+        self._required = required
+        self._counted = counted
+        self._acked = set()
+        self._failed = set()
+        self._settled = False
+        self._lock = threading.Lock()
+
+    def for_sink(self, name: str) -> Callable[[], None]:
+        def sink_ack():
+            with self._lock:
+                if name not in self._counted or name in self._acked or self._settled:
+                    return
+                self._acked.add(name)
+                done = self._settled = len(self._acked) == self._required
+            if done and self._ack:
+                self._ack()
+        return sink_ack
+
+    def for_sink_failure(self, name: str) -> Callable[[Exception], None]:
+        """The sink's on_failure, for a write it deferred."""
+        def sink_failure(error: Exception):
+            with self._lock:
+                if name not in self._counted or name in self._failed or self._settled:
+                    return
+                self._failed.add(name)
+                failed = self._settled = len(self._failed) > len(self._counted) - self._required
+            if failed and self._on_failure:
+                self._on_failure(error)
+        return sink_failure
+
+    def sink_raised(self, name: str) -> None:
+        """Counts a write that failed right away, the caller decides whether to raise."""
+        with self._lock:
+            if name in self._counted:
+                self._failed.add(name)
+
+    def settle(self) -> bool:
+        """Marks the request as failed by the caller (who raises), False if it was settled already."""
+        with self._lock:
+            settled, self._settled = self._settled, True
+            return not settled
+
+
+class CompositeStorage:
+    """
+    Writes every widget to several storage sinks at once (e.g. S3 and DynamoDB during a migration).
+
+    The policy decides when a request counts as stored:
+        all      every sink has written it
+        quorum   a majority of the sinks has written it
+        primary  the first sink has written it, the others are written in the background and their
+                 failures are only logged and counted
+    A request whose policy can't be met any more raises the sink's error so the worker retries it (or,
+    when a sink's deferred write made it fail, gets it through on_failure), writes are idempotent so sinks
+    that already have it just write it again.
+    At most max_pending secondary writes are queued or running at once (twice the pool by default),
+    past that a new request waits for one to finish, so a slow secondary holds the workers back
+    instead of piling up writes in memory.
+    """
+    POLICIES = ('all', 'quorum', 'primary')
+
+    def __init__(self, sinks: List[tuple], policy: str = 'all', max_workers: int = 8, max_pending: int = None):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unsupported sink policy: {policy}")
+        # [(name, strategy)], the first one is the primary
+        self.sinks = sinks
+        self.policy = policy
+        self.quorum = len(sinks) // 2 + 1
+        pool_size = max(1, max_workers * (len(sinks) - 1))
+        self._pool = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="storage-fan-out")
+        self._pending_slots = threading.BoundedSemaphore(max(1, max_pending or 2 * pool_size))
+        self._latency = {name: METRICS.histogram("widget_sink_seconds", "Time each storage sink takes per write.", sink=name)
+                         for name, _ in sinks}
+        self._failures = {name: METRICS.counter("widget_sink_failures_total", "Failed writes, by storage sink.", sink=name)
+                          for name, _ in sinks}
+
+    def store_widget(self, request_data: Dict[str, Any], ack: Ack = None, on_failure: Failure = None) -> None:
+        self._fan_out('store_widget', request_data, ack, on_failure)
+
+    def update_widget(self, request_data: Dict[str, Any], ack: Ack = None, on_failure: Failure = None) -> None:
+        self._fan_out('update_widget', request_data, ack, on_failure)
+
+    def delete_widget(self, request_data: Dict[str, Any], ack: Ack = None, on_failure: Failure = None) -> None:
+        self._fan_out('delete_widget', request_data, ack, on_failure)
+
+    def _write(self, name: str, strategy, method: str, request_data: Dict[str, Any], fan_out_ack: _FanOutAck) -> None:
+        try:
+            with self._latency[name].time():
+                getattr(strategy, method)(request_data, fan_out_ack.for_sink(name), fan_out_ack.for_sink_failure(name))
+        except Exception as e:
+            fan_out_ack.sink_raised(name)
+            self._failures[name].inc()
+            logger.error(f"Storage sink {name} failed to {method} widget {request_data.get('widgetId')}. Error: {e}")
+            raise
+
+    def _fan_out(self, method: str, request_data: Dict[str, Any], ack: Ack, on_failure: Failure) -> None:
+        names = [name for name, _ in self.sinks]
+        if self.policy == 'primary':
+            fan_out_ack = _FanOutAck(ack, 1, {names[0]}, on_failure)
+        else:
+            required = len(names) if self.policy == 'all' else self.quorum
+            fan_out_ack = _FanOutAck(ack, required, set(names), on_failure)
+
+        # secondaries go to the pool first, the primary is written on the calling thread meanwhile
+        futures = [self._submit(name, strategy, method, request_data, fan_out_ack)
+                   for name, strategy in self.sinks[1:]]
+        primary_name, primary = self.sinks[0]
+        primary_error = None
+        try:
+            self._write(primary_name, primary, method, request_data, fan_out_ack)
+        except Exception as e:
+            primary_error = e
+
+        if self.policy == 'primary':
+            if primary_error is not None and fan_out_ack.settle():
+                raise primary_error
+            return
+
+        # all / quorum: wait until enough sinks took the write or it can't happen any more
+        needed = len(names) if self.policy == 'all' else self.quorum
+        succeeded = 0 if primary_error else 1
+        errors = [primary_error] if primary_error else []
+        pending = set(futures)
+        while succeeded < needed and len(errors) <= len(names) - needed and pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    succeeded += 1
+                else:
+                    errors.append(future.exception())
+        # unless a deferred failure already reported it through on_failure
+        if succeeded < needed and fan_out_ack.settle():
+            raise errors[0]
+
+    def _submit(self, name: str, strategy, method: str, request_data: Dict[str, Any], fan_out_ack: _FanOutAck):
+        # blocks while max_pending secondary writes are outstanding
+        self._pending_slots.acquire()
+        try:
+            future = self._pool.submit(self._write, name, strategy, method, request_data, fan_out_ack)
+        except BaseException:
+            self._pending_slots.release()
+            raise
+        future.add_done_callback(lambda _: self._pending_slots.release())
+        return future
 
+    def latency_stats(self) -> Dict[str, dict]:
+        """p50/p95/p99 write latency per sink, in ms."""
+        return {name: {"count": histogram.snapshot()[2],
+                       "p50_ms": round(histogram.quantile(0.50) * 1000, 3),
+                       "p95_ms": round(histogram.quantile(0.95) * 1000, 3),
+                       "p99_ms": round(histogram.quantile(0.99) * 1000, 3)}
+                for name, histogram in self._latency.items()}
 
+    def flush(self) -> None:
+        for _, strategy in self.sinks:
+            flush = getattr(strategy, "flush", None)
+            if flush is not None:
+                flush()
+
+    def close(self) -> None:
+        # let background secondary writes finish before the sinks flush and stop
+        self._pool.shutdown(wait=True)
+        for _, strategy in self.sinks:
+            close = getattr(strategy, "close", None)
+            if close is not None:
+                close()
+
+
+class WriteCoalescer:
+    """
+    Holds requests per widget for window_ms and folds each widget's requests into the one write
+    that has the same end result:
+        create, then updates      -> one create with the updates applied
+        only updates              -> one update with the changes combined
+        anything, then a delete   -> one delete
+        a delete, then updates    -> one delete (updates of a missing widget are skipped anyway)
+    The acks of every folded request run once that write is done. If the write fails their failure
+    callbacks get the error instead, so the caller can release or quarantine the source requests.
+
+    Expired writes run on a pool of `workers` threads, one write per widget at a time so a widget's
+    writes stay in order. add() blocks while max_pending widgets are waiting or being written.
+    """
+    # widgets held at most (waiting for their window or being written) before add() blocks
+    MAX_PENDING = 10000
+
+    def __init__(self, write: Callable[[str, Dict[str, Any], Ack, Failure], None], window_ms: int = 50,
+                 workers: int = 1, max_pending: int = None):
+        self._write = write
+        self.window_s = window_ms / 1000.0
+        self.max_pending = max(1, max_pending or self.MAX_PENDING)
+        # widgetId -> [request type, request, [acks], [failure callbacks], first seen],
+        # dicts keep insertion order so the oldest is first
+        self._pending: Dict[str, list] = {}
+        # widgets handed to the pool whose write hasn't returned yet
+        self._writing = set()
+        self._changed = threading.Condition()
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="write-coalescer")
+        self._stop = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, name="write-coalescer", daemon=True)
+        self._flusher.start()
+
+    def add(self, request_type: str, request: Dict[str, Any], ack: Ack = None, on_failure: Failure = None) -> None:
+        widget_id = request["widgetId"]
+        with self._changed:
+            entry = self._pending.get(widget_id)
+            if entry is None:
+                # folding into a pending widget is always fine, a new one has to wait for room
+                while len(self._pending) + len(self._writing) >= self.max_pending:
+                    self._changed.wait()
+                    entry = self._pending.get(widget_id)
+                    if entry is not None:
+                        break
+            if entry is None:
+                self._pending[widget_id] = [request_type, request, [ack] if ack else [],
+                                            [on_failure] if on_failure else [], time.monotonic()]
+                return
+            entry[0], entry[1] = self._fold(entry[0], entry[1], request_type, request)
+            if ack:
+                entry[2].append(ack)
+            if on_failure:
+                entry[3].append(on_failure)
+        _COALESCED.inc()
+
+    @staticmethod
+    def _fold(pending_type: str, pending: Dict[str, Any], request_type: str, request: Dict[str, Any]) -> tuple:
+        if request_type != 'update':
+            # creates and deletes replace whatever came before
+            return request_type, request
+        if pending_type == 'create':
+            return 'create', apply_update(pending, request)
+        if pending_type == 'update':
+            return 'update', compose_updates(pending, request)
+        return pending_type, pending
+
+    def flush(self) -> None:
+        """Writes everything that is still pending and waits for the writes to return."""
+        with self._changed:
+            while self._pending or self._writing:
+                self._dispatch(expired_before=None)
+                self._changed.wait()
+
+    def close(self) -> None:
+        self._stop.set()
+        self._flusher.join()
+        self.flush()
+        self._pool.shutdown()
+
+    def _flush_loop(self) -> None:
+        while not self._stop.wait(self.window_s / 2 or 0.01):
+            with self._changed:
+                self._dispatch(expired_before=time.monotonic() - self.window_s)
+
+    def _dispatch(self, expired_before: Optional[float]) -> None:
+        # called with the lock held, hands the widgets that are due (all of them if expired_before
+        # is None) to the pool, a widget that is still being written waits for the next round
+        for widget_id, entry in list(self._pending.items()):
+            if expired_before is not None and entry[4] > expired_before:
+                break
+            if widget_id in self._writing:
+                continue
+            del self._pending[widget_id]
+            self._writing.add(widget_id)
+            self._pool.submit(self._write_entry, widget_id, entry)
+
+    def _write_entry(self, widget_id: str, entry: list) -> None:
+        request_type, request, acks, failures, _ = entry
+        fail_all = self._fail_all(widget_id, failures)
+        try:
+            # a write-behind buffer reports its own failures through fail_all later on
+            self._write(request_type, request, self._ack_all(acks), fail_all)
+        except Exception as e:
+            logger.error(f"Coalesced {request_type} of widget {widget_id} failed. Error: {e}")
+            if fail_all:
+                fail_all(e)
+        finally:
+            with self._changed:
+                self._writing.discard(widget_id)
+                self._changed.notify_all()
+
+    @staticmethod
+    def _ack_all(acks: List[Callable[[], None]]) -> Ack:
+        if not acks:
+            return None
+        def ack():
+            for each in acks:
+                each()
+        return ack
+
+    @staticmethod
+    def _fail_all(widget_id: str, failures: List[Callable[[Exception], None]]) -> Failure:
+        if not failures:
+            return None
+        def on_failure(error: Exception):
+            for each in failures:
+                try:
+                    each(error)
+                except Exception as callback_error:
+                    logger.error(f"Failure callback for widget {widget_id} failed. Error: {callback_error}")
+        return on_failure
 
 
 class Wiget_Processor:
-    def __init__(self, config: ConsumerConfig):
+    def __init__(self, config: ConsumerConfig, clients: ClientFactory = None):
         """
         Initialize the Widget Processor with the specified storage strategy.
+        `clients` shares AWS clients (and their connection pools) with the request source.
         """
-        if config.storage_type == 's3':
-            self._storage_strategy: StorageStrategy = S3Storage(config)
-        elif config.storage_type == 'dynamodb':
-            self._storage_strategy: StorageStrategy = DynamoDBStorage(config)
+        clients = clients or ClientFactory.from_config(config)
+        self._storage_strategy: StorageStrategy = self._create_storage(config.storage_type, config, clients)
+        if config.extra_storage_types:
+            # fan out to every sink, --storage-type is the primary
+            sinks = [(config.storage_type, self._storage_strategy)]
+            sinks += [(storage_type, self._create_storage(storage_type, config, clients))
+                      for storage_type in config.extra_storage_types]
+            self._storage_strategy = CompositeStorage(sinks, policy=config.sink_policy, max_workers=config.workers)
+
+        # writes are handed to drain threads so retrieval doesn't wait for slow storage
+        self._buffer = None
+        self._submit = self._write
+        if config.write_buffer_bytes > 0:
+            self._buffer = WriteBehindBuffer(
+                self._write,
+                max_bytes=config.write_buffer_bytes,
+                spill_path=config.write_buffer_spill_path,
+                workers=config.workers
+            )
+            self._submit = self._buffer.put
+
+        # bursts of requests for the same widget are folded into one write per window
+        self._coalescer = None
+        if config.coalesce_window_ms > 0:
+            self._coalescer = WriteCoalescer(self._submit, window_ms=config.coalesce_window_ms, workers=config.workers)
+
+        # requestIds that were already stored, repeats are acked without writing again
+        self._dedup_cache = None
+        if config.dedup_cache_size > 0:
+            self._dedup_cache = RequestDedupCache(
+                max_entries=config.dedup_cache_size,
+                ttl_s=config.dedup_ttl_s,
+                path=config.dedup_cache_path
+            )
+
+
+    @staticmethod
+    def _create_storage(storage_type: str, config: ConsumerConfig, clients: ClientFactory) -> StorageStrategy:
+        # every backend gets its own limiter (None unless --storage-rate-limit is set)
+        limiter = create_storage_limiter(config, storage_type)
+        if storage_type == 's3':
+            return S3Storage(config, limiter, clients)
+        elif storage_type == 'dynamodb':
+            return DynamoDBStorage(config, limiter, clients)
         else:
-            raise ValueError(f"Unsupported storage type: {config.storage_type}")
-        
+            raise ValueError(f"Unsupported storage type: {storage_type}")
 
-    def process(self, widget_data: dict):
+    def process(self, widget_data: dict, ack: Ack = None, on_failure: Failure = None):
         """
         Process the widget data and store it in the specified storage type.
+        widget_data is the decoded request, it is checked here once and handed on as a WidgetRequest.
+        `ack` is called once the request is fully handled, which may happen after this returns
+        if the storage strategy batches writes. A write that fails after this returned (a coalesced,
+        buffered or batched one) calls `on_failure` with the error instead, a write that fails in here raises.
+
+        Raises:
+            InvalidRequestError: If the request fails validation, `ack` is not called.
         """
 
-        request_type = widget_data.get('type')
-        if request_type is None:
-            logger.error("Error: 'type' field missing in payload. Skipping.")
-            return
-        request_type = request_type.lower()
-
-
-        if request_type == 'create':
-            logger.info("Processing: Widget Create Request...")
-            self._storage_strategy.store_widget(widget_data)
-        
-        elif request_type == 'UPDATE':
-            widget_id = widget_data.get("widgetId", "N/A")
-            logger.warning(f"Warning: Received UPDATE request for widget {widget_id}. Skipping (Implementation pending for HW7).")
-            
-        elif request_type == 'DELETE':
-            widget_id = widget_data.get("widgetId", "N/A")
-            logger.warning(f"Warning: Received DELETE request for widget {widget_id}. Skipping (Implementation pending for HW7).")
-            
+        try:
+            with _VALIDATE_SECONDS.time():
+                request = WidgetRequest.parse(widget_data)
+        except InvalidRequestError as e:
+            _FAILED.inc()
+            logger.error(f"Error: {e}. Skipping.")
+            raise
+
+        request_type = request.request_type
+        request_id = request.request_id
+        if self._dedup_cache is not None:
+            if self._dedup_cache.contains(request_id):
+                _DUPLICATES.inc()
+                logger.info("Request %s was already processed, skipping", request_id)
+                if ack:
+                    ack()
+                return
+            ack = self._remember_completed(request_id, ack)
+
+        logger.info("Processing: Widget %s Request...", request_type)
+        if self._coalescer is not None:
+            self._coalescer.add(request_type, request, ack, on_failure)
         else:
-            logger.error(f"Error: Unknown request type in payload: {request_type}. Skipping.")
+            self._submit(request_type, request, ack, on_failure)
+        _PROCESSED.inc()
+
+    def _write(self, request_type: str, widget_data: dict, ack: Ack, on_failure: Failure = None) -> None:
+        # a failure right here is raised to the caller (process() or a drain thread), on_failure is for
+        # writes the storage strategy batches and sends later
+        try:
+            with _STORE_SECONDS.time():
+                if request_type == 'create':
+                    self._storage_strategy.store_widget(widget_data, ack, on_failure)
+                elif request_type == 'update':
+                    self._storage_strategy.update_widget(widget_data, ack, on_failure)
+                else:
+                    self._storage_strategy.delete_widget(widget_data, ack, on_failure)
+        except Exception:
+            _FAILED.inc()
+            raise
+
+    def _remember_completed(self, request_id: str, ack: Ack) -> Ack:
+        # only cache the id once the write is confirmed, a failed write has to be retried
+        def ack_and_remember():
+            self._dedup_cache.add(request_id)
+            if ack:
+                ack()
+        return ack_and_remember
+
+    def flush(self, timeout: float = 30) -> bool:
+        """
+        Writes out anything the storage strategy is holding without shutting it down.
+        Waits up to timeout seconds for the write-behind buffer, writes it hasn't finished by then stay in it
+        (or in its spill file) and keep being retried. False if that happened.
+        """
+        if self._coalescer is not None:
+            self._coalescer.flush()
+        drained = True
+        if self._buffer is not None:
+            drained = self._buffer.flush(timeout)
+            if not drained:
+                logger.warning(f"Write-behind buffer still holds {self._buffer.pending()} writes after {timeout}s")
+        flush = getattr(self._storage_strategy, "flush", None)
+        if flush is not None:
+            flush()
+        if self._dedup_cache is not None:
+            self._dedup_cache.flush()
+        return drained
+
+    def close(self) -> None:
+        """Flushes anything the storage strategy is still holding."""
+        if self._coalescer is not None:
+            self._coalescer.close()
+        if self._buffer is not None:
+            self._buffer.close()
+        close = getattr(self._storage_strategy, "close", None)
+        if close is not None:
+            close()
+        if self._dedup_cache is not None:
+            self._dedup_cache.close()
@@ -0,0 +1,136 @@
+from collections.abc import Mapping
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+from widget_encoding import encode_widget, encode_s3_body
+from s3_layout import widget_key
+
+# The request model.
+# A request is checked once, when the processor gets it, and from then on travels as a WidgetRequest:
+# the typed fields sit in slots, the decoded dict underneath is kept as it is (no copy) and the object
+# still reads like that dict (request["owner"], request.get("label"), dict(request)), so code that
+# works on plain dicts (coalescing, updates, the write buffer) takes either. Every problem with a
+# request is reported at once as a list of FieldErrors instead of failing on the first one.
+
+KNOWN_REQUEST_TYPES = ('create', 'update', 'delete')
+REQUIRED_FIELDS = ('widgetId', 'owner', 'requestId')
+OPTIONAL_TEXT_FIELDS = ('label', 'description')
+
+
+class FieldError(NamedTuple):
+    field: str
+    code: str  # missing | type | unknown | invalid
+    message: str
+
+
+class InvalidRequestError(ValueError):
+    """Raised for requests that can never be processed, no matter how often they are retried."""
+    def __init__(self, errors):
+        if isinstance(errors, str):
+            errors = [FieldError('', 'invalid', errors)]
+        self.errors: List[FieldError] = list(errors)
+        super().__init__("; ".join(error.message for error in self.errors))
+
+
+def _check_attributes(attributes: Any, errors: List[FieldError]) -> None:
+    if not isinstance(attributes, list):
+        errors.append(FieldError('otherAttributes', 'type', "otherAttributes must be a list"))
+        return
+    for i, attr in enumerate(attributes):
+        if not isinstance(attr, dict) or not isinstance(attr.get('name'), str):
+            errors.append(FieldError(f'otherAttributes[{i}]', 'type',
+                                     f"otherAttributes[{i}] must be an object with a string name"))
+
+
+class WidgetRequest(Mapping):
+    """A validated widget request. Read-only, build it with WidgetRequest.parse()."""
+    __slots__ = ('request_type', 'request_id', 'widget_id', 'owner', 'label', 'description',
+                 'other_attributes', '_data', '_widget')
+
+    def __init__(self, data: Dict[str, Any], request_type: str):
+        # trusts data, parse() is the way in for anything that wasn't checked yet
+        self._data = data
+        self.request_type = request_type
+        self.request_id = data['requestId']
+        self.widget_id = data['widgetId']
+        self.owner = data['owner']
+        self.label: Optional[str] = data.get('label')
+        self.description: Optional[str] = data.get('description')
+        self.other_attributes: List[dict] = data.get('otherAttributes') or []
+        self._widget = None
+
+    @classmethod
+    def parse(cls, data: Any) -> "WidgetRequest":
+        """
+        Checks a decoded request in one pass.
+
+        Raises:
+            InvalidRequestError: With a FieldError for every problem found.
+        """
+        if isinstance(data, WidgetRequest):
+            return data
+        if not isinstance(data, dict):
+            raise InvalidRequestError(f"request must be a JSON object, got {type(data).__name__}")
+
+        errors: List[FieldError] = []
+        request_type = data.get('type')
+        if not isinstance(request_type, str):
+            errors.append(FieldError('type', 'missing', "'type' field missing in payload"))
+        else:
+            request_type = request_type.lower()
+            if request_type not in KNOWN_REQUEST_TYPES:
+                errors.append(FieldError('type', 'unknown', f"unknown request type in payload: {request_type}"))
+
+        for field in REQUIRED_FIELDS:
+            value = data.get(field)
+            if value is None:
+                errors.append(FieldError(field, 'missing', f"{field} is required in request_data"))
+            elif not isinstance(value, str):
+                errors.append(FieldError(field, 'type', f"{field} must be a string"))
+        for field in OPTIONAL_TEXT_FIELDS:
+            if data.get(field) is not None and not isinstance(data[field], str):
+                errors.append(FieldError(field, 'type', f"{field} must be a string"))
+        if data.get('otherAttributes') is not None:
+            _check_attributes(data['otherAttributes'], errors)
+
+        if errors:
+            raise InvalidRequestError(errors)
+        return cls(data, request_type)
+
+    # read-only dict view of the request as it was decoded
+    def __getitem__(self, key: str) -> Any:
+        return self._data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __repr__(self) -> str:
+        return f"WidgetRequest({self.request_type} {self.widget_id}, requestId={self.request_id})"
+
+    def to_dict(self) -> Dict[str, Any]:
+        """The decoded request itself, not a copy, don't modify it."""
+        return self._data
+
+    def stored_widget(self) -> Dict[str, Any]:
+        """The widget as the storage strategies keep it, built on first use. Missing label/description are left out."""
+        if self._widget is None:
+            widget = {"widgetId": self.widget_id, "owner": self.owner}
+            if self.label is not None:
+                widget["label"] = self.label
+            if self.description is not None:
+                widget["description"] = self.description
+            widget["otherAttributes"] = self.other_attributes
+            self._widget = widget
+        return self._widget
+
+    def s3_key(self, layout: str = 'owner', shard_chars: int = 2) -> str:
+        return widget_key(self.owner, self.widget_id, layout, shard_chars)
+
+    def s3_body(self, attribute_format: str = 'list', compression: str = 'none') -> Tuple[bytes, Optional[str]]:
+        """(object body, ContentEncoding) for S3Storage."""
+        return encode_s3_body(self.stored_widget(), attribute_format, compression)
+
+    def dynamodb_item(self, attribute_format: str = 'list') -> Dict[str, Any]:
+        """The item for DynamoDBStorage, the stored widget itself unless attributes are flattened."""
+        return encode_widget(self.stored_widget(), attribute_format, keep_order=True)
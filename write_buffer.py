@@ -0,0 +1,294 @@
+import json
+import json_codec
+import logging
+import os
+import threading
+import time
+import weakref
+from collections import deque
+from typing import Any, Callable, Dict, Optional
+from botocore.exceptions import BotoCoreError, ClientError
+from metrics import METRICS
+from throttling import is_throttle_error
+from widget_request import WidgetRequest
+
+logger = logging.getLogger(__name__)
+
+# Write-behind buffer between the processor and the storage strategy.
+# Retrieval doesn't wait for storage: process() hands the write to the buffer and returns, drain threads
+# write it out. Memory is capped at max_bytes of (serialized) requests. Past that the writes are appended
+# to a spill file, acked once they are fsynced there (the file now owns them, the source request can go),
+# and drained from the file in order once memory is free again. Until the file is drained every new write
+# goes to it too, so writes for the same widget never overtake each other.
+# On startup an existing spill file is replayed before anything else. Entries that were already written
+# before a crash are written again, which is harmless: creates and deletes overwrite, updates set fields.
+# Without a spill path a full buffer blocks process() instead (plain back-pressure).
+# Writes the sink rejects for good are handed to the entry's on_failure (the caller releases or quarantines
+# the request), spilled ones were acked already and go to a .failed file next to the spill file.
+# A spilled write only leaves the spill file once the sink acks it (or rejects it), a sink that queues
+# writes (the DynamoDB batch writer) may return before the write is stored.
+
+# the gauges add up every buffer in the process instead of following whichever was created last
+_BUFFERS = weakref.WeakSet()
+_BUFFERED_BYTES = METRICS.gauge("widget_write_buffer_bytes", "Bytes of writes held in memory by the write-behind buffers.")
+_BUFFERED_BYTES.set_function(lambda: sum(buffer._memory_bytes for buffer in list(_BUFFERS)))
+_SPILLED = METRICS.gauge("widget_write_buffer_spilled", "Writes waiting in the spill files.")
+_SPILLED.set_function(lambda: sum(buffer._spill_pending for buffer in list(_BUFFERS)))
+_SPILLS = METRICS.counter("widget_write_buffer_spills_total", "Writes that went to the spill file.")
+
+MAX_RETRY_BACKOFF_S = 30.0
+
+
+def _is_retryable(error: BaseException) -> bool:
+    """Throttling, connection trouble and 5xx responses, the sink should recover from those."""
+    if is_throttle_error(error) or isinstance(error, BotoCoreError):
+        return True
+    if isinstance(error, ClientError):
+        return error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500
+    return False
+
+
+class _Entry:
+    __slots__ = ("request_type", "request", "ack", "on_failure", "size", "spilled")
+
+    def __init__(self, request_type: str, request: Dict[str, Any], ack, size: int, spilled: bool, on_failure=None):
+        self.request_type = request_type
+        self.request = request
+        self.ack = ack
+        self.on_failure = on_failure
+        self.size = size
+        self.spilled = spilled
+
+
+class WriteBehindBuffer:
+    """
+    Bounded FIFO of (request type, request, ack, on_failure) drained into `write` by `workers` threads.
+    A widget has at most one write in flight, a later write for it waits for the earlier one.
+    """
+    def __init__(self, write: Callable[[str, Dict[str, Any], Optional[Callable[[], None]],
+                                        Optional[Callable[[Exception], None]]], None],
+                 max_bytes: int = 64 * 1024 * 1024, spill_path: str = None, workers: int = 4,
+                 base_backoff_s: float = 0.1):
+        self._write = write
+        self.max_bytes = max(1, max_bytes)
+        self.spill_path = spill_path
+        self.base_backoff_s = base_backoff_s
+
+        self._memory = deque()
+        self._memory_bytes = 0
+        self._in_flight = set()  # widgetIds being written
+        self._busy = 0
+        self._cond = threading.Condition()
+        self._stop = False
+
+        self._spill = None
+        self._spill_reader = None
+        self._spill_head: Optional[_Entry] = None
+        self._spill_unread = 0   # lines in the file nobody took yet
+        self._spill_pending = 0  # lines in the file the sink hasn't acked yet
+        if spill_path:
+            self._open_spill()
+
+        _BUFFERS.add(self)
+        self._drainers = [threading.Thread(target=self._drain_loop, name=f"write-behind-{i}", daemon=True)
+                          for i in range(max(1, workers))]
+        for drainer in self._drainers:
+            drainer.start()
+
+    def _open_spill(self) -> None:
+        """Opens the spill file and queues what a previous run left in it."""
+        lines = 0
+        complete = 0
+        if os.path.exists(self.spill_path):
+            with open(self.spill_path, 'rb') as spill:
+                for line in spill:
+                    if not line.endswith(b'\n'):
+                        # a torn last line from a crash, appending after it would corrupt the next entry
+                        break
+                    complete += len(line)
+                    lines += 1
+            if complete != os.path.getsize(self.spill_path):
+                os.truncate(self.spill_path, complete)
+        self._spill = open(self.spill_path, 'ab')
+        self._spill_reader = open(self.spill_path, 'rb')
+        self._spill_unread = self._spill_pending = lines
+        if lines:
+            logger.info(f"Replaying {lines} spilled writes from {self.spill_path}")
+
+    def put(self, request_type: str, request: Dict[str, Any], ack: Optional[Callable[[], None]] = None,
+            on_failure: Optional[Callable[[Exception], None]] = None) -> None:
+        """
+        Queues a write. The ack runs once it is stored, or once it is safe in the spill file.
+        on_failure gets the error instead if the sink rejects a write that is still in memory.
+        Blocks while memory is full and there is no spill file.
+        """
+        payload = request.to_dict() if isinstance(request, WidgetRequest) else request
+        line = json_codec.dumps({"type": request_type, "request": payload}, compact=True) + b"\n"
+        size = len(line)
+        with self._cond:
+            full = self._memory and self._memory_bytes + size > self.max_bytes
+            # while older writes wait in the file, newer ones queue behind them
+            spilling = self._spill_unread or self._spill_head is not None
+            if self._spill is None or not (spilling or full):
+                while self._spill is None and self._memory and self._memory_bytes + size > self.max_bytes:
+                    self._cond.wait()
+                # a single write bigger than max_bytes still gets in on its own
+                self._memory.append(_Entry(request_type, request, ack, size, False, on_failure))
+                self._memory_bytes += size
+                self._cond.notify_all()
+                return
+            self._spill.write(line)
+            self._spill.flush()
+            self._spill_unread += 1
+            self._spill_pending += 1
+            fileno = self._spill.fileno()
+            self._cond.notify_all()
+        _SPILLS.inc()
+        os.fsync(fileno)
+        if ack:
+            ack()
+
+    def _read_spilled(self) -> Optional[_Entry]:
+        # caller holds the condition
+        while self._spill_unread:
+            line = self._spill_reader.readline()
+            self._spill_unread -= 1
+            try:
+                record = json_codec.loads(line)
+                return _Entry(record["type"], record["request"], None, 0, True)
+            except (ValueError, KeyError, TypeError) as e:
+                logger.error(f"Dropping unreadable spilled write: {e}")
+                self._spill_pending -= 1
+        return None
+
+    def _take(self) -> Optional[_Entry]:
+        """Next write whose widget isn't in flight, oldest first. None once the buffer is stopped."""
+        with self._cond:
+            while True:
+                if self._stop:
+                    return None
+                entry = None
+                if self._memory:
+                    entry = self._memory[0]
+                elif self._spill_head is not None or self._spill_unread:
+                    if self._spill_head is None:
+                        self._spill_head = self._read_spilled()
+                    entry = self._spill_head
+                if entry is None or entry.request.get("widgetId") in self._in_flight:
+                    # an earlier write for the same widget is still going, keep the order
+                    self._cond.wait()
+                    continue
+                if entry.spilled:
+                    self._spill_head = None
+                else:
+                    self._memory.popleft()
+                self._in_flight.add(entry.request.get("widgetId"))
+                self._busy += 1
+                return entry
+
+    def _drain_loop(self) -> None:
+        while True:
+            entry = self._take()
+            if entry is None:
+                return
+            try:
+                self._drain(entry)
+            finally:
+                with self._cond:
+                    self._in_flight.discard(entry.request.get("widgetId"))
+                    self._busy -= 1
+                    if not entry.spilled:
+                        self._memory_bytes -= entry.size
+                    self._cond.notify_all()
+
+    def _spilled_callbacks(self, entry: _Entry) -> tuple:
+        """Ack and failure callbacks for a spilled entry, whichever runs first takes it off the spill file."""
+        settled = []
+
+        def done():
+            with self._cond:
+                if settled:
+                    return
+                settled.append(True)
+                self._spill_pending -= 1
+                if not self._spill_pending and not self._spill_unread and not self._spill.closed:
+                    # everything in the file is stored, start it over
+                    self._spill.truncate(0)
+                    self._spill_reader.seek(0)
+                self._cond.notify_all()
+
+        def on_failure(error: Exception):
+            if not settled:
+                # already acked, keep it next to the spill file instead of losing it
+                self._reject(entry, error)
+            done()
+
+        return done, on_failure
+
+    def _drain(self, entry: _Entry) -> bool:
+        """Writes the entry, retrying while the sink is unavailable. False if the buffer stopped first."""
+        if entry.spilled:
+            ack, on_failure = self._spilled_callbacks(entry)
+        else:
+            ack, on_failure = entry.ack, entry.on_failure
+        attempt = 0
+        while True:
+            try:
+                self._write(entry.request_type, entry.request, ack, on_failure)
+                return True
+            except Exception as e:
+                widget_id = entry.request.get("widgetId")
+                if not _is_retryable(e):
+                    if entry.spilled:
+                        on_failure(e)
+                    else:
+                        logger.error(f"Buffered {entry.request_type} of widget {widget_id} failed. Error: {e}")
+                        if entry.on_failure is not None:
+                            try:
+                                entry.on_failure(e)
+                            except Exception as callback_error:
+                                logger.error(f"Failure callback for widget {widget_id} failed. Error: {callback_error}")
+                    return True
+                backoff = min(MAX_RETRY_BACKOFF_S, self.base_backoff_s * (2 ** attempt))
+                attempt += 1
+                logger.warning(f"Storage is unavailable for widget {widget_id}, retrying in {backoff:.1f}s. Error: {e}")
+                with self._cond:
+                    # close() wakes us up
+                    self._cond.wait_for(lambda: self._stop, timeout=backoff)
+                    if self._stop:
+                        # a spilled write is replayed on the next start, a buffered one redelivered by the source
+                        return False
+
+    def _reject(self, entry: _Entry, error: BaseException) -> None:
+        logger.error(f"Spilled {entry.request_type} of widget {entry.request.get('widgetId')} failed, "
+                     f"moving it to {self.spill_path}.failed. Error: {error}")
+        with open(f"{self.spill_path}.failed", 'a', encoding='utf-8') as failed:
+            failed.write(json.dumps({"type": entry.request_type, "request": entry.request, "error": str(error)}) + "\n")
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._memory) + self._spill_pending + self._busy
+
+    def flush(self, timeout: float = None) -> bool:
+        """Waits until every queued write went to the sink. False if that took longer than timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._memory or self._spill_pending or self._busy:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self, timeout: float = 30) -> None:
+        """Drains for up to timeout seconds. What is left stays in the spill file (or unacked) for the next run."""
+        if not self.flush(timeout):
+            logger.warning(f"Stopping the write-behind buffer with {self.pending()} writes left")
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        for drainer in self._drainers:
+            drainer.join()
+        if self._spill is not None:
+            self._spill.close()
+            self._spill_reader.close()